@@ -0,0 +1,81 @@
+"""
+Память индексов запросов: pydantic-модели против компактных записей.
+
+Запуск: python -m benchmarks.memory [количество запросов, по умолчанию 1000000]
+
+Для каждого запроса строятся объекты, которые репозиторий держит в памяти:
+до перехода на записи - UserRequest, UniqueUserRequest и RequestForServer,
+после - RequestRecord (он же уникальный запрос) и ServerRecord.
+Отдельно измеряются индексы репозитория целиком (RequestRepository._index_request).
+"""
+
+import datetime
+import gc
+import sys
+import time
+import tracemalloc
+
+from utils.records import RequestRecord, ServerRecord
+from utils.repositories import Repository
+from utils.schemas import UserRequest, UniqueUserRequest, RequestForServer, Price, PercentOfTime, Period, Way
+
+SYMBOLS = 2000
+
+
+def make_models(n: int) -> list[UserRequest]:
+    dt = datetime.datetime.utcnow()
+    requests = []
+    for i in range(n):
+        symbol = f"sym{i % SYMBOLS}usdt"
+        if i % 2:
+            request_data = Price(target_price=1000 + i)
+        else:
+            request_data = PercentOfTime(target_percent=i / 100, period=Period.v_24h)
+        requests.append(
+            UserRequest(request_id=i, symbol=symbol, request_data=request_data, way=Way.up_to, created=dt, updated=dt)
+        )
+    return requests
+
+
+def measure(name: str, n: int, build) -> None:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    held = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<40} {size / n:8.0f} bytes/request {elapsed:8.2f}s")
+    del held
+
+
+def build_models(n: int):
+    requests = make_models(n)
+    return requests, [UniqueUserRequest(r) for r in requests], [RequestForServer(r) for r in requests]
+
+
+def build_records(n: int):
+    records = [RequestRecord.from_model(r) for r in make_models(n)]
+    gc.collect()
+    return records, [ServerRecord(r) for r in records]
+
+
+def build_repository(n: int):
+    repo = Repository(sql_db=None)
+    repo.clear()
+    for i, request in enumerate(make_models(n)):
+        repo._index_request(i % 1000, RequestRecord.from_model(request))
+    return repo
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"{n} requests, {SYMBOLS} symbols")
+    measure("pydantic models (before)", n, lambda: build_models(n))
+    measure("slotted records (after)", n, lambda: build_records(n))
+    measure("repository indexes with records", n, lambda: build_repository(n))
+
+
+if __name__ == "__main__":
+    main()
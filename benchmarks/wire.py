@@ -0,0 +1,97 @@
+"""
+Размер и скорость ответов репозитория: JSON (orjson) против MessagePack.
+
+Запуск: python -m benchmarks.wire [количество запросов, по умолчанию 100000]
+
+Для /requests/server/, /requests/unique/ и /requests/users/{user_id} измеряются размер тела,
+время кодирования на сервере и время декодирования клиентом: до сырых структур (orjson.loads,
+msgpack.unpackb) и до pydantic-моделей (в обоих случаях через model_construct).
+"""
+
+import sys
+import time
+
+import msgpack
+import orjson
+
+from benchmarks.memory import make_models
+from utils import wire
+from utils.records import RequestRecord, ServerRecord
+from utils.responses import dumps
+from utils.schemas import UserRequest, UniqueUserRequest, RequestForServer, Price, PercentOfPoint, PercentOfTime
+
+DATA_MODELS = {"price": Price, "percent_of_point": PercentOfPoint, "percent_of_time": PercentOfTime}
+
+
+def timed(func, repeat: int = 3) -> tuple[float, object]:
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def json_models(model, items: list[dict]) -> list:
+    """
+    Декодирует JSON так же, как utils.wire декодирует MessagePack: через model_construct без валидации.
+    """
+
+    result = []
+    for item in items:
+        data = item["request_data"]
+        item["request_data"] = DATA_MODELS[data["type_request"]].model_construct(**data)
+        result.append(model.model_construct(**item))
+    return result
+
+
+def compare(name: str, n: int, json_content, msgpack_content, json_model, loads_msgpack) -> None:
+    json_encode, json_body = timed(lambda: dumps(json_content()))
+    msgpack_encode, msgpack_body = timed(lambda: wire.dumps(msgpack_content()))
+    json_raw, _ = timed(lambda: orjson.loads(json_body))
+    msgpack_raw, _ = timed(lambda: msgpack.unpackb(msgpack_body))
+    json_decode, _ = timed(lambda: json_models(json_model, orjson.loads(json_body)))
+    msgpack_decode, _ = timed(lambda: loads_msgpack(msgpack_body))
+    print(name)
+    print(f"  {'':<10} {'bytes/request':>14} {'encode':>9} {'decode raw':>11} {'decode models':>14}")
+    for fmt, body, encode, raw, models in (
+            ("json", json_body, json_encode, json_raw, json_decode),
+            ("msgpack", msgpack_body, msgpack_encode, msgpack_raw, msgpack_decode),
+    ):
+        print(f"  {fmt:<10} {len(body) / n:14.1f} {encode:8.3f}s {raw:10.3f}s {models:13.3f}s")
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    records = [RequestRecord.from_model(model) for model in make_models(n)]
+    servers = [ServerRecord(record) for record in records]
+    print(f"{n} requests")
+    compare(
+        "/requests/server/",
+        n,
+        lambda: [request.to_dict() for request in servers],
+        lambda: [wire.request_for_server(request) for request in servers],
+        RequestForServer,
+        wire.loads_requests_for_server,
+    )
+    compare(
+        "/requests/unique/",
+        n,
+        lambda: [request.to_unique_dict() for request in records],
+        lambda: [wire.unique_request(request) for request in records],
+        UniqueUserRequest,
+        wire.loads_unique_requests,
+    )
+    compare(
+        "/requests/users/{user_id}",
+        n,
+        lambda: [request.to_dict() for request in records],
+        lambda: [wire.user_request(request) for request in records],
+        UserRequest,
+        wire.loads_user_requests,
+    )
+
+
+if __name__ == "__main__":
+    main()
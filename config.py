@@ -21,6 +21,70 @@ BINANCE API WEIGHTS
 """
 WEIGHT_GET_TICKER = 2
 WEIGHT_REQUEST_KLINE = 6
+WEIGHT_TICKER_PRICE = 2
+WEIGHT_TICKER_PRICE_MULTI = 4
+TICKER_PRICE_MAX_SYMBOLS = 500
+WEIGHT_TICKER_24H = 2
+WEIGHT_TICKER_24H_ALL = 80
+TICKER_24H_MAX_SYMBOLS = 20
+WEIGHT_TICKER_WINDOW_PER_SYMBOL = 4
+WEIGHT_TICKER_WINDOW_MAX = 200
+TICKER_WINDOW_MAX_SYMBOLS = 100
+PLAN_WEIGHT_BUDGET = int(os.getenv("PLAN_WEIGHT_BUDGET", 3000))
+PLAN_SLOT_SECONDS = 5
+PLAN_MAX_POLLS_PER_CYCLE = 3
+
+
+"""
+REPOSITORY
+"""
+BULK_CHUNK_SIZE = 1000
+DB_LOAD_CHUNK_SIZE = 10000
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 10))
+DB_READ_MAX_OVERFLOW = int(os.getenv("DB_READ_MAX_OVERFLOW", 20))
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", 2))
+CHANGELOG_SIZE = 10000
+LOCK_SHARDS = 1024
+
+
+"""
+PAGINATION
+"""
+PAGE_SIZE = 1000
+PAGE_MAX_SIZE = 10000
+NDJSON_CHUNK_SIZE = 1000
+
+
+"""
+STREAM
+"""
+STREAM_QUEUE_SIZE = 1000
+STREAM_PING_INTERVAL = 15
+
+
+"""
+WRITE BEHIND
+"""
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED") == "1"
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", 20))
+WRITE_BEHIND_BATCH_SIZE = 1000
+WRITE_BEHIND_DURABILITY = os.getenv("WRITE_BEHIND_DURABILITY", "commit")
+
+
+"""
+SNAPSHOT
+"""
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+SNAPSHOT_INTERVAL = 300
+
+
+"""
+CHANGE FEED
+"""
+CHANGE_FEED_ENABLED = os.getenv("CHANGE_FEED_ENABLED") == "1"
+CHANGE_FEED_CHANNEL = "ci_repo_changes"
 
 
 """
@@ -29,6 +93,8 @@ REDIS
 REDIS_HOST = "localhost"
 REDIS_PORT = 6379
 REDIS_DB = 0
+REDIS_PREFIX = "ci_repo"
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
 
 
 """
@@ -41,6 +107,10 @@ POSTGRESQL_PORT = os.getenv("POSTGRESQL_PORT")
 POSTGRESQL_DB = "ci"
 SQLALCHEMY_DATABASE_URL = (f"postgresql+asyncpg://{POSTGRESQL_USER}:{POSTGRESQL_PASSWORD}@{POSTGRESQL_HOST}:"
                            f"{POSTGRESQL_PORT}/{POSTGRESQL_DB}")
+POSTGRESQL_READ_HOST = os.getenv("POSTGRESQL_READ_HOST")
+POSTGRESQL_READ_PORT = os.getenv("POSTGRESQL_READ_PORT", POSTGRESQL_PORT)
+SQLALCHEMY_DATABASE_READ_URL = (f"postgresql+asyncpg://{POSTGRESQL_USER}:{POSTGRESQL_PASSWORD}@{POSTGRESQL_READ_HOST}:"
+                                f"{POSTGRESQL_READ_PORT}/{POSTGRESQL_DB}") if POSTGRESQL_READ_HOST else None
 
 
 """
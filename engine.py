@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import time
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
@@ -9,21 +11,84 @@ import config as cfg
 
 from sql.database import AlchemySqlDb
 from sql.models import Base
+from utils.backends import RedisBackend, LocalBackend
+from utils.changes import ChangeFeedListener
 from utils.repositories import Repository
 
-sql_db = AlchemySqlDb(cfg.SQLALCHEMY_DATABASE_URL, Base)
-repo = Repository(sql_db)
+sql_db = AlchemySqlDb(cfg.SQLALCHEMY_DATABASE_URL, Base, read_url=cfg.SQLALCHEMY_DATABASE_READ_URL)
+repo = Repository(sql_db, RedisBackend.from_config() if cfg.STATE_BACKEND == "redis" else LocalBackend())
 
 logger = logging.getLogger('uvicorn.error')
 
 
+async def load_with_stats(name: str, loader) -> None:
+    start = time.perf_counter()
+    rows = await loader()
+    elapsed = time.perf_counter() - start
+    logger.info(f'Loaded {rows} {name} in {elapsed:.2f}s ({rows / elapsed if elapsed else rows:.0f} rows/s)')
+
+
+async def save_snapshots() -> None:
+    while True:
+        await asyncio.sleep(cfg.SNAPSHOT_INTERVAL)
+        try:
+            await repo.save_snapshot(cfg.SNAPSHOT_PATH)
+        except Exception as e:
+            logger.error(f'save_snapshot error: {e}')
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info('Prepare database')
     await repo.sql_db.prepare()
-    await repo.load_users_from_db()
-    await repo.load_requests_from_db()
+    change_feed, change_feed_task = None, None
+    if cfg.CHANGE_FEED_ENABLED:
+        change_feed = ChangeFeedListener(repo.sql_db, repo.apply_changes, repo.reload)
+        change_feed_task = asyncio.create_task(change_feed.run())
+        await asyncio.wait_for(change_feed.listening.wait(), timeout=30)
+    start = time.perf_counter()
+    if repo.backend.shared and await repo.load_from_backend():
+        logger.info(f'Repository loaded from {cfg.STATE_BACKEND} backend')
+    else:
+        if cfg.SNAPSHOT_PATH and await repo.load_from_snapshot(cfg.SNAPSHOT_PATH):
+            logger.info(f'Repository loaded from snapshot {cfg.SNAPSHOT_PATH}')
+        else:
+            await asyncio.gather(
+                load_with_stats('users', repo.load_users_from_db),
+                load_with_stats('requests', repo.load_requests_from_db),
+            )
+        if repo.backend.shared:
+            await repo.save_to_backend()
+    registered = await repo.register_unique_requests()
+    if registered:
+        logger.info(f'Registered {registered} unique requests in the canonical id registry')
+    repo.planner.rebalance(repo.plan_priorities())
+    logger.info(f'Repository warm-up finished in {time.perf_counter() - start:.2f}s')
+    if change_feed:
+        change_feed.ready.set()
+    snapshot_task = asyncio.create_task(save_snapshots()) if cfg.SNAPSHOT_PATH else None
+    if cfg.WRITE_BEHIND_ENABLED:
+        repo.start_write_behind()
+        logger.info(f'Write-behind enabled ({cfg.WRITE_BEHIND_DURABILITY} durability)')
     yield
+    try:
+        await repo.stop_write_behind()
+    except Exception as e:
+        logger.error(f'write-behind drain error: {e}')
+    for task in (change_feed_task, snapshot_task):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.error(f'background task error: {e}')
+    if snapshot_task:
+        try:
+            await repo.save_snapshot(cfg.SNAPSHOT_PATH)
+        except Exception as e:
+            logger.error(f'save_snapshot error: {e}')
     logging.info("Application shutdown")
 
 
@@ -3,7 +3,8 @@ import sys
 
 import sentry_sdk
 import uvicorn
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, status, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import Annotated
 
@@ -11,8 +12,93 @@ import config
 from config import SENTRY_DSN
 
 from engine import app, repo
+from utils import wire
 from utils.auth import create_access_token, create_refresh_token
-from utils.schemas import Token, User, UserRequest, UserRequestSchema
+from utils.pagination import ndjson_lines
+from utils.responses import dumps
+from utils.stream import stream_changes
+from utils.schemas import (
+    Token,
+    User,
+    UserRequest,
+    UserRequestSchema,
+    TriggeredRequest,
+    Period,
+    BulkRequestItem,
+    BulkRequestResult,
+    BulkDeleteRequest,
+    UserRequestKey,
+    FetchPlan,
+)
+
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def accept_qualities(http_request: Request) -> dict[str, float]:
+    """
+    Разбирает заголовок Accept: {тип: q}. Некорректное значение q считается нулем.
+    """
+
+    qualities = {}
+    for item in http_request.headers.get('accept', '').split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[media_type.lower()] = quality
+    return qualities
+
+
+def wants(http_request: Request, media_type: str) -> bool:
+    """
+    Клиент явно указал media_type с q > 0 и не предпочитает ему JSON (в том числе через application/* и */*).
+    """
+
+    qualities = accept_qualities(http_request)
+    quality = qualities.get(media_type, 0)
+    json_quality = next(
+        (qualities[name] for name in ('application/json', 'application/*', '*/*') if name in qualities), 0
+    )
+    return quality > 0 and quality >= json_quality
+
+
+def wants_ndjson(http_request: Request) -> bool:
+    return wants(http_request, NDJSON_MEDIA_TYPE)
+
+
+def page_limit(limit: int | None) -> int:
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=422, detail='limit must be positive')
+    return min(limit or config.PAGE_SIZE, config.PAGE_MAX_SIZE)
+
+
+def page_response(items: dict, next_after: int | None) -> Response:
+    """
+    Страница keyset-пагинации: {"items": {id: запись}, "next_after": курсор следующей страницы или null}.
+    """
+
+    return Response(content=dumps({'items': items, 'next_after': next_after}), media_type='application/json')
+
+
+def ndjson_response(
+        page, after: int | None, limit: int | None, line=lambda key, value: value
+) -> StreamingResponse:
+    """
+    Потоковый ответ NDJSON: записи после курсора after (не больше limit) читаются страницами
+    по NDJSON_CHUNK_SIZE, по одной записи в строке.
+    """
+
+    return StreamingResponse(
+        ndjson_lines(page, config.NDJSON_CHUNK_SIZE, line, after, limit), media_type=NDJSON_MEDIA_TYPE
+    )
 
 
 @app.get('/users/{user_id}', response_model=User)
@@ -28,10 +114,14 @@ async def get_user(user_id: int):
 
 
 @app.get('/users/')
-async def get_all_users():
+async def get_all_users(http_request: Request, after: int | None = None, limit: int | None = None):
+    page_size = page_limit(limit)
     try:
-        res = await repo.get_all_users()
-        return res
+        if wants_ndjson(http_request):
+            return ndjson_response(repo.get_users_page, after, limit)
+        if after is not None or limit is not None:
+            return page_response(*await repo.get_users_page(after, page_size))
+        return Response(content=await repo.get_all_users_json(), media_type='application/json')
     except Exception as e:
         logging.error(f'get_all_users error: {e}')
         raise HTTPException(status_code=500, detail=f'get_all_users error: {e}')
@@ -76,20 +166,72 @@ async def update_user(user: User):
         raise HTTPException(status_code=400, detail=f'update_user error: {e}')
 
 
+@app.get('/requests/plan')
+async def get_requests_plan(rebalance: bool = False):
+    try:
+        return await repo.get_plan(rebalance)
+    except Exception as e:
+        logging.error(f'get_requests_plan error: {e}')
+        raise HTTPException(status_code=500, detail=f'get_requests_plan error: {e}')
+
+
+@app.get('/requests/fetch-plan', response_model=FetchPlan)
+async def get_fetch_plan(shard: int | None = None, of: int | None = None):
+    check_shard(shard, of)
+    try:
+        return await repo.get_fetch_plan(shard, of)
+    except Exception as e:
+        logging.error(f'get_fetch_plan error: {e}')
+        raise HTTPException(status_code=500, detail=f'get_fetch_plan error: {e}')
+
+
+@app.get('/requests/shards')
+async def get_shards(of: int):
+    if of < 1:
+        raise HTTPException(status_code=422, detail='of must be positive')
+    try:
+        return await repo.shard_weights(of)
+    except Exception as e:
+        logging.error(f'get_shards error: {e}')
+        raise HTTPException(status_code=500, detail=f'get_shards error: {e}')
+
+
+@app.get('/requests/stream')
+async def get_requests_stream(http_request: Request, since: int | None = None):
+    last_event_id = http_request.headers.get('last-event-id')
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    return StreamingResponse(
+        stream_changes(repo, since),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
 @app.get("/requests/{request_id}", response_model=UserRequest)
 async def get_request(request_id: int):
     try:
-        return await repo.get_unique_request(request_id)
+        request = await repo.get_unique_request(request_id)
     except Exception as e:
         logging.error(f'get_request error: {e}')
         raise HTTPException(status_code=500, detail=f'get_request error: {e}')
+    if not request:
+        raise HTTPException(status_code=404, detail=f"Request {request_id} not found")
+    return request.to_model()
 
 
 @app.get('/requests/')
-async def get_all_user_requests():
+async def get_all_user_requests(http_request: Request, after: int | None = None, limit: int | None = None):
+    page_size = page_limit(limit)
     try:
-        res = await repo.get_all_requests()
-        return res
+        if wants_ndjson(http_request):
+            return ndjson_response(
+                repo.get_requests_page, after, limit,
+                lambda user_id, requests: {'user_id': user_id, 'requests': requests},
+            )
+        if after is not None or limit is not None:
+            return page_response(*await repo.get_requests_page(after, page_size))
+        return Response(content=await repo.get_all_requests_json(), media_type='application/json')
     except Exception as e:
         logging.error(f'get_all_user_requests error: {e}')
         raise HTTPException(status_code=500, detail=f'get_all_user_requests error: {e}')
@@ -106,32 +248,130 @@ async def get_all_users_for_request(request_id: int):
 
 
 @app.get('/requests/users/{user_id}')
-async def get_all_requests_for_user(user_id: int):
+async def get_all_requests_for_user(user_id: int, http_request: Request, response: Response):
+    response.headers['Vary'] = 'Accept'
     try:
-        return await repo.get_all_requests_for_user(user_id)
+        res = await repo.get_all_requests_for_user(user_id)
+        if wants_msgpack(http_request):
+            return msgpack_response(wire.dumps(None if res is None else [wire.user_request(r) for r in res]))
+        return None if res is None else [request.to_model() for request in res]
     except Exception as e:
         logging.error(f'get_all_requests_for_user error: {e}')
         raise HTTPException(status_code=500, detail=f'get_all_requests_for_user error: {e}')
 
 
+def not_modified(http_request: Request, since: int | None, etag: str) -> bool:
+    """
+    Проверяет, что у клиента актуальная версия репозитория: since совпадает с текущей версией
+    или If-None-Match содержит ETag текущей версии в запрошенном формате.
+    """
+
+    if since is not None:
+        return since == repo.version
+    tags = http_request.headers.get('if-none-match', '')
+    return any(tag.strip().removeprefix('W/') == etag for tag in tags.split(','))
+
+
+def wants_msgpack(http_request: Request) -> bool:
+    return wants(http_request, wire.MEDIA_TYPE)
+
+
+def version_etag(msgpack: bool) -> str:
+    """
+    Сильный ETag версии репозитория. Представления JSON и MessagePack различаются, поэтому у MessagePack суффикс -mp.
+    """
+
+    return f'"{repo.version}-mp"' if msgpack else f'"{repo.version}"'
+
+
+def msgpack_response(body: bytes, headers: dict | None = None) -> Response:
+    return Response(content=body, media_type=wire.MEDIA_TYPE, headers={'Vary': 'Accept', **(headers or {})})
+
+
+def check_shard(shard: int | None, of: int | None) -> None:
+    if (shard is None) != (of is None) or (of is not None and not 0 <= shard < of):
+        raise HTTPException(status_code=422, detail='shard and of must be given together, 0 <= shard < of')
+
+
 @app.get('/requests/unique/')
-async def get_unique_requests():
+async def get_unique_requests(http_request: Request, response: Response, since: int | None = None):
+    msgpack = wants_msgpack(http_request)
+    etag = version_etag(msgpack)
+    if not_modified(http_request, since, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag, 'Vary': 'Accept'})
+    response.headers['ETag'] = etag
+    response.headers['Vary'] = 'Accept'
     try:
-        return await repo.to_list_unique_user_requests()
+        if msgpack:
+            if since is not None:
+                body = wire.dumps_changes(await repo.changes_since('unique', since), 'unique')
+            else:
+                body = await repo.unique_user_requests_msgpack()
+            return msgpack_response(body, {'ETag': etag})
+        if since is not None:
+            return await repo.changes_since('unique', since)
+        return Response(
+            content=await repo.unique_user_requests_json(),
+            media_type='application/json',
+            headers={'ETag': etag, 'Vary': 'Accept'},
+        )
     except Exception as e:
         logging.error(f'get_unique_requests error: {e}')
         raise HTTPException(status_code=500, detail=f'get_unique_requests error: {e}')
 
 
 @app.get('/requests/server/')
-async def get_requests_for_server():
+async def get_requests_for_server(
+        http_request: Request,
+        response: Response,
+        since: int | None = None,
+        shard: int | None = None,
+        of: int | None = None,
+):
+    check_shard(shard, of)
+    msgpack = wants_msgpack(http_request)
+    etag = version_etag(msgpack)
+    if not_modified(http_request, since, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag, 'Vary': 'Accept'})
+    response.headers['ETag'] = etag
+    response.headers['Vary'] = 'Accept'
     try:
-        return await repo.to_list_unique_requests_for_server()
+        if msgpack:
+            if since is not None:
+                body = wire.dumps_changes(await repo.changes_since('server', since, shard, of), 'server')
+            else:
+                body = await repo.requests_for_server_msgpack(shard, of)
+            return msgpack_response(body, {'ETag': etag})
+        if since is not None:
+            return await repo.changes_since('server', since, shard, of)
+        return Response(
+            content=await repo.requests_for_server_json(shard, of),
+            media_type='application/json',
+            headers={'ETag': etag, 'Vary': 'Accept'},
+        )
     except Exception as e:
         logging.error(f'get_all_requests_for_server error: {e}')
         raise HTTPException(status_code=500, detail=f'get_requests_for_server error: {e}')
 
 
+@app.post('/ticks', response_model=list[TriggeredRequest])
+async def evaluate_ticks(ticks: dict[str, float]):
+    try:
+        return await repo.evaluate_ticks(ticks)
+    except Exception as e:
+        logging.error(f'evaluate_ticks error: {e}')
+        raise HTTPException(status_code=500, detail=f'evaluate_ticks error: {e}')
+
+
+@app.post('/ticks/percent-of-time', response_model=list[TriggeredRequest])
+async def evaluate_percent_changes(changes: dict[str, dict[Period, float]]):
+    try:
+        return await repo.evaluate_percent_changes(changes)
+    except Exception as e:
+        logging.error(f'evaluate_percent_changes error: {e}')
+        raise HTTPException(status_code=500, detail=f'evaluate_percent_changes error: {e}')
+
+
 @app.post('/requests/', status_code=status.HTTP_201_CREATED)
 async def add_request(user_id: int, request: UserRequestSchema):
     request = UserRequest(**request.dict())
@@ -143,6 +383,31 @@ async def add_request(user_id: int, request: UserRequestSchema):
         raise HTTPException(status_code=500, detail=f'add_request error: {e}')
 
 
+@app.post('/requests/bulk', response_model=list[BulkRequestResult])
+async def add_requests(items: list[BulkRequestItem]):
+    try:
+        return await repo.add_requests([(item.user_id, UserRequest(**item.request.dict())) for item in items])
+    except Exception as e:
+        logging.error(f'add_requests error: {e}')
+        raise HTTPException(status_code=500, detail=f'add_requests error: {e}')
+
+
+@app.post('/requests/bulk/delete', response_model=list[UserRequestKey])
+async def delete_requests(query: BulkDeleteRequest):
+    if not (query.items or query.symbol or query.request_ids):
+        raise HTTPException(status_code=422, detail='delete_requests: no filter given')
+    try:
+        deleted = await repo.delete_requests(
+            keys=[(item.user_id, item.request_id) for item in query.items],
+            symbol=query.symbol,
+            request_ids=query.request_ids,
+        )
+        return [UserRequestKey(user_id=user_id, request_id=request_id) for user_id, request_id in deleted]
+    except Exception as e:
+        logging.error(f'delete_requests error: {e}')
+        raise HTTPException(status_code=500, detail=f'delete_requests error: {e}')
+
+
 @app.delete('/requests/{user_id}', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_request_for_user(user_id: int, request_id: int):
     if not await repo.get_user_request(user_id, request_id):
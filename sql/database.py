@@ -1,21 +1,68 @@
-from sqlalchemy import update
+import time
+
+import asyncpg
+from sqlalchemy import event, update, delete, select, tuple_
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.pool import NullPool
 
+import config
+
 
 class AlchemySqlDb:
-    def __init__(self, sql_url, base: type[DeclarativeBase], test: bool = False):
+    """
+    Движок и фабрики сессий БД.
+    Если задан read_url, чтения репозитория идут в реплику через read_session, а записи остаются на основной БД.
+    После фиксации транзакции на основной БД чтения read_your_writes секунд идут в нее же,
+    чтобы не прочитать с реплики состояние до собственной записи.
+    """
+
+    def __init__(
+            self,
+            sql_url,
+            base: type[DeclarativeBase],
+            test: bool = False,
+            read_url=None,
+            read_your_writes: float = config.DB_READ_YOUR_WRITES_SECONDS,
+    ):
         self.metadata = base.metadata
+        self.engine = self._create_engine(sql_url, test, config.DB_POOL_SIZE, config.DB_MAX_OVERFLOW)
+        self.SessionLocal = self._sessionmaker(self.engine)
+        self.read_engine = None
+        self.ReadSessionLocal = None
+        if read_url:
+            self.read_engine = self._create_engine(read_url, test, config.DB_READ_POOL_SIZE, config.DB_READ_MAX_OVERFLOW)
+            self.ReadSessionLocal = self._sessionmaker(self.read_engine)
+        self.read_your_writes = read_your_writes
+        self.last_commit = float("-inf")
+        event.listen(self.engine.sync_engine, "commit", self._on_commit)
+
+    @staticmethod
+    def _create_engine(sql_url, test: bool, pool_size: int, max_overflow: int) -> AsyncEngine:
         if test:
-            self.engine = create_async_engine(sql_url, poolclass=NullPool, echo=False)
-        else:
-            self.engine = create_async_engine(sql_url, echo=False)
-        self.SessionLocal = async_sessionmaker(
-            autocommit=False, autoflush=False, bind=self.engine, class_=AsyncSession, expire_on_commit=False
+            return create_async_engine(sql_url, poolclass=NullPool, echo=False)
+        return create_async_engine(sql_url, pool_size=pool_size, max_overflow=max_overflow, echo=False)
+
+    @staticmethod
+    def _sessionmaker(engine: AsyncEngine) -> async_sessionmaker:
+        return async_sessionmaker(
+            autocommit=False, autoflush=False, bind=engine, class_=AsyncSession, expire_on_commit=False
         )
 
+    def _on_commit(self, conn) -> None:
+        self.last_commit = time.monotonic()
+
+    def read_session(self) -> AsyncSession:
+        """
+        Сессия только для чтения: реплика, если она задана и последняя запись была раньше read_your_writes секунд назад,
+        иначе основная БД.
+        """
+
+        if self.ReadSessionLocal is None or time.monotonic() - self.last_commit < self.read_your_writes:
+            return self.SessionLocal()
+        return self.ReadSessionLocal()
+
     async def prepare(self):
         async with self.engine.begin() as conn:
             await conn.run_sync(self.metadata.create_all)
@@ -25,15 +72,44 @@ class AlchemySqlDb:
             await conn.run_sync(self.metadata.drop_all)
             await conn.run_sync(self.metadata.create_all)
 
+    async def raw_connection(self) -> asyncpg.Connection:
+        """
+        Открывает отдельное соединение asyncpg вне пула (для LISTEN).
+        """
+
+        return await asyncpg.connect(self.engine.url.set(drivername="postgresql").render_as_string(hide_password=False))
+
     @staticmethod
-    def insert_query(model, values: dict, index_elements: list):
-        return (
+    def insert_query(model, values: dict | list[dict], index_elements: list | None = None, returning: tuple = ()):
+        query = (
             insert(model)
-            .values(**values)
+            .values(values)
             .on_conflict_do_nothing(index_elements=index_elements)
         )
+        return query.returning(*returning) if returning else query
+
+    @staticmethod
+    def insert_or_select_query(model, values: list[dict], key: tuple, returning: tuple):
+        """
+        Одним запросом вставляет строки (INSERT ... ON CONFLICT DO NOTHING RETURNING в CTE) и читает
+        уже существующие строки с теми же ключами. SELECT видит снимок до вставки,
+        поэтому каждая строка возвращается не больше одного раза.
+        Строка, конфликт которой вызван не ключом или еще не зафиксированной вставкой, не возвращается.
+        """
+
+        inserted = insert(model).values(values).on_conflict_do_nothing().returning(*returning).cte("inserted")
+        existing = select(*returning).where(
+            tuple_(*key).in_([tuple(value[column.key] for column in key) for value in values])
+        )
+        return select(*inserted.c).union_all(existing)
+
+    @staticmethod
+    def update_query(model, where_col, where_value, values, returning: tuple = ()):
+        query = update(model).values(values).where(where_col == where_value)
+        return query.returning(*returning) if returning else query
 
     @staticmethod
-    def update_query(model, where_col, where_value, values):
-        return update(model).values(values).where(where_col, where_value)
+    def delete_query(model, where: tuple, returning: tuple = ()):
+        query = delete(model).where(*where)
+        return query.returning(*returning) if returning else query
 
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import ForeignKey, BigInteger, TIMESTAMP
+from sqlalchemy import ForeignKey, BigInteger, TIMESTAMP, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
 
 from utils.schemas import UserRequest, User
@@ -73,3 +73,25 @@ class UserRequestOrm(Base):
             created=request.created,
             updated=request.updated,
         )
+
+
+class UniqueRequestOrm(Base):
+    """
+    Реестр канонических request_id уникальных запросов (ключ дедупликации - символ, данные и направление).
+    Уникальный индекс по ключу выбирает id в БД, поэтому все экземпляры сервиса получают один и тот же id.
+    Строки не удаляются: уникальный запрос, добавленный повторно, получает прежний id.
+    """
+
+    __tablename__ = "unique_requests"
+    __table_args__ = (UniqueConstraint("symbol", "request_data", "way"),)
+
+    request_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    symbol: Mapped[str] = mapped_column()
+    request_data: Mapped[str] = mapped_column()
+    way: Mapped[str] = mapped_column()
+
+    def __repr__(self):
+        return (
+            f'UniqueRequestOrm(request_id={self.request_id}, symbol="{self.symbol}", '
+            f'request_data="{self.request_data}", way={self.way})'
+        )
@@ -1,12 +1,37 @@
+import asyncio
 import datetime
+import importlib
+import json
+import random
+import warnings
+from collections import deque
 
+import httpx
 import pytest
 import redis
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from fakeredis import aioredis as fakeredis, FakeServer, FakeRedis as SyncFakeRedis
+from fastapi.encoders import jsonable_encoder
 
 import config
 from sql.database import AlchemySqlDb
-from sql.models import Base, UserOrm
+from sql.models import Base, UserOrm, UserRequestOrm
+from utils.backends import RedisBackend, LocalBackend
+from utils.changes import ChangeFeedListener, add_request_event, delete_request_event, encode, publish
+from utils.engines import PriceCrossingEngine, PercentOfTimeEngine
+from utils.pagination import SortedIds, ndjson_lines
+from utils.patterns import RepositoryDB
+from utils.planner import WeightPlanner, build_fetch_plan
+from utils.sharding import shard_of
+from utils import wire
+from utils.records import RequestRecord, ServerRecord
 from utils.repositories import Repository
+from utils.locks import KeyLocks
+from utils.responses import ResponseCache, dumps
+from utils.stream import Subscription, stream_changes
+from utils.writebehind import GroupCommitQueue
+from utils.snapshot import user_to_row, request_to_row, user_from_row, request_from_row
 from utils.schemas import (
     RequestForServer,
     UniqueUserRequest,
@@ -17,15 +42,55 @@ from utils.schemas import (
     PercentOfPoint,
     User,
     UserRequest,
+    BulkStatus,
 )
 
 """
 CONFIG
 """
 test_sql = AlchemySqlDb(config.SQLALCHEMY_DATABASE_URL_TEST, Base, test=True)
+
 redis_db = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_HOST, db=config.REDIS_DB)
 
 
+class ReplicaRepository(Repository):
+    """
+    Второй экземпляр сервиса в том же процессе: свой объект-одиночка и свои индексы, БД общая.
+    """
+
+    _instance = None
+    users = {}
+    user_ids = SortedIds()
+    user_requests = {}
+    request_user_ids = SortedIds()
+    user_request_keys = {}
+    unique_user_requests = {}
+    unique_keys = {}
+    unique_request_ids = {}
+    unique_requests_for_server = set()
+    requests_for_server_refs = {}
+    price_engine = PriceCrossingEngine()
+    percent_engine = PercentOfTimeEngine()
+    planner = WeightPlanner()
+    changelog = deque(maxlen=config.CHANGELOG_SIZE)
+    subscriptions = set()
+    locks = KeyLocks()
+    responses = ResponseCache()
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """
+    Приложение с БД для тестов. Первый импорт engine создает движок из SQLALCHEMY_DATABASE_URL
+    и передает его репозиторию-одиночке, поэтому репозиторию возвращается движок тестов.
+    """
+
+    monkeypatch.setattr(config, "SQLALCHEMY_DATABASE_URL", config.SQLALCHEMY_DATABASE_URL_TEST)
+    main = importlib.import_module("main")
+    main.repo.sql_db = test_sql
+    return main.app
+
+
 class TestRequest:
     @staticmethod
     def test_comparison_request_server():
@@ -184,6 +249,55 @@ class TestRequest:
         assert ex1 != ex2
 
 
+class TestRecords:
+    models = [
+        UserRequest.create("btcusdt", Price(target_price=69000), Way.up_to),
+        UserRequest.create("btcusdt", PercentOfPoint(target_percent=-5, current_price=70000), Way.down_to),
+        UserRequest.create("ethusdt", PercentOfTime(target_percent=3, period=Period.v_8h), Way.all),
+    ]
+
+    def test_compatible_with_models(self):
+        for model in self.models:
+            record = RequestRecord.from_model(model)
+            assert record == model and model == record and hash(record) == hash(model)
+            assert record == UniqueUserRequest(model) and {UniqueUserRequest(model): 1} == {record: 1}
+            assert ServerRecord(record) == RequestForServer(model) and hash(ServerRecord(record)) == hash(
+                RequestForServer(model)
+            )
+            assert record.request_data.json() == model.request_data.json()
+            assert record.to_model() == model and record.to_model().request_id == model.request_id
+            assert record.to_unique().json() == UniqueUserRequest(model).json()
+        assert RequestRecord.from_model(self.models[0]) != RequestRecord.from_model(self.models[1])
+
+    def test_interned(self):
+        a = RequestRecord.from_model(UserRequest.create("".join(["btc", "usdt"]), Price(target_price=1), Way.up_to))
+        b = RequestRecord.from_model(UserRequest.create("".join(["btc", "usdt"]), Price(target_price=1), Way.up_to))
+        assert a.symbol is b.symbol
+        assert not hasattr(a, "__dict__")
+
+
+class TestWire:
+    models = TestRecords.models
+
+    def test_roundtrip(self):
+        records = [RequestRecord.from_model(model) for model in self.models]
+        for requests in (self.models, records):
+            decoded = wire.loads_user_requests(wire.dumps([wire.user_request(r) for r in requests]))
+            assert decoded == self.models
+            assert [(r.request_id, r.created, r.updated) for r in decoded] == [
+                (r.request_id, r.created, r.updated) for r in self.models
+            ]
+            decoded = wire.loads_unique_requests(wire.dumps([wire.unique_request(r) for r in requests]))
+            assert decoded == [UniqueUserRequest(model) for model in self.models]
+            decoded = wire.loads_requests_for_server(wire.dumps([wire.request_for_server(r) for r in requests]))
+            assert decoded == [RequestForServer(model) for model in self.models]
+        assert wire.loads_user_requests(wire.dumps(None)) is None
+
+    def test_compact(self):
+        body = wire.dumps([wire.unique_request(model) for model in self.models])
+        assert len(body) * 2 < len(dumps([UniqueUserRequest(model) for model in self.models]))
+
+
 class TestRequestRepository:
     repo = Repository(sql_db=test_sql)
     dt = datetime.datetime.utcnow()
@@ -350,9 +464,68 @@ class TestRequestRepository:
         assert self.repo.user_requests == res_user_requests_delete
         assert self.repo.unique_user_requests == res_unique_delete
 
+    @pytest.mark.asyncio
+    async def test_requests_for_server(self):
+        assert set(await self.repo.to_list_unique_requests_for_server()) == {
+            RequestForServer(self.user_request4),
+            RequestForServer(self.user_request6),
+        }
+        assert self.repo.planner.weight == 12
+        await self.repo.add_request(2, self.user_request1)
+        assert len(self.repo.unique_requests_for_server) == 3
+        assert self.repo.planner.weight == 14
+        await self.repo.delete_request(2, self.user_request1)
+        assert len(self.repo.unique_requests_for_server) == 2
+        assert self.repo.planner.weight == 12
+
+    @pytest.mark.asyncio
+    async def test_request_for_server_representative(self):
+        price = RequestRecord.from_model(UserRequest.create("reprusdt", Price(target_price=1), Way.up_to))
+        point = RequestRecord.from_model(
+            UserRequest.create("reprusdt", PercentOfPoint(target_percent=5, current_price=2, weight=3), Way.up_to)
+        )
+        price.request_id, point.request_id = 10 ** 9 + 1, 10 ** 9 + 2
+        weight = self.repo.planner.weight
+        self.repo._index_request(3, price)
+        self.repo._index_request(3, point)
+        version = self.repo.version
+
+        await self.repo._unindex_request(3, price)
+        assert self.repo.version == version + 3
+        server = [
+            request for request in await self.repo.to_list_unique_requests_for_server() if request.symbol == "REPRUSDT"
+        ]
+        assert server == [RequestForServer(UniqueUserRequest(point.to_model()))]
+        assert server[0].request_data == point.request_data.to_model()
+        assert self.repo.planner.weight == weight + 3
+        changes = await self.repo.changes_since("server", version)
+        assert [request.request_data for request in changes["added"]] == [point.request_data.to_model()]
+        assert [request.request_data for request in changes["removed"]] == [price.request_data.to_model()]
+
+        await self.repo._unindex_request(3, point)
+        assert self.repo.planner.weight == weight
+        assert ServerRecord(point) not in self.repo.requests_for_server_refs
+
+    @pytest.mark.asyncio
+    async def test_unique_registry(self):
+        request = UserRequest.create(
+            "ethusdt", PercentOfPoint(target_percent=23, current_price=70000), Way.up_to
+        )
+        await self.repo.add_request(3, request)
+        assert request.request_id == self.user_request4.request_id
+        assert self.repo.unique_request_ids[request.request_id] == UniqueUserRequest(request)
+        assert set(self.repo.unique_keys) == set(self.repo.unique_user_requests)
+        await self.repo.delete_request(3, request)
+        assert self.repo.unique_user_requests[UniqueUserRequest(request)] == {1}
+
     @pytest.mark.asyncio
     async def test_get(self):
         assert await self.repo.get_user_request(1, self.user_request4) == self.user_request4
+        assert await self.repo.get_user_request(1, self.user_request4.request_id) == self.user_request4
+        assert await self.repo.get_user_request(2, self.user_request4.request_id) is None
+        assert await self.repo.get_unique_request(self.user_request4.request_id) == self.user_request4
+        assert await self.repo.get_unique_request(1) is None
+        assert await self.repo.get_all_users_for_request(self.user_request6.request_id) == {1}
 
     @pytest.mark.asyncio
     async def test_get_all_requests_for_user_id(self):
@@ -367,9 +540,65 @@ class TestRequestRepository:
         await self.repo.add_request(2, self.user_request4)
         await self.repo.add_request(3, self.user_request4)
         assert await self.repo.get_all_users_for_request(self.user_request4) == {1, 2, 3}
+        records = [r for requests in self.repo.user_requests.values() for r in requests if r == self.user_request4]
+        assert len(records) == 3 and len({(id(r.request_data), id(r._hash)) for r in records}) == 1
         await self.repo.delete_request(2, self.user_request4)
         assert await self.repo.get_all_users_for_request(self.user_request4) == {1, 3}
 
+    @pytest.mark.asyncio
+    async def test_cached_responses(self):
+        def as_json(content):
+            return json.loads(json.dumps(jsonable_encoder(content)))
+
+        changes = [{"op": "update_user", "user": user_to_row(user)} for user in list(self.repo.users.values())]
+        await self.repo.apply_changes(changes)
+        users = await self.repo.get_all_users_json()
+        assert json.loads(users) == as_json(await self.repo.get_all_users())
+        assert await self.repo.get_all_users_json() is users
+        await self.repo.apply_changes(changes)
+        assert await self.repo.get_all_users_json() is not users
+        requests = await self.repo.get_all_requests_json()
+        assert json.loads(requests) == as_json(
+            {user_id: [r.to_model() for r in reqs] for user_id, reqs in (await self.repo.get_all_requests()).items()}
+        )
+        unique = await self.repo.unique_user_requests_json()
+        assert json.loads(unique) == as_json(await self.repo.to_list_unique_user_requests())
+        server = await self.repo.requests_for_server_json(0, 2)
+        assert json.loads(server) == as_json(await self.repo.to_list_unique_requests_for_server(0, 2))
+        assert await self.repo.unique_user_requests_json() is unique
+        assert await self.repo.requests_for_server_json(0, 2) is server
+        unique_models = await self.repo.to_list_unique_user_requests()
+        assert wire.loads_unique_requests(await self.repo.unique_user_requests_msgpack()) == unique_models
+        assert await self.repo.unique_user_requests_msgpack() is await self.repo.unique_user_requests_msgpack()
+
+        await self.repo.add_request(2, self.user_request4)
+        assert await self.repo.get_all_requests_json() != requests
+        assert await self.repo.unique_user_requests_json() is unique
+        await self.repo.delete_request(2, self.user_request4)
+        assert json.loads(await self.repo.get_all_requests_json()) == json.loads(requests)
+
+    @pytest.mark.asyncio
+    async def test_pages(self):
+        user_ids = sorted(self.repo.users)
+        page, next_after = await self.repo.get_users_page(None, 2)
+        assert list(page) == user_ids[:2] and next_after == user_ids[1]
+        page, next_after = await self.repo.get_users_page(next_after, 2)
+        assert list(page) == user_ids[2:4] and next_after is None
+        page, _ = await self.repo.get_requests_page(None, 10)
+        assert page == dict(sorted(self.repo.user_requests.items()))
+
+        chunks = [chunk async for chunk in ndjson_lines(self.repo.get_requests_page, 1, lambda key, value: key)]
+        assert [json.loads(line) for chunk in chunks for line in chunk.splitlines()] == sorted(self.repo.user_requests)
+
+        page, next_after = await self.repo.get_users_page(None, len(user_ids))
+        assert list(page) == user_ids and next_after is None
+        lines = [
+            json.loads(line) async for chunk in ndjson_lines(
+                self.repo.get_users_page, 1, lambda key, value: key, user_ids[0], 1
+            ) for line in chunk.splitlines()
+        ]
+        assert lines == user_ids[1:2]
+
     @pytest.mark.asyncio
     async def test_delete(self):
         await self.repo.delete_user(1)
@@ -377,6 +606,274 @@ class TestRequestRepository:
         assert len(self.repo.unique_user_requests) == 1
         assert len(self.repo.user_requests) == 1
 
+    @pytest.mark.asyncio
+    async def test_add_requests(self):
+        new_request = UserRequest.create(
+            "btcusdt", PercentOfTime(target_percent=5, period=Period.v_4h), Way.up_to
+        )
+        results = await self.repo.add_requests([
+            (3, UserRequest.create("ethusdt", PercentOfPoint(target_percent=23, current_price=70000), Way.up_to)),
+            (3, new_request),
+            (3, UserRequest.create("btcusdt", PercentOfTime(target_percent=5, period=Period.v_4h), Way.up_to)),
+            (99, UserRequest.create("btcusdt", Price(target_price=1), Way.up_to)),
+            (3, UserRequest.create("btcusdt", Price(target_price=69000), Way.up_to)),
+        ])
+        assert [r.status for r in results] == [
+            BulkStatus.exists, BulkStatus.created, BulkStatus.exists, BulkStatus.error, BulkStatus.created
+        ]
+        assert results[0].request_id == self.user_request4.request_id
+        assert results[1].request_id == results[2].request_id == new_request.request_id
+        assert len(self.repo.user_requests[3]) == 3
+        assert len(self.repo.unique_user_requests) == 3
+        assert self.repo.planner.weight == 14
+        assert await self.repo.get_user_request(3, new_request.request_id) == new_request
+
+    @pytest.mark.asyncio
+    async def test_delete_requests(self):
+        deleted = await self.repo.delete_requests(
+            keys=[(3, self.user_request4.request_id)], request_ids=list(range(1, 40000))
+        )
+        assert deleted == [(3, self.user_request4.request_id)]
+        assert len(self.repo.user_requests[3]) == 2
+        assert len(await self.repo.delete_requests(symbol="btcusdt")) == 2
+        assert self.repo.user_requests == {}
+        assert self.repo.unique_user_requests == {}
+        assert self.repo.unique_requests_for_server == set()
+        assert self.repo.planner.weight == 0
+
+    @pytest.mark.asyncio
+    async def test_load_from_db(self):
+        await self.repo.add_request(3, self.user_request7)
+        assert await asyncio.gather(self.repo.load_users_from_db(), self.repo.load_requests_from_db()) == [1, 1]
+        assert self.repo.user_requests == {3: {self.user_request7}}
+        assert self.repo.unique_user_requests == {UniqueUserRequest(self.user_request7): {3}}
+        assert set(self.repo.users) == {3}
+
+    @pytest.mark.asyncio
+    async def test_snapshot(self, tmp_path):
+        path = str(tmp_path / "repository.snapshot")
+        await self.repo.save_snapshot(path)
+        await self.repo.add_request(3, self.user_request1)
+        self.repo.clear()
+        assert await self.repo.load_from_snapshot(path)
+        assert self.repo.user_requests == {3: {self.user_request7, self.user_request1}}
+        assert self.repo.planner.weight == 4
+        assert set(self.repo.users) == {3}
+
+        with open(path, "r+b") as f:
+            f.seek(-1, 2)
+            last = f.read(1)
+            f.seek(-1, 2)
+            f.write(bytes([last[0] ^ 0xFF]))
+        self.repo.clear()
+        assert not await self.repo.load_from_snapshot(path)
+        assert self.repo.user_requests == {}
+        assert await self.repo.load_requests_from_db() == 2
+
+    @pytest.mark.asyncio
+    async def test_changes_since(self):
+        version = self.repo.version
+        assert await self.repo.changes_since("unique", version) == {
+            "version": version, "reset": False, "added": [], "removed": []
+        }
+        await self.repo.add_request(3, self.user_request5)
+        delta = await self.repo.changes_since("unique", version)
+        assert delta["added"] == [UniqueUserRequest(self.user_request5)] and delta["removed"] == []
+        assert (await self.repo.changes_since("server", version))["added"] == [RequestForServer(self.user_request5)]
+        added_version = self.repo.version
+        await self.repo.delete_request(3, self.user_request5)
+        assert (await self.repo.changes_since("unique", version))["added"] == []
+        assert (await self.repo.changes_since("unique", added_version))["removed"] == [
+            UniqueUserRequest(self.user_request5)
+        ]
+        delta = await self.repo.changes_since("unique", 0)
+        assert delta["reset"] and set(delta["added"]) == set(self.repo.unique_user_requests)
+
+    @pytest.mark.asyncio
+    async def test_stream(self):
+        version = self.repo.version
+        stream = stream_changes(self.repo)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            snapshot = await anext(stream)
+        assert snapshot.startswith(f"id: {version}\nevent: snapshot\n")
+        data = json.loads(snapshot.split("data: ", 1)[1])
+        assert data["unique"] == jsonable_encoder(await self.repo.to_list_unique_user_requests())
+        next_event = asyncio.ensure_future(anext(stream))
+        await self.repo.add_request(3, self.user_request5)
+        event = await next_event
+        assert event.startswith(f"id: {version + 1}\nevent: added\n") and '"kind":"unique"' in event
+        item = json.loads(event.split("data: ", 1)[1])["item"]
+        assert item == jsonable_encoder(UniqueUserRequest(self.user_request5))
+        resumed = stream_changes(self.repo, since=version)
+        assert (await anext(resumed)) == event
+        await self.repo.delete_request(3, self.user_request5)
+        await stream.aclose()
+        await resumed.aclose()
+        assert not self.repo.subscriptions
+
+        subscription = Subscription(maxsize=1)
+        subscription.push((1, "unique", True, UniqueUserRequest(self.user_request5)))
+        subscription.push((2, "unique", False, UniqueUserRequest(self.user_request5)))
+        assert subscription.overflowed and subscription.queue.qsize() == 1
+
+    @pytest.mark.asyncio
+    async def test_plan(self):
+        await self.repo.add_request(3, self.user_request5)
+        assert self.repo.plan_priorities() == {
+            RequestForServer(self.user_request7): 1 / 24,
+            RequestForServer(self.user_request1): 1 / 24,
+            RequestForServer(self.user_request5): 1 / 101,
+        }
+        plan = await self.repo.get_plan(rebalance=True)
+        assert sum(slot["weight"] for slot in plan["slots"]) == self.repo.planner.weight
+        assert plan["slots"][-1]["requests"][-1] == RequestForServer(self.user_request5)
+        await self.repo.delete_request(3, self.user_request5)
+        assert len(self.repo.planner) == len(self.repo.unique_requests_for_server)
+        plan = await self.repo.get_fetch_plan()
+        assert plan is await self.repo.get_fetch_plan()
+        assert (plan.total_weight, plan.naive_weight) == (2, 4)
+        assert self.repo.requests_weight == plan.total_weight
+
+    @pytest.mark.asyncio
+    async def test_shards(self):
+        await self.repo.add_request(3, self.user_request5)
+        parts = [await self.repo.to_list_unique_requests_for_server(i, 3) for i in range(3)]
+        assert sorted(map(repr, sum(parts, []))) == sorted(map(repr, self.repo.unique_requests_for_server))
+        weights = await self.repo.shard_weights(3)
+        assert sum(stats["weight"] for stats in weights) == self.repo.planner.weight
+        assert [stats["requests"] for stats in weights] == [len(part) for part in parts]
+        await self.repo.delete_request(3, self.user_request5)
+
+    @pytest.mark.asyncio
+    async def test_delete_unindexed(self):
+        orphan = RequestRecord.from_model(UserRequest.create("orphanusdt", Price(target_price=1), Way.up_to))
+        key = (3, orphan.request_id)
+        async with test_sql.SessionLocal() as session:
+            await session.execute(test_sql.insert_query(UserRequestOrm, self.repo._request_values(3, orphan)))
+            await session.commit()
+        with pytest.raises(Exception, match="not found"):
+            await self.repo.delete_request(*key)
+        assert key in {(r.user_id, r.request_id) for r in await self.repo.get_all_requests_from_db()}
+        assert await self.repo.delete_requests(keys=[key]) == [key]
+
+    @pytest.mark.asyncio
+    async def test_write_behind(self):
+        async def db_keys():
+            return {(r.user_id, r.request_id) for r in await self.repo.get_all_requests_from_db()}
+
+        requests = [
+            UserRequest.create(f"wb{i}usdt", Price(target_price=i + 1), Way.up_to) for i in range(50)
+        ]
+        await self.repo.load_users_from_db()
+        self.repo.start_write_behind("commit")
+        queue = self.repo.write_queue
+        await asyncio.gather(*(self.repo.add_request(3, request) for request in requests))
+        assert 1 <= queue.batches < 10
+        assert {(3, request.request_id) for request in requests} <= await db_keys()
+        await asyncio.gather(*(self.repo.delete_request(3, request.request_id) for request in requests))
+        assert not {(3, request.request_id) for request in requests} & await db_keys()
+        await self.repo.stop_write_behind()
+
+        self.repo.start_write_behind("memory")
+        await self.repo.add_request(3, requests[0])
+        assert await self.repo.get_user_request(3, requests[0].request_id)
+        assert (3, requests[0].request_id) not in await db_keys()
+        await self.repo.delete_request(3, requests[0].request_id)
+        await self.repo.add_request(3, requests[1])
+        with pytest.raises(Exception, match="not found"):
+            await self.repo.add_request(999, requests[2])
+        again = UserRequest.create("wb2usdt", Price(target_price=3), Way.up_to)
+        await self.repo.add_request(3, again)
+        assert again.request_id != requests[2].request_id
+        await self.repo.flush_writes()
+        assert await self.repo.get_user_request(3, requests[2].request_id) == again
+        assert await self.repo.get_unique_request(requests[2].request_id) == again
+        assert (3, requests[2].request_id) in await db_keys()
+        await self.repo.delete_request(3, requests[2].request_id)
+        await self.repo.stop_write_behind()
+        keys = await db_keys()
+        assert (3, requests[1].request_id) in keys and (3, requests[0].request_id) not in keys
+        await self.repo.delete_request(3, requests[1])
+
+    async def check_invariants(self, user_ids: list[int]):
+        for user_id, requests in self.repo.user_requests.items():
+            assert user_id in self.repo.users or user_id not in user_ids
+            for request in requests:
+                assert request.request_id == self.repo.unique_keys[request].request_id
+                assert user_id in self.repo.unique_user_requests[request]
+                assert self.repo.user_request_keys[(user_id, request.request_id)] == request
+        for request, subscribers in self.repo.unique_user_requests.items():
+            assert subscribers == {u for u, requests in self.repo.user_requests.items() if request in requests}
+        rows = await self.repo.get_all_requests_from_db()
+        assert {(r.user_id, r.request_id) for r in rows} == set(self.repo.user_request_keys)
+        canonical_ids = {}
+        for row in rows:
+            assert canonical_ids.setdefault((row.symbol, row.request_data, row.way), row.request_id) == row.request_id
+
+    @pytest.mark.asyncio
+    async def test_content_negotiation(self, app):
+        msgpack = wire.MEDIA_TYPE
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            async def get(accept: str | None = None, etag: str | None = None):
+                headers = {key: value for key, value in (("Accept", accept), ("If-None-Match", etag)) if value}
+                return await client.get("/requests/unique/", headers=headers)
+
+            json_etag = (await get()).headers["etag"]
+            response = await get(f"{msgpack}, application/json;q=0.5")
+            assert response.headers["content-type"] == msgpack
+            msgpack_etag = response.headers["etag"]
+            assert msgpack_etag == json_etag[:-1] + '-mp"'
+            for accept in (f"{msgpack};q=0, application/json", f"application/json, {msgpack};q=0.5", "*/*"):
+                assert (await get(accept)).headers["content-type"] == "application/json"
+            assert (await get(msgpack, json_etag)).status_code == 200
+            assert (await get(msgpack, msgpack_etag)).status_code == 304
+            assert (await get("application/json", msgpack_etag)).status_code == 200
+
+    @pytest.mark.asyncio
+    async def test_concurrent_mutations(self, app):
+        user_ids = list(range(100, 110))
+        deleted_users = set(user_ids[-2:])
+        for user_id in user_ids:
+            await self.repo.add_user(User.create(user_id, "stress", "test", f"stress_{user_id}"))
+        variants = [(f"st{i % 5}usdt", {"target_price": i % 4 + 1, "type_request": "price"}) for i in range(20)]
+        now = datetime.datetime.utcnow().isoformat()
+        rng = random.Random(7)
+        semaphore = asyncio.Semaphore(50)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            async def mutate(i: int):
+                user_id = rng.choice(user_ids)
+                symbol, data = rng.choice(variants)
+                async with semaphore:
+                    if i in (1000, 2000):
+                        user_id = user_ids[i // 1000 - 3]
+                        return "delete_user", user_id, await client.delete(f"/users/{user_id}")
+                    if rng.random() < 0.6 or not self.repo.user_requests.get(user_id):
+                        body = {"symbol": symbol, "request_data": data, "way": "up_to", "created": now, "updated": now}
+                        return "add", user_id, await client.post("/requests/", params={"user_id": user_id}, json=body)
+                    request_id = rng.choice(list(self.repo.user_requests[user_id])).request_id
+                    response = await client.delete(f"/requests/{user_id}", params={"request_id": request_id})
+                    return "delete", user_id, response
+
+            results = await asyncio.gather(*(mutate(i) for i in range(3000)))
+
+        foreign_key_errors = 0
+        for kind, user_id, response in results:
+            if kind == "delete_user" or response.status_code in (201, 204):
+                assert response.status_code in (201, 204)
+            elif kind == "add":
+                assert user_id in deleted_users and "ForeignKeyViolation" in response.json()["detail"]
+                foreign_key_errors += 1
+            else:
+                assert response.status_code == 404 or "not found" in response.json()["detail"]
+        assert foreign_key_errors
+        await self.check_invariants(user_ids)
+        for user_id in user_ids[:-2]:
+            await self.repo.delete_user(user_id)
+        await self.check_invariants(user_ids)
+
 
 class TestUserRepository:
     repo = Repository(sql_db=test_sql)
@@ -492,3 +989,485 @@ class TestUserRepository:
             user_from_db.ban,
             user_from_db.created
         )
+
+
+class TestPriceCrossingEngine:
+    engine = PriceCrossingEngine()
+
+    up = UniqueUserRequest(UserRequest.create("btcusdt", Price(target_price=70000), Way.up_to))
+    up_percent = UniqueUserRequest(
+        UserRequest.create("btcusdt", PercentOfPoint(target_percent=10, current_price=60000), Way.up_to)
+    )
+    down = UniqueUserRequest(
+        UserRequest.create("btcusdt", PercentOfPoint(target_percent=-10, current_price=60000), Way.down_to)
+    )
+    cross = UniqueUserRequest(UserRequest.create("btcusdt", Price(target_price=62000), Way.all))
+    other = UniqueUserRequest(UserRequest.create("ethusdt", Price(target_price=3000), Way.up_to))
+    time = UniqueUserRequest(
+        UserRequest.create("btcusdt", PercentOfTime(target_percent=5, period=Period.v_4h), Way.up_to)
+    )
+
+    def test_evaluate(self):
+        for request in (self.up, self.up_percent, self.down, self.cross, self.other, self.time):
+            self.engine.add(request)
+        assert self.engine.evaluate({"BTCUSDT": 60000}) == []
+        assert set(self.engine.evaluate({"btcusdt": 66000})) == {self.up_percent, self.cross}
+        assert set(self.engine.evaluate({"BTCUSDT": 71000, "ETHUSDT": 2000})) == {self.up, self.up_percent}
+        assert set(self.engine.evaluate({"BTCUSDT": 50000})) == {self.down, self.cross}
+
+    def test_remove(self):
+        self.engine.remove(self.up_percent)
+        self.engine.remove(self.time)
+        assert set(self.engine.evaluate({"BTCUSDT": 71000})) == {self.up, self.cross}
+        self.engine.clear()
+        assert self.engine.evaluate({"BTCUSDT": 71000, "ETHUSDT": 4000}) == []
+
+
+class TestPercentOfTimeEngine:
+    engine = PercentOfTimeEngine()
+
+    up = UniqueUserRequest(
+        UserRequest.create("btcusdt", PercentOfTime(target_percent=5, period=Period.v_24h), Way.up_to)
+    )
+    down = UniqueUserRequest(
+        UserRequest.create("ethusdt", PercentOfTime(target_percent=-3, period=Period.v_24h), Way.down_to)
+    )
+    both = UniqueUserRequest(
+        UserRequest.create("btcusdt", PercentOfTime(target_percent=2, period=Period.v_4h), Way.all)
+    )
+    price = UniqueUserRequest(UserRequest.create("btcusdt", Price(target_price=70000), Way.up_to))
+
+    def test_evaluate(self):
+        for request in (self.up, self.down, self.both, self.price):
+            self.engine.add(request)
+        assert self.engine.evaluate({"BTCUSDT": {Period.v_24h: 4.9, Period.v_4h: 1}}) == []
+        assert set(self.engine.evaluate({"btcusdt": {Period.v_24h: 5, Period.v_4h: -2.5}})) == {self.up, self.both}
+        assert self.engine.evaluate({"ETHUSDT": {Period.v_24h: -3.1, Period.v_4h: -5}}) == [self.down]
+
+    def test_remove(self):
+        self.engine.remove(self.up)
+        self.engine.remove(self.price)
+        assert self.engine.evaluate({"BTCUSDT": {Period.v_24h: 10, Period.v_4h: 10}}) == [self.both]
+        for i in range(100):
+            self.engine.add(UniqueUserRequest(
+                UserRequest.create(f"sym{i}", PercentOfTime(target_percent=i, period=Period.v_24h), Way.up_to)
+            ))
+        assert len(self.engine.evaluate({f"SYM{i}": {Period.v_24h: 50} for i in range(100)})) == 51
+
+    def test_reuse_symbol_index(self):
+        engine = PercentOfTimeEngine()
+        engine.add(self.up)
+        engine.add(self.both)
+        engine.add(self.down)
+        assert engine.symbol_index == {"BTCUSDT": 0, "ETHUSDT": 1}
+        engine.remove(self.up)
+        assert engine.symbol_index == {"BTCUSDT": 0, "ETHUSDT": 1}
+        engine.remove(self.both)
+        assert engine.symbol_index == {"ETHUSDT": 1} and engine.free_indexes == [0]
+
+        sol = UniqueUserRequest(
+            UserRequest.create("solusdt", PercentOfTime(target_percent=1, period=Period.v_24h), Way.up_to)
+        )
+        engine.add(sol)
+        assert engine.symbol_index == {"SOLUSDT": 0, "ETHUSDT": 1} and engine.size == 2
+        assert engine.evaluate({"SOLUSDT": {Period.v_24h: 1}, "BTCUSDT": {Period.v_24h: 10}}) == [sol]
+        engine.remove(sol)
+        engine.remove(self.down)
+        assert engine.symbol_index == {} and engine.size == 0
+
+
+class TestWeightPlanner:
+    planner = WeightPlanner(budget=120, slot_seconds=5)
+
+    btc = RequestForServer(UserRequest.create("btcusdt", Price(target_price=70000), Way.up_to))
+    eth = RequestForServer(UserRequest.create("ethusdt", Price(target_price=3000), Way.up_to))
+    sol = RequestForServer(
+        UserRequest.create("solusdt", PercentOfTime(target_percent=5, period=Period.v_4h), Way.up_to)
+    )
+    big = RequestForServer(UserRequest.create("bnbusdt", Price(target_price=600), Way.up_to))
+
+    def test_add(self):
+        self.planner.add(self.btc, 6)
+        self.planner.add(self.eth, 6)
+        self.planner.add(self.sol, 2)
+        self.planner.add(self.big, 20)
+        assert self.planner.slot_budget == 10
+        assert [list(slot) for slot in self.planner.slots] == [[self.btc, self.sol], [self.eth], [self.big]]
+        assert self.planner.to_dict()["cycle_seconds"] == 15
+
+    def test_remove_and_rebalance(self):
+        self.planner.remove(self.big)
+        self.planner.remove(self.btc)
+        assert self.planner.slot_weights == [2, 6]
+        self.planner.rebalance({self.eth: 3, self.sol: 1})
+        assert [list(slot) for slot in self.planner.slots] == [[self.eth, self.sol]]
+        assert all(weight <= self.planner.slot_budget for weight in self.planner.slot_weights)
+
+    def test_compact_and_polls(self):
+        planner = WeightPlanner(budget=120, slot_seconds=5)
+        planner.add(self.btc, 6)
+        planner.add(self.eth, 6)
+        planner.add(self.big, 8)
+        planner.remove(self.eth)
+        assert [list(slot) for slot in planner.slots] == [[self.btc], [self.big]]
+        assert planner.slot_of == {self.btc: [0], self.big: [1]}
+
+        planner.add(self.sol, 2)
+        planner.rebalance({self.btc: 10, self.big: 1, self.sol: 1})
+        assert [list(slot) for slot in planner.slots] == [[self.btc, self.sol], [self.big], [self.btc]]
+        assert (len(planner), planner.weight, sum(planner.slot_weights)) == (3, 16, 22)
+        planner.remove(self.btc)
+        assert [list(slot) for slot in planner.slots] == [[self.sol], [self.big]]
+        assert planner.to_dict()["cycle_seconds"] == 10
+
+    def test_fetch_plan(self):
+        plan = build_fetch_plan([self.btc, self.eth, self.sol, self.big], naive_weight=20)
+        assert [(call.endpoint, call.symbols, call.window, call.weight) for call in plan.calls] == [
+            ("/api/v3/ticker/price", ["BNBUSDT", "BTCUSDT", "ETHUSDT"], None, 4),
+            ("/api/v3/ticker", ["SOLUSDT"], "4h", 4),
+        ]
+        assert (plan.total_weight, plan.naive_weight) == (8, 20)
+        plan = build_fetch_plan([
+            RequestForServer(
+                UserRequest.create(f"sym{i}", PercentOfTime(target_percent=1, period=period), Way.up_to)
+            )
+            for i in range(1000)
+            for period in (Period.v_24h, Period.v_8h)
+        ])
+        assert [(call.endpoint, call.window, call.weight) for call in plan.calls[:2]] == [
+            ("/api/v3/ticker", "8h", 200), ("/api/v3/ticker", "8h", 200)
+        ]
+        assert plan.calls[-1].endpoint == "/api/v3/ticker/24hr" and plan.calls[-1].symbols is None
+        assert plan.total_weight == 10 * 200 + 80
+
+
+class TestSortedIds:
+    def test_page(self):
+        index = SortedIds()
+        for item_id in (5, 1, 3):
+            index.add(item_id)
+        index.remove(3)
+        assert index.page(None, 10) == [1, 5] and index.page(1, 1) == [5] and index.page(5, 10) == []
+        index.add(3)
+        index.remove(5)
+        assert index.page(None, 10) == [1, 3]
+
+    def test_bulk(self):
+        index = SortedIds()
+        ids = list(range(0, 2000, 2))
+        for item_id in reversed(ids):
+            index.add(item_id)
+        assert index.page(None, 2000) == ids
+        for item_id in ids[::3]:
+            index.remove(item_id)
+        index.add(7)
+        expected = sorted(set(ids) - set(ids[::3]) | {7})
+        assert index.page(None, 2000) == expected and len(index) == len(expected)
+
+
+class TestGroupCommitQueue:
+    @staticmethod
+    def committer(committed: list, delay: float = 0):
+        async def commit(ops):
+            await asyncio.sleep(delay)
+            if "bad" in ops:
+                raise IntegrityError("insert", {}, Exception("foreign key violation"))
+            committed.extend(ops)
+        return commit
+
+    @pytest.mark.asyncio
+    async def test_close_during_flush(self):
+        committed = []
+        queue = GroupCommitQueue(self.committer(committed, 0.05), interval_ms=1, durability="memory")
+        queue.start()
+        await queue.put("a")
+        await asyncio.sleep(0.02)
+        await queue.put("b")
+        await queue.close()
+        assert committed == ["a", "b"] and not len(queue)
+
+    @pytest.mark.asyncio
+    async def test_reject_bad_ops(self):
+        committed, rejected = [], []
+
+        async def reject(op, error):
+            rejected.append(op)
+
+        queue = GroupCommitQueue(self.committer(committed), durability="memory", rejected=reject)
+        for op in ("a", "bad", "b"):
+            await queue.put(op)
+        await queue.flush()
+        assert committed == ["a", "b"] and rejected == ["bad"] and not len(queue)
+
+        committed.clear()
+        queue = GroupCommitQueue(self.committer(committed), interval_ms=1, durability="commit")
+        queue.start()
+        results = await asyncio.gather(*(queue.put(op) for op in ("a", "bad", "b")), return_exceptions=True)
+        await queue.close()
+        assert committed == ["a", "b"]
+        assert results[0] is None and isinstance(results[1], IntegrityError) and results[2] is None
+
+
+class TestSharding:
+    symbols = [f"SYM{i}USDT" for i in range(10000)]
+
+    def test_balance(self):
+        counts = [0] * 4
+        for symbol in self.symbols:
+            counts[shard_of(symbol, 4)] += 1
+        assert all(2200 < count < 2800 for count in counts)
+
+    def test_minimal_movement(self):
+        moved = [symbol for symbol in self.symbols if shard_of(symbol, 4) != shard_of(symbol, 5)]
+        assert all(shard_of(symbol, 5) == 4 for symbol in moved)
+        assert 1700 < len(moved) < 2300
+
+
+class TestReadReplica:
+    sql_db = AlchemySqlDb(
+        config.SQLALCHEMY_DATABASE_URL_TEST,
+        Base,
+        test=True,
+        read_url=config.SQLALCHEMY_DATABASE_URL_TEST,
+        read_your_writes=60,
+    )
+
+    @pytest.mark.asyncio
+    async def test_routing(self):
+        async with self.sql_db.read_session() as session:
+            assert session.bind is self.sql_db.read_engine
+            await session.execute(select(UserOrm.user_id))
+        async with self.sql_db.SessionLocal() as session:
+            await session.execute(select(UserOrm.user_id))
+            await session.commit()
+        async with self.sql_db.read_session() as session:
+            assert session.bind is self.sql_db.engine
+        self.sql_db.read_your_writes = 0
+        async with self.sql_db.read_session() as session:
+            assert session.bind is self.sql_db.read_engine
+        async with test_sql.read_session() as session:
+            assert session.bind is test_sql.engine
+
+    def test_load_from_primary_with_change_feed(self, monkeypatch):
+        self.sql_db.read_your_writes = 0
+        repo = RepositoryDB(self.sql_db)
+        monkeypatch.setattr(config, "CHANGE_FEED_ENABLED", False)
+        assert repo.load_session().bind is self.sql_db.read_engine
+        monkeypatch.setattr(config, "CHANGE_FEED_ENABLED", True)
+        assert repo.load_session().bind is self.sql_db.engine
+
+
+class TestChangeFeed:
+    repo = Repository(sql_db=test_sql)
+
+    def state(self):
+        return (
+            sorted(user_to_row(user) for user in self.repo.users.values()),
+            sorted(
+                request_to_row(user_id, request)
+                for user_id, requests in self.repo.user_requests.items()
+                for request in requests
+            ),
+            {u_req.request_id: users for u_req, users in self.repo.unique_user_requests.items()},
+            self.repo.unique_requests_for_server,
+            self.repo.requests_weight,
+        )
+
+    @pytest.mark.asyncio
+    async def test_replicas_converge(self, monkeypatch):
+        monkeypatch.setattr(config, "CHANGE_FEED_ENABLED", True)
+        await self.repo.sql_db.clean()
+        self.repo.clear()
+        await self.repo.add_user(User.create(1, "sergey", "ivanov", "sergey_ivanov"))
+        await self.repo.add_request(1, UserRequest.create("btcusdt", Price(target_price=69000), Way.up_to))
+        initial_users = [user_to_row(user) for user in self.repo.users.values()]
+        initial_requests = [
+            request_to_row(user_id, request)
+            for user_id, requests in self.repo.user_requests.items()
+            for request in requests
+        ]
+
+        received = []
+
+        async def apply(events):
+            received.extend(events)
+
+        listener = ChangeFeedListener(test_sql, apply, origin=None)
+        listener.ready.set()
+        task = asyncio.create_task(listener.run())
+        await asyncio.wait_for(listener.listening.wait(), timeout=5)
+
+        await self.repo.add_user(User.create(2, "ivan", "petrov", "ivan_petrov"))
+        await self.repo.add_user(User.create(3, "fedor", "sidorov", "fedor_sidorov"))
+        shared = UserRequest.create("ethusdt", PercentOfPoint(target_percent=5, current_price=3000), Way.up_to)
+        await self.repo.add_request(2, shared)
+        await self.repo.add_requests([
+            (3, UserRequest.create("ethusdt", PercentOfPoint(target_percent=5, current_price=3000), Way.up_to)),
+            (3, UserRequest.create("btcusdt", PercentOfTime(target_percent=3, period=Period.v_4h), Way.down_to)),
+            (2, UserRequest.create("bnbusdt", Price(target_price=600), Way.all)),
+        ])
+        await self.repo.delete_request(2, shared.request_id)
+        await self.repo.delete_requests(symbol="bnbusdt")
+        user = User.create(3, "fedor", "sidorov", "f_s")
+        await self.repo.update_user(user)
+        await self.repo.delete_user(1)
+        expected = self.state()
+
+        for _ in range(50):
+            if received and received[-1]["op"] == "delete_user":
+                break
+            await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        self.repo.clear()
+        for row in initial_users:
+            user = user_from_row(row)
+            self.repo.users[user.user_id] = user
+        for row in initial_requests:
+            self.repo._index_request(*request_from_row(row))
+        await self.repo.apply_changes(received)
+        await self.repo.apply_changes(received)
+        assert self.state() == expected
+
+    @pytest.mark.asyncio
+    async def test_publish_in_one_statement(self, monkeypatch):
+        monkeypatch.setattr(config, "CHANGE_FEED_ENABLED", True)
+        events = [delete_request_event(1, request_id) for request_id in range(2000)]
+        assert len(encode(events)) > 1
+        received = []
+
+        async def apply(batch):
+            received.extend(batch)
+
+        listener = ChangeFeedListener(test_sql, apply, origin=None)
+        listener.ready.set()
+        task = asyncio.create_task(listener.run())
+        await asyncio.wait_for(listener.listening.wait(), timeout=5)
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(test_sql.engine.sync_engine, "before_cursor_execute", count)
+        try:
+            async with test_sql.SessionLocal() as session:
+                await publish(session, events)
+                await session.commit()
+        finally:
+            event.remove(test_sql.engine.sync_engine, "before_cursor_execute", count)
+        assert len(statements) == 1
+
+        for _ in range(50):
+            if len(received) == len(events):
+                break
+            await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert received == events
+
+    @pytest.mark.asyncio
+    async def test_writers_agree_on_canonical_id(self):
+        await self.repo.sql_db.clean()
+        self.repo.clear()
+        await self.repo.add_user(User.create(1, "sergey", "ivanov", "sergey_ivanov"))
+        await self.repo.add_user(User.create(2, "ivan", "petrov", "ivan_petrov"))
+        other = ReplicaRepository(sql_db=test_sql)
+        other.clear()
+
+        first = UserRequest.create("solusdt", Price(target_price=150), Way.up_to)
+        second = UserRequest.create("solusdt", Price(target_price=150), Way.up_to)
+        second.request_id = first.request_id + 1
+        await asyncio.gather(self.repo.add_request(1, first), other.add_request(2, second))
+        assert first.request_id == second.request_id
+        rows = await self.repo.get_all_requests_from_db()
+        assert {(row.user_id, row.request_id) for row in rows} == {(1, first.request_id), (2, first.request_id)}
+
+        taken = UserRequest.create("solusdt", Price(target_price=160), Way.up_to)
+        taken.request_id = first.request_id
+        await other.add_request(2, taken)
+        assert taken.request_id == first.request_id + 1
+
+        await self.repo.apply_changes([add_request_event(2, other.user_request_keys[(2, first.request_id)])])
+        assert await self.repo.get_all_users_for_request(first.request_id) == {1, 2}
+        assert set(self.repo.user_request_keys) == {(1, first.request_id), (2, first.request_id)}
+
+    @pytest.mark.asyncio
+    async def test_register_unique_requests(self):
+        await self.repo.sql_db.clean()
+        self.repo.clear()
+        await self.repo.add_user(User.create(1, "sergey", "ivanov", "sergey_ivanov"))
+        legacy = RequestRecord.from_model(UserRequest.create("adausdt", Price(target_price=1), Way.up_to))
+        self.repo._index_request(1, legacy)
+        assert await self.repo.register_unique_requests() == 1
+        assert await self.repo.register_unique_requests() == 0
+
+        self.repo.clear()
+        await self.repo.load_users_from_db()
+        request = UserRequest.create("adausdt", Price(target_price=1), Way.up_to)
+        await self.repo.add_request(1, request)
+        assert request.request_id == legacy.request_id
+
+
+class TestRedisBackend:
+    repo = Repository(sql_db=test_sql)
+
+    def rows(self):
+        users, requests = self.repo._rows()
+        return sorted(users), sorted(requests)
+
+    @pytest.mark.asyncio
+    async def test_write_through(self):
+        backend = RedisBackend(fakeredis.FakeRedis())
+        self.repo.backend = backend
+        try:
+            await self.repo.sql_db.clean()
+            self.repo.clear()
+            assert await backend.load() is None
+
+            await self.repo.add_user(User.create(1, "sergey", "ivanov", "sergey_ivanov"))
+            await self.repo.add_user(User.create(2, "ivan", "petrov", "ivan_petrov"))
+            await self.repo.save_to_backend()
+            await self.repo.add_request(1, UserRequest.create("btcusdt", Price(target_price=69000), Way.up_to))
+            await self.repo.add_requests([
+                (1, UserRequest.create("ethusdt", PercentOfTime(target_percent=3, period=Period.v_8h), Way.up_to)),
+                (2, UserRequest.create("ethusdt", PercentOfTime(target_percent=3, period=Period.v_8h), Way.up_to)),
+                (2, UserRequest.create("bnbusdt", Price(target_price=600), Way.down_to)),
+            ])
+            await self.repo.delete_requests(symbol="bnbusdt")
+            await self.repo.update_user(User.create(1, "sergey", "ivanov", "s_i"))
+            await self.repo.delete_user(2)
+
+            users, requests = await backend.load()
+            assert (sorted(users), sorted(requests)) == self.rows()
+
+            expected = self.rows()
+            self.repo.clear()
+            assert await self.repo.load_from_backend()
+            assert self.rows() == expected
+            assert self.repo.users[1].username == "s_i"
+            assert len(self.repo.unique_user_requests) == 2
+        finally:
+            self.repo.backend = LocalBackend()
+
+    @pytest.mark.asyncio
+    async def test_replace_conflict(self):
+        server = FakeServer()
+        backend = RedisBackend(fakeredis.FakeRedis(server=server))
+        peer = SyncFakeRedis(server=server)
+        await backend.replace([(1, "a", "b", "c", False, None, None)], [])
+        assert await backend.load() is not None
+
+        save_users = backend._save_users
+
+        def save_users_after_peer(pipe, users):
+            peer.hset(backend.users_key, 2, "peer")
+            save_users(pipe, users)
+
+        backend._save_users = save_users_after_peer
+        await backend.replace([(1, "a", "b", "c", False, None, None)], [])
+        assert await backend.load() is None
+        assert peer.hget(backend.users_key, 2) == b"peer"
@@ -0,0 +1,187 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from redis import asyncio as aioredis
+
+import config
+
+
+class StateBackend(ABC):
+    """
+    Интерфейс хранилища общего прогретого индекса репозитория.
+    Пользователи и запросы передаются строками (кортежами) в формате utils.snapshot.
+    """
+
+    shared: bool = False
+
+    @abstractmethod
+    async def load(self) -> tuple[list[tuple], list[tuple]] | None:
+        """
+        Возвращает строки пользователей и запросов или None, если прогретого индекса нет.
+        """
+
+    @abstractmethod
+    async def replace(self, users: list[tuple], requests: list[tuple]) -> None:
+        ...
+
+    @abstractmethod
+    async def save_users(self, users: list[tuple]) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_user(self, user_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def save_requests(self, requests: list[tuple]) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_requests(self, keys: list[tuple[int, int]]) -> None:
+        ...
+
+
+class LocalBackend(StateBackend):
+    """
+    Состояние живет только в словарях репозитория текущего процесса.
+    Общего индекса нет, каждый процесс загружает его из БД сам.
+    """
+
+    async def load(self) -> None:
+        return None
+
+    async def replace(self, users: list[tuple], requests: list[tuple]) -> None:
+        pass
+
+    async def save_users(self, users: list[tuple]) -> None:
+        pass
+
+    async def delete_user(self, user_id: int) -> None:
+        pass
+
+    async def save_requests(self, requests: list[tuple]) -> None:
+        pass
+
+    async def delete_requests(self, keys: list[tuple[int, int]]) -> None:
+        pass
+
+
+class RedisBackend(StateBackend):
+    """
+    Общий прогретый индекс в Redis.
+    {prefix}:users - hash user_id -> строка пользователя,
+    {prefix}:requests - hash "user_id:request_id" -> строка запроса,
+    {prefix}:user_requests:{user_id} - set id запросов пользователя,
+    {prefix}:ready - признак того, что индекс загружен полностью.
+    Изменения пишутся пачками в pipeline (MULTI/EXEC). При ошибке записи (и при конфликте полной замены
+    с записью другого процесса) признак ready снимается, и следующий процесс загрузит индекс из БД.
+    """
+
+    shared = True
+
+    def __init__(self, client: aioredis.Redis, prefix: str = config.REDIS_PREFIX):
+        self.client = client
+        self.users_key = f"{prefix}:users"
+        self.requests_key = f"{prefix}:requests"
+        self.user_requests_key = f"{prefix}:user_requests"
+        self.ready_key = f"{prefix}:ready"
+
+    @staticmethod
+    def from_config() -> "RedisBackend":
+        return RedisBackend(aioredis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=config.REDIS_DB))
+
+    async def _invalidate(self, e: BaseException) -> None:
+        logging.error(f'redis backend error: {e!r}')
+        try:
+            await self.client.delete(self.ready_key)
+        except Exception as e:
+            logging.error(f'redis backend invalidate error: {e}')
+
+    @asynccontextmanager
+    async def _writing(self) -> AsyncIterator[None]:
+        """
+        Снимает признак ready при любой ошибке записи, в том числе при отмене задачи:
+        запись идет после фиксации в БД, и недописанный индекс не должен считаться прогретым.
+        """
+
+        try:
+            yield
+        except Exception as e:
+            await self._invalidate(e)
+        except BaseException as e:
+            await self._invalidate(e)
+            raise
+
+    async def load(self) -> tuple[list[tuple], list[tuple]] | None:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.get(self.ready_key)
+            pipe.hvals(self.users_key)
+            pipe.hvals(self.requests_key)
+            ready, users, requests = await pipe.execute()
+        if not ready:
+            return None
+        return [tuple(json.loads(row)) for row in users], [tuple(json.loads(row)) for row in requests]
+
+    async def replace(self, users: list[tuple], requests: list[tuple]) -> None:
+        """
+        Заменяет индекс целиком. Ключи читаются и переписываются под WATCH: если другой процесс
+        записал изменение до EXEC, транзакция не выполняется и признак ready снимается,
+        чтобы не затереть его изменение устаревшими строками (индекс будет загружен из БД).
+        """
+
+        async with self._writing():
+            async with self.client.pipeline(transaction=True) as pipe:
+                await pipe.watch(self.ready_key, self.users_key, self.requests_key)
+                old_sets = [key async for key in pipe.scan_iter(match=f"{self.user_requests_key}:*")]
+                pipe.multi()
+                pipe.delete(self.ready_key, self.users_key, self.requests_key, *old_sets)
+                self._save_users(pipe, users)
+                self._save_requests(pipe, requests)
+                pipe.set(self.ready_key, 1)
+                await pipe.execute()
+
+    def _save_users(self, pipe, users: list[tuple]) -> None:
+        for i in range(0, len(users), config.BULK_CHUNK_SIZE):
+            pipe.hset(self.users_key, mapping={row[0]: json.dumps(row) for row in users[i:i + config.BULK_CHUNK_SIZE]})
+
+    def _save_requests(self, pipe, requests: list[tuple]) -> None:
+        for i in range(0, len(requests), config.BULK_CHUNK_SIZE):
+            chunk = requests[i:i + config.BULK_CHUNK_SIZE]
+            pipe.hset(self.requests_key, mapping={f"{row[1]}:{row[0]}": json.dumps(row) for row in chunk})
+            for row in chunk:
+                pipe.sadd(f"{self.user_requests_key}:{row[1]}", row[0])
+
+    async def save_users(self, users: list[tuple]) -> None:
+        async with self._writing():
+            async with self.client.pipeline(transaction=True) as pipe:
+                self._save_users(pipe, users)
+                await pipe.execute()
+
+    async def delete_user(self, user_id: int) -> None:
+        async with self._writing():
+            request_ids = await self.client.smembers(f"{self.user_requests_key}:{user_id}")
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hdel(self.users_key, user_id)
+                if request_ids:
+                    pipe.hdel(self.requests_key, *[f"{user_id}:{int(request_id)}" for request_id in request_ids])
+                pipe.delete(f"{self.user_requests_key}:{user_id}")
+                await pipe.execute()
+
+    async def save_requests(self, requests: list[tuple]) -> None:
+        async with self._writing():
+            async with self.client.pipeline(transaction=True) as pipe:
+                self._save_requests(pipe, requests)
+                await pipe.execute()
+
+    async def delete_requests(self, keys: list[tuple[int, int]]) -> None:
+        async with self._writing():
+            async with self.client.pipeline(transaction=True) as pipe:
+                for i in range(0, len(keys), config.BULK_CHUNK_SIZE):
+                    chunk = keys[i:i + config.BULK_CHUNK_SIZE]
+                    pipe.hdel(self.requests_key, *[f"{user_id}:{request_id}" for user_id, request_id in chunk])
+                    for user_id, request_id in chunk:
+                        pipe.srem(f"{self.user_requests_key}:{user_id}", request_id)
+                await pipe.execute()
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Awaitable, Callable
+
+from sqlalchemy import ARRAY, Text, bindparam, select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from sql.database import AlchemySqlDb
+from utils.records import RequestRecord
+from utils.schemas import User
+from utils.snapshot import user_to_row, request_to_row
+
+INSTANCE_ID = uuid.uuid4().hex
+MAX_PAYLOAD = 7000
+
+
+def add_user_event(user: User) -> dict:
+    return {"op": "add_user", "user": user_to_row(user)}
+
+
+def update_user_event(user: User) -> dict:
+    return {"op": "update_user", "user": user_to_row(user)}
+
+
+def delete_user_event(user_id: int) -> dict:
+    return {"op": "delete_user", "user_id": user_id}
+
+
+def add_request_event(user_id: int, request: RequestRecord) -> dict:
+    return {"op": "add_request", "request": request_to_row(user_id, request)}
+
+
+def delete_request_event(user_id: int, request_id: int) -> dict:
+    return {"op": "delete_request", "user_id": user_id, "request_id": request_id}
+
+
+def encode(events: list[dict]) -> list[str]:
+    """
+    Упаковывает события в payload'ы NOTIFY, каждый не длиннее MAX_PAYLOAD байт
+    (ограничение Postgres - 8000 байт).
+
+    :param events: События изменения репозитория
+    :return: Список JSON-строк вида {"origin": ..., "events": [...]}
+    """
+
+    payloads, chunk, size = [], [], 0
+    for event in events:
+        encoded = json.dumps(event, separators=(",", ":"))
+        if chunk and size + len(encoded) > MAX_PAYLOAD:
+            payloads.append(chunk)
+            chunk, size = [], 0
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        payloads.append(chunk)
+    return [f'{{"origin":"{INSTANCE_ID}","events":[{",".join(chunk)}]}}' for chunk in payloads]
+
+
+async def publish(session: AsyncSession, events: list[dict]) -> None:
+    """
+    Отправляет события в канал изменений в рамках транзакции сессии одним запросом на все payload'ы.
+    Postgres доставляет NOTIFY подписчикам только после commit, поэтому откаченные изменения не публикуются.
+
+    :param session: Сессия, в которой выполняется изменение
+    :param events: События изменения репозитория
+    """
+
+    if not config.CHANGE_FEED_ENABLED or not events:
+        return
+    payload = func.unnest(bindparam("payloads", encode(events), type_=ARRAY(Text))).column_valued("payload")
+    await session.execute(select(func.pg_notify(config.CHANGE_FEED_CHANNEL, payload)))
+
+
+class ChangeFeedListener:
+    """
+    Подписчик на канал изменений репозитория (LISTEN).
+    События применяются строго по порядку через очередь, собственные события экземпляра пропускаются.
+    До установки ready события только накапливаются: так подписку можно открыть до начальной загрузки
+    и не потерять изменения, сделанные во время нее.
+    При потере соединения вызывается resync, так как пропущенные за это время события не восстановить.
+    """
+
+    def __init__(
+            self,
+            sql_db: AlchemySqlDb,
+            apply: Callable[[list[dict]], Awaitable[None]],
+            resync: Callable[[], Awaitable[None]] | None = None,
+            origin: str | None = INSTANCE_ID,
+            channel: str = config.CHANGE_FEED_CHANNEL,
+            reconnect_delay: float = 1,
+    ):
+        self.sql_db = sql_db
+        self.apply = apply
+        self.resync = resync
+        self.origin = origin
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.queue: asyncio.Queue[list[dict]] = asyncio.Queue()
+        self.listening = asyncio.Event()
+        self.ready = asyncio.Event()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        message = json.loads(payload)
+        if self.origin is None or message["origin"] != self.origin:
+            self.queue.put_nowait(message["events"])
+
+    async def _consume(self) -> None:
+        await self.ready.wait()
+        while True:
+            events = await self.queue.get()
+            try:
+                await self.apply(events)
+            except Exception as e:
+                logging.error(f'change feed apply error: {e}')
+
+    async def run(self) -> None:
+        consumer = asyncio.create_task(self._consume())
+        connected_before = False
+        try:
+            while True:
+                try:
+                    connection = await self.sql_db.raw_connection()
+                except Exception as e:
+                    logging.error(f'change feed connect error: {e}')
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+                try:
+                    await connection.add_listener(self.channel, self._on_notify)
+                    if connected_before and self.resync:
+                        await self.resync()
+                    connected_before = True
+                    self.listening.set()
+                    await lost.wait()
+                    logging.warning('change feed connection lost')
+                except Exception as e:
+                    logging.error(f'change feed error: {e}')
+                finally:
+                    self.listening.clear()
+                    if not connection.is_closed():
+                        await connection.close()
+                await asyncio.sleep(self.reconnect_delay)
+        finally:
+            consumer.cancel()
@@ -0,0 +1,287 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from utils.records import RequestRecord
+from utils.schemas import Period, Way
+
+
+class PriceThresholds:
+    """
+    Отсортированный массив порогов цены для одного символа и одного направления.
+    Пороги и соответствующие им уникальные запросы хранятся в параллельных списках.
+    """
+
+    __slots__ = ("prices", "requests")
+
+    def __init__(self):
+        self.prices: list[float] = []
+        self.requests: list[RequestRecord] = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def add(self, price: float, request: RequestRecord) -> None:
+        i = bisect_right(self.prices, price)
+        self.prices.insert(i, price)
+        self.requests.insert(i, request)
+
+    def remove(self, price: float, request: RequestRecord) -> bool:
+        i = bisect_left(self.prices, price)
+        j = bisect_right(self.prices, price)
+        for k in range(i, j):
+            if self.requests[k] == request:
+                del self.prices[k]
+                del self.requests[k]
+                return True
+        return False
+
+    def up_to(self, price: float) -> list[RequestRecord]:
+        """Запросы, цена которых достигнута при движении вверх (порог <= цена)."""
+        return self.requests[:bisect_right(self.prices, price)]
+
+    def down_to(self, price: float) -> list[RequestRecord]:
+        """Запросы, цена которых достигнута при движении вниз (порог >= цена)."""
+        return self.requests[bisect_left(self.prices, price):]
+
+    def between(self, low: float, high: float) -> list[RequestRecord]:
+        """Запросы, порог которых лежит в отрезке [low, high]."""
+        return self.requests[bisect_left(self.prices, low):bisect_right(self.prices, high)]
+
+
+class PriceCrossingEngine:
+    """
+    Движок проверки запросов Price и PercentOfPoint на пересечение цены.
+    Для каждого символа и направления хранит отсортированные пороги,
+    поэтому проверка тика стоит O(log n + количество сработавших запросов).
+    """
+
+    def __init__(self):
+        self.thresholds: dict[tuple[str, Way], PriceThresholds] = {}
+        self.last_prices: dict[str, float] = {}
+
+    @staticmethod
+    def target_price(request: RequestRecord) -> float | None:
+        """
+        Возвращает абсолютную цену срабатывания запроса.
+        PercentOfPoint переводится в цену от current_price на target_percent.
+
+        :param request: Уникальный запрос
+        :return: Цена или None, если запрос не проверяется по цене
+        """
+
+        if request.request_data.type_request == "price":
+            return request.request_data.target_price
+        if request.request_data.type_request == "percent_of_point":
+            return request.request_data.current_price * (1 + request.request_data.target_percent / 100)
+        return None
+
+    def add(self, request: RequestRecord) -> None:
+        price = self.target_price(request)
+        if price is None:
+            return
+        key = (request.symbol, request.way)
+        if key not in self.thresholds:
+            self.thresholds[key] = PriceThresholds()
+        self.thresholds[key].add(price, request)
+
+    def remove(self, request: RequestRecord) -> None:
+        price = self.target_price(request)
+        if price is None:
+            return
+        key = (request.symbol, request.way)
+        thresholds = self.thresholds.get(key)
+        if thresholds is not None and thresholds.remove(price, request) and not thresholds:
+            self.thresholds.pop(key, None)
+
+    def clear(self) -> None:
+        self.thresholds.clear()
+        self.last_prices.clear()
+
+    def evaluate(self, ticks: dict[str, float]) -> list[RequestRecord]:
+        """
+        Возвращает уникальные запросы, сработавшие на пачке тиков.
+        up_to срабатывает при цене не ниже порога, down_to - при цене не выше порога,
+        all - если порог лежит между предыдущей и текущей ценой символа.
+
+        :param ticks: Словарь {символ: цена}
+        :return: Сработавшие уникальные запросы
+        """
+
+        triggered = []
+        for symbol, price in ticks.items():
+            symbol = symbol.upper()
+            thresholds = self.thresholds.get((symbol, Way.up_to))
+            if thresholds is not None:
+                triggered.extend(thresholds.up_to(price))
+            thresholds = self.thresholds.get((symbol, Way.down_to))
+            if thresholds is not None:
+                triggered.extend(thresholds.down_to(price))
+            last_price = self.last_prices.get(symbol)
+            thresholds = self.thresholds.get((symbol, Way.all))
+            if thresholds is not None and last_price is not None:
+                triggered.extend(thresholds.between(min(last_price, price), max(last_price, price)))
+            self.last_prices[symbol] = price
+        return triggered
+
+
+WAY_CODES = {Way.up_to: 0, Way.down_to: 1, Way.all: 2}
+
+
+class PercentOfTimeColumns:
+    """
+    Колоночное хранилище запросов PercentOfTime одного периода.
+    Индекс символа, target_percent и направление хранятся в массивах NumPy,
+    удаление выполняется перестановкой последней строки на место удаляемой.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.size = 0
+        self.symbols = np.empty(capacity, dtype=np.int64)
+        self.targets = np.empty(capacity, dtype=np.float64)
+        self.ways = np.empty(capacity, dtype=np.int8)
+        self.requests: list[RequestRecord] = []
+        self.rows: dict[RequestRecord, int] = {}
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self) -> None:
+        capacity = len(self.symbols) * 2
+        self.symbols = np.resize(self.symbols, capacity)
+        self.targets = np.resize(self.targets, capacity)
+        self.ways = np.resize(self.ways, capacity)
+
+    def add(self, symbol: int, request: RequestRecord) -> bool:
+        if request in self.rows:
+            return False
+        if self.size == len(self.symbols):
+            self._grow()
+        row = self.size
+        self.symbols[row] = symbol
+        self.targets[row] = request.request_data.target_percent
+        self.ways[row] = WAY_CODES[request.way]
+        self.requests.append(request)
+        self.rows[request] = row
+        self.size += 1
+        return True
+
+    def remove(self, request: RequestRecord) -> bool:
+        row = self.rows.pop(request, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            self.symbols[row] = self.symbols[last]
+            self.targets[row] = self.targets[last]
+            self.ways[row] = self.ways[last]
+            moved = self.requests[last]
+            self.requests[row] = moved
+            self.rows[moved] = row
+        self.requests.pop()
+        self.size = last
+        return True
+
+    def evaluate(self, changes: np.ndarray) -> list[RequestRecord]:
+        """
+        Векторно сравнивает изменения цены с target_percent всех запросов периода.
+
+        :param changes: Изменения цены в процентах по индексу символа (NaN - нет данных)
+        :return: Сработавшие уникальные запросы
+        """
+
+        n = self.size
+        values = changes[self.symbols[:n]]
+        targets = self.targets[:n]
+        ways = self.ways[:n]
+        mask = (
+            ((ways == WAY_CODES[Way.up_to]) & (values >= targets))
+            | ((ways == WAY_CODES[Way.down_to]) & (values <= targets))
+            | ((ways == WAY_CODES[Way.all]) & (np.abs(values) >= np.abs(targets)))
+        )
+        return [self.requests[i] for i in np.flatnonzero(mask)]
+
+
+class PercentOfTimeEngine:
+    """
+    Движок проверки запросов PercentOfTime по всем символам.
+    Запросы сгруппированы по периоду в колоночные хранилища,
+    проверка пачки изменений цены выполняется векторными сравнениями NumPy.
+    Индекс символа освобождается вместе с его последним запросом и достается следующему новому символу,
+    поэтому длина массива изменений ограничена числом символов с активными запросами.
+    """
+
+    def __init__(self):
+        self.symbol_index: dict[str, int] = {}
+        self.symbol_requests: dict[str, int] = {}
+        self.free_indexes: list[int] = []
+        self.size = 0
+        self.columns: dict[Period, PercentOfTimeColumns] = {}
+
+    def _acquire(self, symbol: str) -> int:
+        i = self.symbol_index.get(symbol)
+        if i is None:
+            if self.free_indexes:
+                i = self.free_indexes.pop()
+            else:
+                i = self.size
+                self.size += 1
+            self.symbol_index[symbol] = i
+        return i
+
+    def _release(self, symbol: str) -> None:
+        count = self.symbol_requests[symbol] - 1
+        if count:
+            self.symbol_requests[symbol] = count
+            return
+        del self.symbol_requests[symbol]
+        self.free_indexes.append(self.symbol_index.pop(symbol))
+        if not self.symbol_index:
+            self.free_indexes.clear()
+            self.size = 0
+
+    def add(self, request: RequestRecord) -> None:
+        if request.request_data.type_request != "percent_of_time":
+            return
+        symbol = self._acquire(request.symbol)
+        period = request.request_data.period
+        if period not in self.columns:
+            self.columns[period] = PercentOfTimeColumns()
+        if self.columns[period].add(symbol, request):
+            self.symbol_requests[request.symbol] = self.symbol_requests.get(request.symbol, 0) + 1
+
+    def remove(self, request: RequestRecord) -> None:
+        if request.request_data.type_request != "percent_of_time":
+            return
+        columns = self.columns.get(request.request_data.period)
+        if columns is not None and columns.remove(request):
+            self._release(request.symbol)
+
+    def clear(self) -> None:
+        self.symbol_index.clear()
+        self.symbol_requests.clear()
+        self.free_indexes.clear()
+        self.size = 0
+        self.columns.clear()
+
+    def evaluate(self, changes: dict[str, dict[Period, float]]) -> list[RequestRecord]:
+        """
+        Возвращает уникальные запросы, сработавшие на пачке изменений цены.
+        up_to срабатывает при изменении не ниже target_percent, down_to - не выше,
+        all - при изменении по модулю не меньше target_percent.
+
+        :param changes: Словарь {символ: {период: изменение цены в процентах}}
+        :return: Сработавшие уникальные запросы
+        """
+
+        triggered = []
+        for period, columns in self.columns.items():
+            if not columns:
+                continue
+            values = np.full(self.size, np.nan)
+            for symbol, periods in changes.items():
+                i = self.symbol_index.get(symbol.upper())
+                if i is not None and period in periods:
+                    values[i] = periods[period]
+            triggered.extend(columns.evaluate(values))
+        return triggered
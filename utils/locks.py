@@ -0,0 +1,83 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable, Iterable
+
+import config
+
+
+class SharedLock:
+    """
+    Асинхронная блокировка с разделяемым и исключительным режимами.
+    Ожидающий исключительный захват не пропускает новые разделяемые, чтобы не голодать.
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, exclusive: bool) -> None:
+        async with self.condition:
+            if exclusive:
+                self.waiting_writers += 1
+                try:
+                    await self.condition.wait_for(lambda: not self.writer and not self.readers)
+                finally:
+                    self.waiting_writers -= 1
+                self.writer = True
+            else:
+                await self.condition.wait_for(lambda: not self.writer and not self.waiting_writers)
+                self.readers += 1
+
+    async def release(self, exclusive: bool) -> None:
+        async with self.condition:
+            if exclusive:
+                self.writer = False
+            else:
+                self.readers -= 1
+            self.condition.notify_all()
+
+
+class KeyLocks:
+    """
+    Таблица блокировок, разбитая на shards частей по хэшу ключа.
+    Изменения с разными ключами почти всегда попадают в разные части и выполняются параллельно,
+    память не растет с количеством ключей. Части захватываются по возрастанию номера,
+    поэтому одновременный захват нескольких ключей не приводит к взаимной блокировке.
+    """
+
+    def __init__(self, shards: int = config.LOCK_SHARDS):
+        self.locks = [SharedLock() for _ in range(shards)]
+
+    @asynccontextmanager
+    async def _hold(self, modes: dict[int, bool]) -> AsyncIterator[None]:
+        held = []
+        try:
+            for shard in sorted(modes):
+                await self.locks[shard].acquire(modes[shard])
+                held.append(shard)
+            yield
+        finally:
+            for shard in reversed(held):
+                await self.locks[shard].release(modes[shard])
+
+    def acquire(self, exclusive: Iterable[Hashable] = (), shared: Iterable[Hashable] = ()):
+        """
+        Захватывает блокировки ключей: async with locks.acquire([key1], [key2]): ...
+        Если ключи попали в одну часть, она захватывается в исключительном режиме.
+
+        :param exclusive: Ключи, изменения которых должны выполняться по одному
+        :param shared: Ключи, которые не должны меняться исключительным владельцем, пока держится блокировка
+        """
+
+        modes = {hash(key) % len(self.locks): False for key in shared}
+        modes.update((hash(key) % len(self.locks), True) for key in exclusive)
+        return self._hold(modes)
+
+    def acquire_all(self):
+        """
+        Захватывает все части таблицы (для изменений, ключи которых заранее неизвестны).
+        """
+
+        return self._hold(dict.fromkeys(range(len(self.locks)), True))
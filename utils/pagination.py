@@ -0,0 +1,107 @@
+import asyncio
+from bisect import bisect_right, insort
+from typing import AsyncIterator, Awaitable, Callable
+
+from utils.responses import dumps
+
+INSORT_LIMIT = 64
+
+
+class SortedIds:
+    """
+    Отсортированный индекс id для keyset-пагинации.
+    Изменения копятся и применяются при чтении: небольшие - вставкой бинарным поиском,
+    большие (например, загрузка из БД) - одной сортировкой, которая для уже отсортированного
+    списка с добавленным хвостом линейна.
+    """
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.added: set[int] = set()
+        self.removed: set[int] = set()
+
+    def __len__(self):
+        self._flush()
+        return len(self.ids)
+
+    def add(self, item_id: int) -> None:
+        """
+        :param item_id: Новый id (вызывающий гарантирует, что его нет в индексе)
+        """
+
+        if item_id in self.removed:
+            self.removed.discard(item_id)
+        else:
+            self.added.add(item_id)
+
+    def remove(self, item_id: int) -> None:
+        if item_id in self.added:
+            self.added.discard(item_id)
+        else:
+            self.removed.add(item_id)
+
+    def clear(self) -> None:
+        self.ids.clear()
+        self.added.clear()
+        self.removed.clear()
+
+    def _flush(self) -> None:
+        if not (self.added or self.removed):
+            return
+        if len(self.added) + len(self.removed) <= INSORT_LIMIT:
+            for item_id in self.removed:
+                i = bisect_right(self.ids, item_id) - 1
+                if i >= 0 and self.ids[i] == item_id:
+                    del self.ids[i]
+            for item_id in self.added:
+                insort(self.ids, item_id)
+        else:
+            removed = self.removed
+            ids = [item_id for item_id in self.ids if item_id not in removed] if removed else self.ids
+            ids.extend(self.added)
+            ids.sort()
+            self.ids = ids
+        self.added.clear()
+        self.removed.clear()
+
+    def page(self, after: int | None, limit: int) -> list[int]:
+        """
+        :param after: Последний id предыдущей страницы (None - с начала)
+        :param limit: Размер страницы
+        :return: id страницы по возрастанию
+        """
+
+        self._flush()
+        start = 0 if after is None else bisect_right(self.ids, after)
+        return self.ids[start:start + limit]
+
+
+async def ndjson_lines(
+        page: Callable[[int | None, int], Awaitable[tuple[dict, int | None]]],
+        chunk_size: int,
+        line: Callable[[int, object], object],
+        after: int | None = None,
+        limit: int | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Отдает записи построчно в формате NDJSON порциями по chunk_size.
+    Каждая порция читается отдельной страницей по курсору, поэтому память ограничена порцией,
+    изменения между порциями не ломают обход, а между порциями цикл событий обслуживает другие запросы.
+
+    :param page: Возвращает записи страницы после after ({id: запись}) и курсор следующей страницы
+    :param chunk_size: Количество записей в порции
+    :param line: Строит строку ответа из id и записи
+    :param after: Курсор, после которого начинается обход (None - с начала)
+    :param limit: Максимальное количество записей (None - до конца)
+    """
+
+    while limit is None or limit > 0:
+        size = chunk_size if limit is None else min(chunk_size, limit)
+        items, after = await page(after, size)
+        if items:
+            yield b"".join(dumps(line(key, value)) + b"\n" for key, value in items.items())
+        if after is None:
+            return
+        if limit is not None:
+            limit -= len(items)
+        await asyncio.sleep(0)
@@ -1,4 +1,9 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
 from sql.database import AlchemySqlDb
+from utils.backends import StateBackend, LocalBackend
+from utils.responses import ResponseCache
 
 
 class PatternSingleton:
@@ -11,6 +16,17 @@ class PatternSingleton:
 
 
 class RepositoryDB:
-    def __init__(self, sql_db: AlchemySqlDb):
+    responses: ResponseCache = ResponseCache()
+
+    def __init__(self, sql_db: AlchemySqlDb, backend: StateBackend | None = None):
         self.sql_db = sql_db
+        self.backend = backend or LocalBackend()
+
+    def load_session(self) -> AsyncSession:
+        """
+        Сессия для полной загрузки репозитория из БД.
+        При включенном канале изменений загрузка идет с основной БД: строку, записанную до LISTEN,
+        но еще не дошедшую до реплики, не принесут ни отстающая реплика, ни канал изменений.
+        """
 
+        return self.sql_db.SessionLocal() if config.CHANGE_FEED_ENABLED else self.sql_db.read_session()
@@ -0,0 +1,208 @@
+from typing import Iterable
+
+import config
+from utils.schemas import RequestForServer, Period, FetchCall, FetchPlan
+
+
+class WeightPlanner:
+    """
+    План опроса API: запросы на API распределяются по временным слотам длиной slot_seconds,
+    суммарный вес запросов слота не превышает slot_budget. Слоты опрашиваются по кругу,
+    поэтому за любую минуту расходуется не больше PLAN_WEIGHT_BUDGET.
+    Новые запросы занимают первый слот со свободным весом, удаленные освобождают вес,
+    опустевшие слоты удаляются, чтобы цикл не рос при смене запросов.
+    Порядок и частота по приоритету восстанавливаются полной перепаковкой (rebalance):
+    запрос с приоритетом в k раз выше среднего опрашивается k раз за цикл (не больше max_polls).
+    """
+
+    def __init__(
+            self,
+            budget: int = config.PLAN_WEIGHT_BUDGET,
+            slot_seconds: int = config.PLAN_SLOT_SECONDS,
+            max_polls: int = config.PLAN_MAX_POLLS_PER_CYCLE,
+    ):
+        self.slot_seconds = slot_seconds
+        self.slot_budget = max(1, budget * slot_seconds // 60)
+        self.max_polls = max_polls
+        self.slots: list[dict[RequestForServer, int]] = []
+        self.slot_weights: list[int] = []
+        self.slot_of: dict[RequestForServer, list[int]] = {}
+        self.request_weight = 0
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    @property
+    def weight(self) -> int:
+        """
+        Суммарный вес запросов плана при опросе каждого запроса на API отдельно по одному разу.
+        """
+
+        return self.request_weight
+
+    def _place(self, request: RequestForServer, weight: int, start: int = 0) -> None:
+        """
+        Помещает запрос в первый слот начиная со start (по кругу), где хватает веса и еще нет этого запроса.
+        Если такого слота нет, добавляет слот в конец цикла.
+        """
+
+        count = len(self.slots)
+        for j in range(count):
+            i = (start + j) % count
+            slot = self.slots[i]
+            if request not in slot and (self.slot_weights[i] + weight <= self.slot_budget or not slot):
+                break
+        else:
+            i = count
+            self.slots.append({})
+            self.slot_weights.append(0)
+        self.slots[i][request] = weight
+        self.slot_weights[i] += weight
+        self.slot_of.setdefault(request, []).append(i)
+
+    def add(self, request: RequestForServer, weight: int) -> None:
+        if request not in self.slot_of:
+            self.request_weight += weight
+            self._place(request, weight)
+
+    def remove(self, request: RequestForServer) -> None:
+        indexes = self.slot_of.pop(request, None)
+        if indexes is None:
+            return
+        for i in indexes:
+            weight = self.slots[i].pop(request)
+            self.slot_weights[i] -= weight
+        self.request_weight -= weight
+        if any(not self.slots[i] for i in indexes):
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Удаляет пустые слоты и перенумеровывает оставшиеся.
+        """
+
+        keep = [i for i, slot in enumerate(self.slots) if slot]
+        self.slots = [self.slots[i] for i in keep]
+        self.slot_weights = [self.slot_weights[i] for i in keep]
+        self.slot_of = {}
+        for i, slot in enumerate(self.slots):
+            for request in slot:
+                self.slot_of.setdefault(request, []).append(i)
+
+    def clear(self) -> None:
+        self.slots.clear()
+        self.slot_weights.clear()
+        self.slot_of.clear()
+        self.request_weight = 0
+
+    def polls(self, priorities: dict[RequestForServer, float]) -> dict[RequestForServer, int]:
+        """
+        Число опросов за цикл: целая часть отношения приоритета к среднему, от 1 до max_polls.
+
+        :param priorities: Приоритет каждого запроса на API
+        :return: Словарь {запрос на API: число опросов за цикл}
+        """
+
+        values = [priorities.get(request, 0) for request in self.slot_of]
+        mean = sum(values) / len(values) if values else 0
+        return {
+            request: min(self.max_polls, max(1, int(priorities.get(request, 0) / mean))) if mean > 0 else 1
+            for request in self.slot_of
+        }
+
+    def rebalance(self, priorities: dict[RequestForServer, float]) -> None:
+        """
+        Перепаковывает план: запросы с большим приоритетом попадают в более ранние слоты,
+        дополнительные опросы частых запросов распределяются по циклу равномерно.
+
+        :param priorities: Приоритет каждого запроса на API
+        """
+
+        polls = self.polls(priorities)
+        weights = {request: self.slots[indexes[0]][request] for request, indexes in self.slot_of.items()}
+        order = sorted(weights, key=lambda r: priorities.get(r, 0), reverse=True)
+        self.clear()
+        for request in order:
+            self.request_weight += weights[request]
+            self._place(request, weights[request])
+        cycle = len(self.slots)
+        for request in order:
+            first = self.slot_of[request][0]
+            for k in range(1, polls[request]):
+                self._place(request, weights[request], (first + k * cycle // polls[request]) % cycle)
+
+    def to_dict(self) -> dict:
+        return {
+            "slot_seconds": self.slot_seconds,
+            "slot_budget": self.slot_budget,
+            "cycle_seconds": max(len(self.slots), 1) * self.slot_seconds,
+            "slots": [
+                {"offset": i * self.slot_seconds, "weight": self.slot_weights[i], "requests": list(slot)}
+                for i, slot in enumerate(self.slots)
+            ],
+        }
+
+
+def _chunks(symbols: list[str], size: int) -> list[list[str]]:
+    return [symbols[i:i + size] for i in range(0, len(symbols), size)]
+
+
+def _price_calls(symbols: list[str]) -> list[FetchCall]:
+    if len(symbols) == 1:
+        return [FetchCall(endpoint="/api/v3/ticker/price", symbols=symbols, weight=config.WEIGHT_TICKER_PRICE)]
+    if len(symbols) > config.TICKER_PRICE_MAX_SYMBOLS:
+        return [FetchCall(endpoint="/api/v3/ticker/price", weight=config.WEIGHT_TICKER_PRICE_MULTI)]
+    return [FetchCall(endpoint="/api/v3/ticker/price", symbols=symbols, weight=config.WEIGHT_TICKER_PRICE_MULTI)]
+
+
+def _ticker_24h_calls(symbols: list[str]) -> list[FetchCall]:
+    chunks = _chunks(symbols, config.TICKER_24H_MAX_SYMBOLS)
+    if len(chunks) * config.WEIGHT_TICKER_24H > config.WEIGHT_TICKER_24H_ALL:
+        return [FetchCall(endpoint="/api/v3/ticker/24hr", weight=config.WEIGHT_TICKER_24H_ALL)]
+    return [
+        FetchCall(endpoint="/api/v3/ticker/24hr", symbols=chunk, weight=config.WEIGHT_TICKER_24H) for chunk in chunks
+    ]
+
+
+def _ticker_window_calls(symbols: list[str], window: str) -> list[FetchCall]:
+    return [
+        FetchCall(
+            endpoint="/api/v3/ticker",
+            symbols=chunk,
+            window=window,
+            weight=min(len(chunk) * config.WEIGHT_TICKER_WINDOW_PER_SYMBOL, config.WEIGHT_TICKER_WINDOW_MAX),
+        )
+        for chunk in _chunks(symbols, config.TICKER_WINDOW_MAX_SYMBOLS)
+    ]
+
+
+def build_fetch_plan(requests: Iterable[RequestForServer], naive_weight: int = 0) -> FetchPlan:
+    """
+    Группирует запросы на API в минимальный по весу набор вызовов мультисимвольных эндпоинтов.
+    Цены (Price, PercentOfPoint) запрашиваются одним вызовом /ticker/price со списком символов,
+    изменения за 24 часа - пачками /ticker/24hr (или одним вызовом по всем символам, если он дешевле),
+    изменения за остальные периоды - пачками /ticker с windowSize, вес которых ограничен сверху.
+
+    :param requests: Запросы на API
+    :param naive_weight: Суммарный вес при запросе каждого символа отдельно
+    :return: План вызовов и его суммарный вес
+    """
+
+    price_symbols: set[str] = set()
+    period_symbols: dict[Period, set[str]] = {}
+    for request in requests:
+        if request.request_data.type_request == "percent_of_time":
+            period_symbols.setdefault(request.request_data.period, set()).add(request.symbol)
+        else:
+            price_symbols.add(request.symbol)
+
+    calls = _price_calls(sorted(price_symbols)) if price_symbols else []
+    for period in Period:
+        symbols = sorted(period_symbols.get(period, ()))
+        if not symbols:
+            continue
+        if period == Period.v_24h:
+            calls.extend(_ticker_24h_calls(symbols))
+        else:
+            calls.extend(_ticker_window_calls(symbols, period.value))
+    return FetchPlan(calls=calls, total_weight=sum(call.weight for call in calls), naive_weight=naive_weight)
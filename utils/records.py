@@ -0,0 +1,344 @@
+"""
+Компактные записи для индексов репозитория в памяти.
+Pydantic-модели используются только на границе API: записи хранят поля в __slots__, символы интернируются,
+данные запроса одного уникального запроса разделяются всеми записями пользователей.
+Хэш и сравнение совместимы с соответствующими pydantic-моделями, поэтому записи и модели
+взаимозаменяемы как ключи словарей и элементы множеств.
+"""
+
+import json
+import sys
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from utils.schemas import (
+    UserRequest,
+    UniqueUserRequest,
+    RequestForServer,
+    Price,
+    PercentOfPoint,
+    PercentOfTime,
+    Period,
+    Way,
+)
+
+
+class RequestDataRecord(ABC):
+    """
+    Базовый класс данных запроса. Данные не изменяются, поэтому хэш ключа
+    (кортежа полей, как в __hash__ pydantic-модели) вычисляется один раз при создании.
+    Сравнение проверяет точный тип, а не isinstance: проверка через ABCMeta заметно медленнее.
+    """
+
+    __slots__ = ("_hash",)
+    type_request: str
+
+    @staticmethod
+    @abstractmethod
+    def key_of(data) -> tuple:
+        """
+        Ключ дедупликации данных: кортеж полей записи или pydantic-модели того же типа.
+        """
+
+    @property
+    def key(self) -> tuple:
+        return self.key_of(self)
+
+    @abstractmethod
+    def to_dict(self) -> dict:
+        """
+        Данные запроса в виде словаря, как model_dump() pydantic-модели.
+        """
+
+    def json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    def _set_key(self) -> None:
+        self._hash = hash(self.key_of(self))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is type(self):
+            return self._hash == other._hash and self.key_of(self) == self.key_of(other)
+        if getattr(other, "type_request", None) != self.type_request:
+            return NotImplemented
+        return self.key_of(self) == self.key_of(other)
+
+    def __hash__(self):
+        return self._hash
+
+
+class PriceData(RequestDataRecord):
+    __slots__ = ("target_price", "weight")
+    type_request = "price"
+
+    def __init__(self, target_price: float, weight: int):
+        self.target_price = float(target_price)
+        self.weight = weight
+        self._set_key()
+
+    def to_model(self) -> Price:
+        return Price(target_price=self.target_price, weight=self.weight)
+
+    def to_dict(self) -> dict:
+        return {"target_price": self.target_price, "weight": self.weight, "type_request": self.type_request}
+
+    @staticmethod
+    def key_of(data) -> tuple:
+        return data.target_price, data.weight, data.type_request
+
+    def __repr__(self):
+        return f'Price(target_price={self.target_price}, weight={self.weight}, type_request="{self.type_request}")'
+
+
+class PercentOfPointData(RequestDataRecord):
+    __slots__ = ("target_percent", "current_price", "weight")
+    type_request = "percent_of_point"
+
+    def __init__(self, target_percent: float, current_price: float, weight: int):
+        self.target_percent = float(target_percent)
+        self.current_price = float(current_price)
+        self.weight = weight
+        self._set_key()
+
+    def to_model(self) -> PercentOfPoint:
+        return PercentOfPoint(target_percent=self.target_percent, current_price=self.current_price, weight=self.weight)
+
+    def to_dict(self) -> dict:
+        return {
+            "target_percent": self.target_percent,
+            "current_price": self.current_price,
+            "weight": self.weight,
+            "type_request": self.type_request,
+        }
+
+    @staticmethod
+    def key_of(data) -> tuple:
+        return data.target_percent, data.current_price, data.weight, data.type_request
+
+    def __repr__(self):
+        return (
+            f"PercentOfPoint(target_percent={self.target_percent}, current_price={self.current_price}, "
+            f'weight={self.weight}, type_request="{self.type_request}")'
+        )
+
+
+class PercentOfTimeData(RequestDataRecord):
+    __slots__ = ("target_percent", "period", "weight")
+    type_request = "percent_of_time"
+
+    def __init__(self, target_percent: float, period: Period, weight: int):
+        self.target_percent = float(target_percent)
+        self.period = period
+        self.weight = weight
+        self._set_key()
+
+    def to_model(self) -> PercentOfTime:
+        return PercentOfTime(target_percent=self.target_percent, period=self.period, weight=self.weight)
+
+    def to_dict(self) -> dict:
+        return {
+            "target_percent": self.target_percent,
+            "period": self.period.value,
+            "weight": self.weight,
+            "type_request": self.type_request,
+        }
+
+    @staticmethod
+    def key_of(data) -> tuple:
+        return data.target_percent, data.period, data.weight, data.type_request
+
+    def __repr__(self):
+        return (
+            f"PercentOfTime(target_percent={self.target_percent}, period={self.period}, "
+            f'weight={self.weight}, type_request="{self.type_request}")'
+        )
+
+
+RequestData = PriceData | PercentOfPointData | PercentOfTimeData
+
+
+def data_from_model(data: Price | PercentOfPoint | PercentOfTime) -> RequestData:
+    if data.type_request == "price":
+        return PriceData(data.target_price, data.weight)
+    if data.type_request == "percent_of_point":
+        return PercentOfPointData(data.target_percent, data.current_price, data.weight)
+    return PercentOfTimeData(data.target_percent, data.period, data.weight)
+
+
+def data_from_json(request_data: str) -> RequestData:
+    data = json.loads(request_data)
+    if data["type_request"] == "price":
+        return PriceData(data["target_price"], data["weight"])
+    elif data["type_request"] == "percent_of_point":
+        return PercentOfPointData(data["target_percent"], data["current_price"], data["weight"])
+    elif data["type_request"] == "percent_of_time":
+        return PercentOfTimeData(data["target_percent"], Period(data["period"]), data["weight"])
+    else:
+        raise ValueError(f"Unknown type request: {data}")
+
+
+class RequestRecord:
+    """
+    Запрос пользователя в индексах репозитория.
+    Первая запись уникального запроса служит и уникальным запросом (с каноническим request_id).
+    Сравнение, как и у UserRequest, не учитывает request_id и время создания и обновления.
+    Хэш ключа дедупликации (символ, данные, направление) вычисляется один раз и совпадает
+    с хэшем UserRequest и UniqueUserRequest. Сравнение записей не создает объектов:
+    символы интернированы, а данные равных записей после share() - один объект.
+    """
+
+    __slots__ = ("request_id", "symbol", "request_data", "way", "created", "updated", "_hash")
+
+    def __init__(
+            self,
+            request_id: int,
+            symbol: str,
+            request_data: RequestData,
+            way: Way,
+            created: datetime,
+            updated: datetime,
+    ):
+        self.request_id = request_id
+        self.symbol = sys.intern(symbol)
+        self.request_data = request_data
+        self.way = way
+        self.created = created
+        self.updated = updated if updated != created else created
+        self._hash = hash((self.symbol, request_data, way))
+
+    @staticmethod
+    def from_model(request: UserRequest) -> "RequestRecord":
+        return RequestRecord(
+            request.request_id,
+            request.symbol,
+            data_from_model(request.request_data),
+            request.way,
+            request.created,
+            request.updated,
+        )
+
+    @staticmethod
+    def from_orm(request_orm) -> "RequestRecord":
+        return RequestRecord(
+            request_orm.request_id,
+            request_orm.symbol,
+            data_from_json(request_orm.request_data),
+            Way(request_orm.way),
+            request_orm.created,
+            request_orm.updated,
+        )
+
+    def to_model(self) -> UserRequest:
+        return UserRequest(
+            request_id=self.request_id,
+            symbol=self.symbol,
+            request_data=self.request_data.to_model(),
+            way=self.way,
+            created=self.created,
+            updated=self.updated,
+        )
+
+    def to_dict(self) -> dict:
+        """
+        Словарь полей в порядке UserRequest для сериализации без pydantic.
+        """
+
+        return {
+            "request_id": self.request_id,
+            "symbol": self.symbol,
+            "request_data": self.request_data.to_dict(),
+            "way": self.way.value,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+    def to_unique_dict(self) -> dict:
+        """
+        Словарь полей в порядке UniqueUserRequest для сериализации без pydantic.
+        """
+
+        return {
+            "request_id": self.request_id,
+            "symbol": self.symbol,
+            "way": self.way.value,
+            "request_data": self.request_data.to_dict(),
+        }
+
+    @property
+    def key(self) -> tuple:
+        return self.symbol, self.request_data, self.way
+
+    def share(self, canonical: "RequestRecord") -> None:
+        """
+        Переиспользует данные и хэш равной записи уникального запроса, чтобы не хранить их копии.
+        """
+
+        self.request_data = canonical.request_data
+        self._hash = canonical._hash
+
+    def to_unique(self) -> UniqueUserRequest:
+        return UniqueUserRequest.model_construct(
+            request_id=self.request_id,
+            symbol=self.symbol,
+            way=self.way,
+            request_data=self.request_data.to_model(),
+        )
+
+    def __eq__(self, other):
+        if isinstance(other, RequestRecord):
+            return (
+                self._hash == other._hash
+                and self.symbol == other.symbol
+                and self.way is other.way
+                and self.request_data == other.request_data
+            )
+        if not isinstance(other, (UserRequest, UniqueUserRequest)):
+            return NotImplemented
+        return (self.symbol, self.request_data, self.way) == (other.symbol, other.request_data, other.way)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return (
+            f"RequestRecord(request_id={self.request_id}, symbol='{self.symbol}', "
+            f"request_data={self.request_data}, way={self.way}, created={self.created}, updated={self.updated})"
+        )
+
+
+class ServerRecord:
+    """
+    Запрос на API в индексах репозитория. Сравнение и хэш такие же, как у RequestForServer:
+    PercentOfTime различаются по символу и периоду, Price и PercentOfPoint - только по символу.
+    """
+
+    __slots__ = ("symbol", "request_data")
+
+    def __init__(self, request: RequestRecord):
+        self.symbol = request.symbol
+        self.request_data = request.request_data
+
+    @staticmethod
+    def key_of(request) -> tuple:
+        if request.request_data.type_request == "percent_of_time":
+            return request.symbol, request.request_data.period
+        return request.symbol, None
+
+    def to_model(self) -> RequestForServer:
+        return RequestForServer.model_construct(symbol=self.symbol, request_data=self.request_data.to_model())
+
+    def to_dict(self) -> dict:
+        return {"symbol": self.symbol, "request_data": self.request_data.to_dict()}
+
+    def __eq__(self, other):
+        if not isinstance(other, (ServerRecord, RequestForServer)):
+            return NotImplemented
+        return self.symbol == other.symbol and self.key_of(self) == self.key_of(other)
+
+    def __hash__(self):
+        return hash(self.symbol)
+
+    def __repr__(self):
+        return f'RequestForServer(symbol="{self.symbol}", request_data={self.request_data})'
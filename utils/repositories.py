@@ -1,21 +1,78 @@
 import asyncio
+import logging
+import time
+from collections import deque
 from datetime import datetime
-from sqlalchemy import update, select
+from itertools import groupby
+from operator import itemgetter
+from sqlalchemy import func, select, tuple_
 
-from sql.models import UserOrm, UserRequestOrm
+import config
+from sql.models import UserOrm, UserRequestOrm, UniqueRequestOrm
+from utils.changes import (
+    publish,
+    add_user_event,
+    update_user_event,
+    delete_user_event,
+    add_request_event,
+    delete_request_event,
+)
+from utils.engines import PriceCrossingEngine, PercentOfTimeEngine
+from utils.locks import KeyLocks
+from utils.pagination import SortedIds
 from utils.patterns import PatternSingleton, RepositoryDB
-from utils.schemas import User, UserRequest, UniqueUserRequest, RequestForServer
+from utils.planner import WeightPlanner, build_fetch_plan
+from utils.records import RequestRecord, ServerRecord
+from utils.sharding import shard_of
+from utils.stream import Subscription
+from utils.writebehind import GroupCommitQueue
+from utils import wire
+from utils.snapshot import (
+    Snapshot,
+    SnapshotError,
+    read_snapshot,
+    write_snapshot,
+    user_to_row,
+    user_from_row,
+    request_to_row,
+    request_from_row,
+)
+from utils.schemas import (
+    User,
+    UserRequest,
+    UniqueUserRequest,
+    RequestForServer,
+    TriggeredRequest,
+    Period,
+    BulkRequestResult,
+    BulkStatus,
+    FetchPlan,
+)
 
 
 class UserRepository(RepositoryDB, PatternSingleton):
     users: dict[int, User] = {}
+    user_ids: SortedIds = SortedIds()
+
+    def _set_user(self, user: User) -> None:
+        if user.user_id not in self.users:
+            self.user_ids.add(user.user_id)
+        self.users[user.user_id] = user
+        self.responses.invalidate("users")
+
+    def _pop_user(self, user_id: int) -> None:
+        if self.users.pop(user_id, None) is not None:
+            self.user_ids.remove(user_id)
+            self.responses.invalidate("users")
 
     async def add_user(self, user: User) -> User:
         async with self.sql_db.SessionLocal() as session:
             user_orm = UserOrm.from_user(user)
             session.add(user_orm)
+            await publish(session, [add_user_event(user)])
             await session.commit()
-        self.users[user.user_id] = user
+        self._set_user(user)
+        await self.backend.save_users([user_to_row(user)])
         return user
 
     async def delete_user(self, user_id: int) -> User:
@@ -27,13 +84,34 @@ class UserRepository(RepositoryDB, PatternSingleton):
     async def get_all_users(self) -> dict:
         return self.users
 
+    async def get_all_users_json(self) -> bytes:
+        return self.responses.get("users", None, lambda: self.users)
+
+    async def get_users_page(
+            self, after: int | None = None, limit: int = config.PAGE_SIZE
+    ) -> tuple[dict, int | None]:
+        """
+        Страница пользователей по возрастанию user_id (keyset-пагинация).
+
+        :param after: user_id последнего пользователя предыдущей страницы
+        :param limit: Размер страницы
+        :return: Пользователи страницы и курсор следующей страницы (None - страница последняя)
+        """
+
+        # Лишний id показывает, есть ли следующая страница: полная последняя страница получает курсор None
+        user_ids = self.user_ids.page(after, limit + 1)
+        next_after = user_ids[limit - 1] if len(user_ids) > limit else None
+        del user_ids[limit:]
+        page = {user_id: self.users[user_id] for user_id in user_ids}
+        return page, next_after
+
     async def get_user_from_db(self, user_id) -> UserOrm | None:
-        async with self.sql_db.SessionLocal() as session:
+        async with self.sql_db.read_session() as session:
             res = await session.execute(select(UserOrm).where(UserOrm.user_id == user_id))
             return res.scalar_one_or_none()
 
     async def get_all_users_from_db(self) -> list[UserOrm]:
-        async with self.sql_db.SessionLocal() as session:
+        async with self.sql_db.read_session() as session:
             res = await session.execute(select(UserOrm))
             return res.scalars().all()
 
@@ -42,239 +120,1244 @@ class UserRepository(RepositoryDB, PatternSingleton):
             raise Exception(f"Ошибка обновления пользователя (пользователь с id {user.user_id} не существует)")
         async with self.sql_db.SessionLocal() as session:
             user.updated = datetime.utcnow()
-            stmt = (
-                update(UserOrm)
-                .values(
-                    firstname=user.firstname,
-                    surname=user.surname,
-                    username=user.username,
-                    ban=user.ban,
-                    updated=user.updated,
-                )
-                .filter_by(user_id=user.user_id)
+            stmt = self.sql_db.update_query(
+                model=UserOrm,
+                where_col=UserOrm.user_id,
+                where_value=user.user_id,
+                values={
+                    "firstname": user.firstname,
+                    "surname": user.surname,
+                    "username": user.username,
+                    "ban": user.ban,
+                    "updated": user.updated,
+                },
+                returning=(UserOrm,),
             )
-            await session.execute(stmt)
-            await session.commit()
-            res = await session.execute(select(UserOrm).filter(UserOrm.user_id == user.user_id))
+            res = await session.execute(stmt)
             user_orm = res.scalar_one_or_none()
             user = User(**user_orm.__dict__)
-            self.users[user.user_id] = user
-            return user
+            await publish(session, [update_user_event(user)])
+            await session.commit()
+        self._set_user(user)
+        await self.backend.save_users([user_to_row(user)])
+        return user
 
-    async def load_users_from_db(self) -> None:
-        users = await self.get_all_users_from_db()
-        for user in users:
-            self.users[user.user_id] = User(**user.__dict__)
+    async def load_users_from_db(self) -> int:
+        """
+        Загружает пользователей из БД порциями через серверный курсор.
+
+        :return: Количество загруженных строк
+        """
+
+        rows = 0
+        async with self.load_session() as session:
+            res = await session.stream(select(UserOrm).execution_options(yield_per=config.DB_LOAD_CHUNK_SIZE))
+            async for users in res.scalars().partitions():
+                for user in users:
+                    self._set_user(User(**user.__dict__))
+                rows += len(users)
+        return rows
 
 
 class RequestRepository(RepositoryDB, PatternSingleton):
-    user_requests: dict[int, set[UserRequest]] = {}
-    unique_user_requests: dict[UniqueUserRequest, set[int]] = {}
-    unique_requests_for_server: set[RequestForServer] = set()
-    requests_weight: int = 0
+    user_requests: dict[int, set[RequestRecord]] = {}
+    request_user_ids: SortedIds = SortedIds()
+    user_request_keys: dict[tuple[int, int], RequestRecord] = {}
+    unique_user_requests: dict[RequestRecord, set[int]] = {}
+    unique_keys: dict[RequestRecord, RequestRecord] = {}
+    unique_request_ids: dict[int, RequestRecord] = {}
+    unique_requests_for_server: set[ServerRecord] = set()
+    requests_for_server_refs: dict[ServerRecord, dict[RequestRecord, None]] = {}
+    price_engine: PriceCrossingEngine = PriceCrossingEngine()
+    percent_engine: PercentOfTimeEngine = PercentOfTimeEngine()
+    planner: WeightPlanner = WeightPlanner()
+    fetch_plan: tuple[int, FetchPlan] | None = None
+    version: int = time.time_ns() // 1000
+    changelog_start: int = version
+    changelog: deque[tuple[int, str, bool, RequestRecord | ServerRecord]] = deque(
+        maxlen=config.CHANGELOG_SIZE
+    )
+    subscriptions: set[Subscription] = set()
+    write_queue: GroupCommitQueue | None = None
+    locks: KeyLocks = KeyLocks()
+
+    @staticmethod
+    def _user_lock(user_id: int) -> tuple:
+        return "user", user_id
+
+    def _log_change(self, kind: str, added: bool, item: RequestRecord | ServerRecord) -> None:
+        """
+        Увеличивает версию репозитория и записывает изменение в журнал.
+        Версия начинается с текущего времени в микросекундах, поэтому не повторяется после перезапуска.
+
+        :param kind: "unique" или "server"
+        :param added: True - запись добавлена, False - удалена
+        :param item: Уникальный запрос или запрос на API
+        """
+
+        if len(self.changelog) == self.changelog.maxlen:
+            self.changelog_start = self.changelog[0][0]
+        self.version += 1
+        self.responses.invalidate(kind)
+        entry = (self.version, kind, added, item)
+        self.changelog.append(entry)
+        for subscription in self.subscriptions:
+            subscription.push(entry)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription()
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    def changelog_since(self, since: int) -> list[tuple] | None:
+        """
+        Возвращает записи журнала изменений после версии since в порядке их появления.
+
+        :param since: Версия, полученная клиентом ранее
+        :return: Записи журнала или None, если журнал не покрывает since
+        """
+
+        if since < self.changelog_start or since > self.version:
+            return None
+        entries = []
+        for entry in reversed(self.changelog):
+            if entry[0] <= since:
+                break
+            entries.append(entry)
+        entries.reverse()
+        return entries
+
+    @staticmethod
+    def _request_values(user_id: int, request: RequestRecord) -> dict:
+        return {
+            "request_id": request.request_id,
+            "user_id": user_id,
+            "symbol": request.symbol,
+            "request_data": request.request_data.json(),
+            "way": request.way.value,
+            "created": request.created,
+            "updated": request.updated,
+        }
+
+    @staticmethod
+    def _unique_values(request: RequestRecord, request_id: int) -> dict:
+        return {
+            "request_id": request_id,
+            "symbol": request.symbol,
+            "request_data": request.request_data.json(),
+            "way": request.way.value,
+        }
+
+    async def _insert_unique_values(self, session, values: list[dict]) -> None:
+        """
+        Вставляет строки в реестр канонических id, пропуская занятые ключи и id.
+        Строки вставляются в порядке ключа, чтобы встречные вставки экземпляров не блокировали друг друга.
+        """
+
+        values.sort(key=itemgetter("symbol", "request_data", "way"))
+        for i in range(0, len(values), config.BULK_CHUNK_SIZE):
+            await session.execute(
+                self.sql_db.insert_query(model=UniqueRequestOrm, values=values[i:i + config.BULK_CHUNK_SIZE])
+            )
+
+    async def _resolve_request_ids(self, session, requests: list[RequestRecord]) -> dict[RequestRecord, int]:
+        """
+        Получает из реестра в БД канонические request_id уникальных запросов в транзакции вызывающего.
+        Порция ключей - один запрос: вставка в реестр и чтение ключей, уже занятых (в том числе другим экземпляром).
+        Ключ, которого нет в ответе, занят еще не зафиксированной вставкой или свободен при занятом id:
+        он повторяется следующим запросом с увеличенным id. Ключи вставляются по порядку,
+        чтобы встречные вставки экземпляров не блокировали друг друга.
+
+        :param requests: Запросы с разными ключами дедупликации, request_id - предлагаемый id
+        :return: Канонический request_id каждого запроса
+        """
+
+        key = (UniqueRequestOrm.symbol, UniqueRequestOrm.request_data, UniqueRequestOrm.way)
+        proposed = {request: request.request_id for request in requests}
+        ids = {}
+        while proposed:
+            values = {}
+            for request, request_id in proposed.items():
+                value = self._unique_values(request, request_id)
+                values[(value["symbol"], value["request_data"], value["way"])] = request, value
+            ordered = [values[value_key][1] for value_key in sorted(values)]
+            for i in range(0, len(ordered), config.BULK_CHUNK_SIZE):
+                res = await session.execute(
+                    self.sql_db.insert_or_select_query(
+                        model=UniqueRequestOrm,
+                        values=ordered[i:i + config.BULK_CHUNK_SIZE],
+                        key=key,
+                        returning=(UniqueRequestOrm.request_id, *key),
+                    )
+                )
+                for row in res:
+                    request = values[(row.symbol, row.request_data, row.way)][0]
+                    ids[request] = row.request_id
+                    proposed.pop(request, None)
+            for request in proposed:
+                proposed[request] += 1
+        return ids
+
+    async def register_unique_requests(self) -> int:
+        """
+        Заносит уникальные запросы репозитория в реестр канонических id, если реестр отстает от репозитория.
+        Строки реестра не удаляются, а новые запросы попадают в него при записи, поэтому строк в реестре
+        меньше, чем уникальных запросов, только до первого переноса запросов, записанных до появления реестра.
+        В остальных запусках выполняется один подсчет строк.
+
+        :return: Количество перенесенных в реестр уникальных запросов (0 - реестр не отстает)
+        """
 
-    async def _add_request(self, user_id, request: UserRequest) -> None:
         async with self.sql_db.SessionLocal() as session:
-            res = await session.execute(select(UserOrm).where(UserOrm.user_id == user_id))
-            user_orm = res.scalar_one_or_none()
-            request_orm = UserRequestOrm.from_user_request(user_orm, request)
+            registered = await session.scalar(select(func.count()).select_from(UniqueRequestOrm))
+            if registered >= len(self.unique_keys):
+                return 0
+            await self._insert_unique_values(
+                session, [self._unique_values(request, request.request_id) for request in self.unique_keys.values()]
+            )
+            await session.commit()
+        return len(self.unique_keys)
+
+    async def _add_request(self, user_id, request: RequestRecord, new_key: bool) -> None:
+        """
+        :param new_key: Ключа запроса нет в репозитории: канонический id выбирается в той же транзакции
+        """
+
+        async with self.sql_db.SessionLocal() as session:
+            if new_key:
+                request.request_id = (await self._resolve_request_ids(session, [request]))[request]
             query = self.sql_db.insert_query(
                 model=UserRequestOrm,
-                values={
-                    "request_id": request_orm.request_id,
-                    "user_id": request_orm.user_id,
-                    "symbol": request_orm.symbol,
-                    "request_data": request_orm.request_data,
-                    "way": request_orm.way,
-                    "created": request_orm.created,
-                    "updated": request_orm.updated,
-                },
+                values=self._request_values(user_id, request),
                 index_elements=["request_id", "user_id"],
             )
             await session.execute(query)
+            await publish(session, [add_request_event(user_id, request)])
             await session.commit()
+        await self.backend.save_requests([request_to_row(user_id, request)])
 
-    async def _delete_unique_user_request(self, user_id: int, request: UserRequest) -> None:
-        if UniqueUserRequest(request) in self.unique_user_requests:
-            self.unique_user_requests[UniqueUserRequest(request)].discard(user_id)
-            if not self.unique_user_requests[UniqueUserRequest(request)]:
-                self.unique_user_requests.pop(UniqueUserRequest(request), None)
+    def start_write_behind(self, durability: str = config.WRITE_BEHIND_DURABILITY) -> None:
+        """
+        Включает отложенную запись: add_request и delete_request меняют индексы в памяти сразу,
+        а изменения в БД сбрасываются фоновой задачей пачками в одной транзакции.
+        Новый уникальный запрос индексируется с предложенным id, канонический id выбирается при сбросе:
+        в режиме memory вызывающий получает предложенный id, который может смениться после сброса.
 
-    async def _do_unique_requests_for_server(self) -> set[RequestForServer]:
+        :param durability: "commit" - вызывающий ждет фиксации транзакции, "memory" - не ждет
         """
-        Создает множество с уникальными запросами (без дублей) на API.
 
-        :return: Set[RequestForServer]
+        if self.write_queue is None:
+            self.write_queue = GroupCommitQueue(self._commit_writes, durability=durability, rejected=self._reject_write)
+            self.write_queue.start()
+
+    async def stop_write_behind(self) -> None:
+        """
+        Сбрасывает накопленные изменения и выключает отложенную запись.
         """
 
-        self.unique_requests_for_server = set()
-        self.requests_weight = 0
+        if self.write_queue is not None:
+            queue, self.write_queue = self.write_queue, None
+            await queue.close()
 
-        async def unique_user_requests_loop():
-            for req in self.unique_user_requests.keys():
-                await asyncio.sleep(0)
-                yield req
+    async def flush_writes(self) -> None:
+        """
+        Сбрасывает накопленные отложенные изменения в БД.
+        Вызывается перед операциями, которые пишут в БД напрямую, чтобы сохранить порядок изменений.
+        """
 
-        async for request in unique_user_requests_loop():
-            if RequestForServer(request) not in self.unique_requests_for_server:
-                self.unique_requests_for_server.add(RequestForServer(request))
-                self.requests_weight += request.request_data.weight
+        if self.write_queue is not None:
+            await self.write_queue.flush()
 
-        return self.unique_requests_for_server
+    async def _reject_write(self, op: tuple, error: Exception) -> None:
+        """
+        Откатывает в индексах отложенное изменение, которое БД отклонила (режим memory).
+        Не захватывает блокировки ключей: вызывается из сброса очереди, который может идти под acquire_all.
+
+        :param op: Изменение ("add" или "delete", id пользователя, запрос)
+        :param error: Ошибка записи
+        """
+
+        kind, user_id, item = op
+        if kind == "add":
+            if self.user_request_keys.get((user_id, item.request_id)) is item:
+                await self._unindex_request(user_id, item)
+        else:
+            logging.error(
+                f'write-behind delete of request {item} for user {user_id} rejected, reload required: {error}'
+            )
+
+    async def _commit_writes(self, ops: list[tuple]) -> None:
+        """
+        Записывает пачку отложенных изменений одной транзакцией.
+        Подряд идущие добавления и удаления объединяются в многострочные INSERT и DELETE,
+        порядок изменений сохраняется. Канонические id добавлений выбираются в той же транзакции.
+
+        :param ops: Изменения ("add" или "delete", id пользователя, запрос)
+        """
+
+        runs = [(kind, list(run)) for kind, run in groupby(ops, key=itemgetter(0))]
+        events = []
+        async with self.sql_db.SessionLocal() as session:
+            for kind, run in runs:
+                if kind == "add":
+                    await self._resolve_writes(session, run)
+                for i in range(0, len(run), config.BULK_CHUNK_SIZE):
+                    chunk = run[i:i + config.BULK_CHUNK_SIZE]
+                    if kind == "add":
+                        query = self.sql_db.insert_query(
+                            model=UserRequestOrm,
+                            values=[self._request_values(user_id, request) for _, user_id, request in chunk],
+                            index_elements=["request_id", "user_id"],
+                        )
+                    else:
+                        query = self.sql_db.delete_query(
+                            model=UserRequestOrm,
+                            where=(
+                                tuple_(UserRequestOrm.user_id, UserRequestOrm.request_id)
+                                .in_([(user_id, request.request_id) for _, user_id, request in chunk]),
+                            ),
+                        )
+                    await session.execute(query)
+                if kind == "add":
+                    events.extend(add_request_event(user_id, request) for _, user_id, request in run)
+                else:
+                    events.extend(delete_request_event(user_id, request.request_id) for _, user_id, request in run)
+            await publish(session, events)
+            await session.commit()
+        for kind, run in runs:
+            if kind == "add":
+                await self.backend.save_requests([request_to_row(user_id, request) for _, user_id, request in run])
+            else:
+                await self.backend.delete_requests([(user_id, request.request_id) for _, user_id, request in run])
+
+    async def _resolve_writes(self, session, run: list[tuple]) -> None:
+        """
+        Выбирает канонические id отложенных добавлений. Уникальный запрос, проиндексированный
+        с другим id (ключ уже занят в реестре), переносится на канонический id вместе с записями пользователей.
+
+        :param run: Изменения ("add", id пользователя, запрос)
+        """
+
+        requests = {}
+        for _, _, request in run:
+            requests.setdefault(request, request)
+        ids = await self._resolve_request_ids(session, list(requests))
+        for request, request_id in ids.items():
+            canonical = self.unique_keys.get(request)
+            if canonical is not None and canonical.request_id != request_id:
+                self._move_unique_request(canonical, request_id)
+        for _, _, request in run:
+            request.request_id = ids[request]
+
+    def _move_unique_request(self, canonical: RequestRecord, request_id: int) -> None:
+        """
+        Меняет request_id уникального запроса и записей его пользователей.
+        В журнал изменений попадают удаление запроса со старым id и добавление с новым.
+
+        :param canonical: Уникальный запрос
+        :param request_id: Канонический id из реестра
+        """
+
+        old_id = canonical.request_id
+        removed = RequestRecord(
+            old_id, canonical.symbol, canonical.request_data, canonical.way, canonical.created, canonical.updated
+        )
+        for user_id in self.unique_user_requests.get(canonical, ()):
+            request = self.user_request_keys.pop((user_id, old_id), None)
+            if request is not None:
+                request.request_id = request_id
+                self.user_request_keys[(user_id, request_id)] = request
+        canonical.request_id = request_id
+        self.unique_request_ids.pop(old_id, None)
+        self.unique_request_ids[request_id] = canonical
+        self.responses.invalidate("requests")
+        self._log_change("unique", False, removed)
+        self._log_change("unique", True, canonical)
+
+    def _index_request(self, user_id: int, request: RequestRecord) -> None:
+        """
+        Добавляет запрос пользователя в индексы репозитория.
+        request_id запроса должен совпадать с каноническим id уникального запроса.
+        Запись, открывшая уникальный запрос, становится уникальным запросом,
+        остальные записи разделяют с ней данные запроса.
+
+        :param user_id: ID пользователя
+        :param request: Запрос пользователя
+        """
+
+        if request in self.unique_user_requests:
+            self.unique_user_requests[request].add(user_id)
+            canonical = self.unique_keys.get(request)
+            if canonical is not None:
+                request.share(canonical)
+        else:
+            self.unique_user_requests.update({request: {user_id}})
+            self._register_unique_request(request)
+        if user_id in self.user_requests:
+            self.user_requests[user_id].add(request)
+        else:
+            self.user_requests.update({user_id: {request}})
+            self.request_user_ids.add(user_id)
+        self.user_request_keys.setdefault((user_id, request.request_id), request)
+        self.responses.invalidate("requests")
+
+    async def _unindex_request(self, user_id: int, request: RequestRecord) -> None:
+        """
+        Удаляет запрос пользователя из индексов репозитория.
+
+        :param user_id: ID пользователя
+        :param request: Запрос пользователя
+        """
+
+        if user_id in self.user_requests:
+            self.user_requests[user_id].discard(request)
+            if not self.user_requests[user_id]:
+                self.user_requests.pop(user_id, None)
+                self.request_user_ids.remove(user_id)
+        self.user_request_keys.pop((user_id, request.request_id), None)
+        self.responses.invalidate("requests")
+        await self._delete_unique_user_request(user_id, request)
+
+    async def _unindex_user_requests(self, user_id: int) -> None:
+        """
+        Удаляет все запросы пользователя из индексов репозитория.
+
+        :param user_id: ID пользователя
+        """
+
+        for request in list(self.user_requests.get(user_id, ())):
+            await self._unindex_request(user_id, request)
+
+    async def _delete_unique_user_request(self, user_id: int, request: RequestRecord) -> None:
+        if request in self.unique_user_requests:
+            self.unique_user_requests[request].discard(user_id)
+            if not self.unique_user_requests[request]:
+                self.unique_user_requests.pop(request, None)
+                self._unregister_unique_request(request)
+
+    def _register_unique_request(self, request: RequestRecord) -> None:
+        """
+        Регистрирует новый уникальный запрос в реестре канонических ключей, в запросах на API
+        и в движках проверки запросов.
+
+        :param request: Уникальный запрос с каноническим request_id
+        """
+
+        self.unique_keys[request] = request
+        self.unique_request_ids[request.request_id] = request
+        self._log_change("unique", True, request)
+        self._add_request_for_server(request)
+        self.price_engine.add(request)
+        self.percent_engine.add(request)
+
+    def _unregister_unique_request(self, request: RequestRecord) -> None:
+        """
+        Удаляет уникальный запрос из реестра канонических ключей, из запросов на API
+        и из движков проверки запросов.
+
+        :param request: Уникальный запрос (request_id может быть не каноническим)
+        """
+
+        canonical = self.unique_keys.pop(request, None)
+        if canonical is not None:
+            self.unique_request_ids.pop(canonical.request_id, None)
+            self._log_change("unique", False, canonical)
+        self._delete_request_for_server(request)
+        self.price_engine.remove(request)
+        self.percent_engine.remove(request)
+
+    def _add_request_for_server(self, request: RequestRecord) -> None:
+        """
+        Учитывает новый уникальный запрос в множестве запросов на API.
+        Для каждого запроса на API хранятся ссылающиеся на него уникальные запросы в порядке добавления,
+        данные и вес запроса на API берутся у первого из них.
+
+        :param request: Новый уникальный запрос
+        """
+
+        request_for_server = ServerRecord(request)
+        referrers = self.requests_for_server_refs.get(request_for_server)
+        if referrers:
+            referrers[request] = None
+        else:
+            self._put_request_for_server(request_for_server, {request: None})
+
+    def _delete_request_for_server(self, request: RequestRecord) -> None:
+        """
+        Убирает уникальный запрос из ссылок запроса на API.
+        Когда на запрос больше не ссылается ни один уникальный запрос, он удаляется из множества.
+        Если удален уникальный запрос, данные которого отдавались в запросе на API, запрос на API
+        заменяется запросом со следующего уникального запроса.
+
+        :param request: Удаленный уникальный запрос
+        """
+
+        request_for_server = ServerRecord(request)
+        referrers = self.requests_for_server_refs.get(request_for_server)
+        if not referrers or request not in referrers:
+            return
+        representative = next(iter(referrers))
+        del referrers[request]
+        if representative != request:
+            return
+        self.requests_for_server_refs.pop(request_for_server)
+        self.unique_requests_for_server.discard(request_for_server)
+        self.planner.remove(request_for_server)
+        self._log_change("server", False, request_for_server)
+        if referrers:
+            self._put_request_for_server(ServerRecord(next(iter(referrers))), referrers)
+
+    def _put_request_for_server(self, request_for_server: ServerRecord, referrers: dict[RequestRecord, None]) -> None:
+        self.requests_for_server_refs[request_for_server] = referrers
+        self.unique_requests_for_server.add(request_for_server)
+        self.planner.add(request_for_server, request_for_server.request_data.weight)
+        self._log_change("server", True, request_for_server)
 
     async def add_request(self, user_id: int, request: UserRequest) -> UserRequest:
         """
         Добавляет запрос пользователя в репозиторий.
         Если запрос уникален, дополнительно добавляет его в список уникальных запросов.
         Если запрос не уникален, меняет id запроса на id уже существующего, чтобы не было дублирования.
+        id нового уникального запроса выбирает реестр в БД в транзакции записи запроса (при отложенной записи -
+        в транзакции сброса), поэтому экземпляры сервиса не расходятся в id.
 
         :param user_id: Экземпляр пользователя
         :param request: Запрос пользователя
         :return: Экземпляр RequestRepository
         """
 
-        if UniqueUserRequest(request) in self.unique_user_requests:
-            self.unique_user_requests[UniqueUserRequest(request)].add(user_id)
-            list_r = list(self.unique_user_requests.keys())
-            i = list_r.index(UniqueUserRequest(request))
-            request.request_id = list_r[i].request_id
-            await self._add_request(user_id, request)
-        else:
-            await self._add_request(user_id, request)
-            self.unique_user_requests.update({UniqueUserRequest(request): {user_id}})
+        record = RequestRecord.from_model(request)
+        async with self.locks.acquire(exclusive=[record], shared=[self._user_lock(user_id)]):
+            if self.write_queue is not None and user_id not in self.users:
+                raise Exception(f"add_request: user {user_id} not found")
+            canonical = self.unique_keys.get(record)
+            if canonical is not None:
+                record.request_id = canonical.request_id
+            if self.write_queue is None:
+                await self._add_request(user_id, record, new_key=canonical is None)
+                self._index_request(user_id, record)
+                request.request_id = record.request_id
+                return request
+            exists = (user_id, record.request_id) in self.user_request_keys
+            self._index_request(user_id, record)
+            try:
+                await self.write_queue.put(("add", user_id, record))
+            except Exception:
+                if not exists and self.user_request_keys.get((user_id, record.request_id)) is record:
+                    await self._unindex_request(user_id, record)
+                raise
+            request.request_id = record.request_id
+            return request
 
-        if user_id in self.user_requests:
-            self.user_requests[user_id].add(request)
-        else:
-            self.user_requests.update({user_id: {request}})
-        return request
+    async def add_requests(self, items: list[tuple[int, UserRequest]]) -> list[BulkRequestResult]:
+        """
+        Добавляет пачку запросов пользователей в репозиторий одним многострочным INSERT в одной транзакции.
+        Дубли внутри пачки и с уже существующими запросами получают канонический request_id,
+        id новых уникальных запросов выбирает реестр в БД.
 
-    async def delete_request(self, user_id: int, request_id: int | UserRequest) -> UserRequest:
+        :param items: Список пар (id пользователя, запрос пользователя)
+        :return: Результат по каждому элементу пачки в исходном порядке
+        """
+
+        async with self.locks.acquire_all():
+            await self.flush_writes()
+            results: list[BulkRequestResult] = []
+            pending: list[tuple[int, int, RequestRecord]] = []
+            batch_requests: dict[int, set[RequestRecord]] = {}
+            records = [RequestRecord.from_model(model) if user_id in self.users else None for user_id, model in items]
+            batch_keys: dict[RequestRecord, RequestRecord] = {}
+            for request in records:
+                if request is not None and request not in self.unique_keys:
+                    batch_keys.setdefault(request, request)
+
+            inserted = set()
+            async with self.sql_db.SessionLocal() as session:
+                batch_ids = await self._resolve_request_ids(session, list(batch_keys))
+                for (user_id, model), request in zip(items, records):
+                    if request is None:
+                        results.append(BulkRequestResult(
+                            user_id=user_id, status=BulkStatus.error, detail=f"User {user_id} not found"
+                        ))
+                        continue
+                    canonical = self.unique_keys.get(request)
+                    request_id = canonical.request_id if canonical is not None else batch_ids[request]
+                    request.request_id = model.request_id = request_id
+                    if request in self.user_requests.get(user_id, ()) or request in batch_requests.get(user_id, ()):
+                        results.append(
+                            BulkRequestResult(user_id=user_id, request_id=request_id, status=BulkStatus.exists)
+                        )
+                        continue
+                    batch_requests.setdefault(user_id, set()).add(request)
+                    results.append(BulkRequestResult(user_id=user_id, request_id=request_id, status=BulkStatus.created))
+                    pending.append((len(results) - 1, user_id, request))
+
+                if not pending:
+                    return results
+
+                for i in range(0, len(pending), config.BULK_CHUNK_SIZE):
+                    query = self.sql_db.insert_query(
+                        model=UserRequestOrm,
+                        values=[
+                            self._request_values(user_id, request)
+                            for _, user_id, request in pending[i:i + config.BULK_CHUNK_SIZE]
+                        ],
+                        index_elements=["request_id", "user_id"],
+                        returning=(UserRequestOrm.request_id, UserRequestOrm.user_id),
+                    )
+                    res = await session.execute(query)
+                    inserted.update((row.request_id, row.user_id) for row in res)
+                await publish(session, [
+                    add_request_event(user_id, request)
+                    for _, user_id, request in pending
+                    if (request.request_id, user_id) in inserted
+                ])
+                await session.commit()
+
+            rows = []
+            for i, user_id, request in pending:
+                if (request.request_id, user_id) in inserted:
+                    self._index_request(user_id, request)
+                    rows.append(request_to_row(user_id, request))
+                else:
+                    results[i].status = BulkStatus.exists
+            await self.backend.save_requests(rows)
+            return results
+
+    async def delete_request(self, user_id: int, request_id: int | UserRequest | RequestRecord) -> RequestRecord:
         """
         Удаляет запрос конкретного пользователя из репозитория и БД.
+        Запрос, которого нет в индексах репозитория, не ищется в БД: удаление идет под блокировкой ключа записи.
 
         :param user_id: Экземпляр пользователя
         :param request_id: Запрос пользователя
         """
 
-        async with self.sql_db.SessionLocal() as session:
-            if isinstance(request_id, int):
-                res = await session.execute(
-                    select(UserRequestOrm).
-                    where(UserRequestOrm.user_id == user_id, UserRequestOrm.request_id == request_id)
-                )
-                request_orm = res.scalar_one_or_none()
-            elif isinstance(request_id, UserRequest):
-                res = await session.execute(
-                    select(UserRequestOrm).
-                    where(UserRequestOrm.user_id == user_id, UserRequestOrm.request_id == request_id.request_id)
-                )
-                request_orm = res.scalar_one_or_none()
-            else:
-                raise Exception("delete_request: Invalid request_id")
-            await session.delete(request_orm)
-            await session.commit()
-        request = UserRequest.from_db(request_orm)
-        self.user_requests[user_id].discard(request)
-        if not self.user_requests[user_id]:
-            self.user_requests.pop(user_id, None)
-        await self._delete_unique_user_request(user_id, request)
-        return request
+        if isinstance(request_id, (UserRequest, RequestRecord)):
+            request_id = request_id.request_id
+        elif not isinstance(request_id, int):
+            raise Exception("delete_request: Invalid request_id")
+        while True:
+            request = self.user_request_keys.get((user_id, request_id))
+            if request is None:
+                raise Exception(f"delete_request: request {request_id} for user {user_id} not found")
+            async with self.locks.acquire(exclusive=[request], shared=[self._user_lock(user_id)]):
+                if self.user_request_keys.get((user_id, request_id)) is not request:
+                    # Запрос заменили, пока ждали блокировку: блокируется ключ текущей записи
+                    continue
+                if self.write_queue is not None:
+                    await self._unindex_request(user_id, request)
+                    try:
+                        await self.write_queue.put(("delete", user_id, request))
+                    except Exception:
+                        self._index_request(user_id, request)
+                        raise
+                    return request
+                async with self.sql_db.SessionLocal() as session:
+                    res = await session.execute(
+                        self.sql_db.delete_query(
+                            model=UserRequestOrm,
+                            where=(UserRequestOrm.user_id == user_id, UserRequestOrm.request_id == request_id),
+                            returning=(UserRequestOrm.request_id,),
+                        )
+                    )
+                    if res.scalar_one_or_none() is None:
+                        raise Exception(f"delete_request: request {request_id} for user {user_id} not found")
+                    await publish(session, [delete_request_event(user_id, request_id)])
+                    await session.commit()
+                await self.backend.delete_requests([(user_id, request_id)])
+                await self._unindex_request(user_id, request)
+                return request
 
-    async def get_user_request(self, user_id: int, request_id: int | UserRequest) -> UserRequest | None:
-        async with self.sql_db.SessionLocal() as session:
-            if isinstance(request_id, int):
-                res = await session.execute(
-                    select(UserRequestOrm).
-                    where(UserRequestOrm.user_id == user_id, UserRequestOrm.request_id == request_id)
-                )
-                request_orm = res.scalar_one_or_none()
-                if request_orm:
-                    request = UserRequest.from_db(request_orm)
-                else:
-                    return None
-            elif isinstance(request_id, UserRequest):
-                request = request_id
-            else:
-                raise Exception(f"Invalid request_id {request_id}")
-        return request if user_id in self.user_requests and request in self.user_requests[user_id] else None
+    async def delete_requests(
+            self,
+            keys: list[tuple[int, int]] | None = None,
+            symbol: str | None = None,
+            request_ids: list[int] | None = None,
+    ) -> list[tuple[int, int]]:
+        """
+        Удаляет пачку запросов из репозитория и БД set-based запросом DELETE ... RETURNING в одной транзакции.
+        Удаляются запросы, подходящие под любой из переданных фильтров.
 
-    async def get_unique_request(self, request_id) -> UserRequest:
-        async with self.sql_db.SessionLocal() as session:
-            res = await session.execute(
-                select(UserRequestOrm).where(UserRequestOrm.request_id == request_id)
+        :param keys: Список пар (id пользователя, id запроса)
+        :param symbol: Удалить все запросы по символу
+        :param request_ids: Удалить запросы с этими id у всех пользователей
+        :return: Список удаленных пар (id пользователя, id запроса)
+        """
+
+        if not (keys or symbol or request_ids):
+            raise Exception("delete_requests: no filter given")
+        async with self.locks.acquire_all():
+            await self.flush_writes()
+            keys = keys or []
+            request_ids = request_ids or []
+            returning = (UserRequestOrm.user_id, UserRequestOrm.request_id)
+            conditions = [
+                tuple_(*returning).in_(keys[i:i + config.BULK_CHUNK_SIZE])
+                for i in range(0, len(keys), config.BULK_CHUNK_SIZE)
+            ]
+            conditions.extend(
+                UserRequestOrm.request_id.in_(request_ids[i:i + config.BULK_CHUNK_SIZE])
+                for i in range(0, len(request_ids), config.BULK_CHUNK_SIZE)
             )
-            request_orm = res.scalars().first()
-            request = UserRequest.from_db(request_orm)
-        return request
+            if symbol:
+                conditions.append(UserRequestOrm.symbol == symbol.upper())
+            statements = [
+                self.sql_db.delete_query(model=UserRequestOrm, where=(condition,), returning=returning)
+                for condition in conditions
+            ]
 
-    async def get_all_unique_requests(self) -> list[UniqueUserRequest]:
+            deleted = {}
+            async with self.sql_db.SessionLocal() as session:
+                for statement in statements:
+                    res = await session.execute(statement)
+                    for row in res:
+                        deleted.setdefault(row.user_id, set()).add(row.request_id)
+                await publish(session, [
+                    delete_request_event(user_id, request_id) for user_id, ids in deleted.items() for request_id in ids
+                ])
+                await session.commit()
+
+            for user_id, ids in deleted.items():
+                for request_id in ids:
+                    request = self.user_request_keys.get((user_id, request_id))
+                    if request is not None:
+                        await self._unindex_request(user_id, request)
+            keys = [(user_id, request_id) for user_id, ids in deleted.items() for request_id in ids]
+            await self.backend.delete_requests(keys)
+            return keys
+
+    async def get_user_request(
+            self, user_id: int, request_id: int | UserRequest | RequestRecord
+    ) -> UserRequest | RequestRecord | None:
+        if isinstance(request_id, int):
+            return self.user_request_keys.get((user_id, request_id))
+        elif isinstance(request_id, (UserRequest, RequestRecord)):
+            request = request_id
+        else:
+            raise Exception(f"Invalid request_id {request_id}")
+        return request if user_id in self.user_requests and request in self.user_requests[user_id] else None
+
+    async def get_unique_request(self, request_id: int) -> RequestRecord | None:
+        u_req = self.unique_request_ids.get(request_id)
+        if u_req is None or not self.unique_user_requests.get(u_req):
+            return None
+        user_id = next(iter(self.unique_user_requests[u_req]))
+        return self.user_request_keys.get((user_id, request_id))
+
+    async def get_all_unique_requests(self) -> list[RequestRecord]:
         return list(self.unique_user_requests.keys())
 
-    async def get_all_requests_for_user(self, user_id: int) -> set[UserRequest] | None:
+    async def get_all_requests_for_user(self, user_id: int) -> set[RequestRecord] | None:
         return self.user_requests[user_id] if user_id in self.user_requests else None
 
-    async def get_all_users_for_request(self, request_id: int | UserRequest) -> set[int] | None:
+    async def get_all_users_for_request(self, request_id: int | UserRequest | RequestRecord) -> set[int] | None:
         if isinstance(request_id, int):
-            request = await self.get_unique_request(request_id)
-        elif isinstance(request_id, UserRequest):
-            request = request_id
+            u_req = self.unique_request_ids.get(request_id)
+        elif isinstance(request_id, (UserRequest, RequestRecord)):
+            u_req = request_id
         else:
             raise Exception("Invalid request_id")
-        u_req = UniqueUserRequest(request)
         return self.unique_user_requests[u_req] if u_req in self.unique_user_requests else None
 
     async def get_all_requests(self) -> dict:
         return self.user_requests
 
     async def get_all_requests_from_db(self) -> list[UserRequestOrm]:
-        async with self.sql_db.SessionLocal() as session:
+        async with self.sql_db.read_session() as session:
             res = await session.execute(select(UserRequestOrm))
             return res.scalars().all()
 
+    async def get_all_requests_json(self) -> bytes:
+        return self.responses.get(
+            "requests",
+            None,
+            lambda: {
+                user_id: [request.to_dict() for request in requests]
+                for user_id, requests in self.user_requests.items()
+            },
+        )
+
+    async def get_requests_page(
+            self, after: int | None = None, limit: int = config.PAGE_SIZE
+    ) -> tuple[dict, int | None]:
+        """
+        Страница запросов пользователей по возрастанию user_id (keyset-пагинация).
+
+        :param after: user_id последнего пользователя предыдущей страницы
+        :param limit: Количество пользователей на странице
+        :return: Запросы пользователей страницы и курсор следующей страницы (None - страница последняя)
+        """
+
+        # Лишний id показывает, есть ли следующая страница: полная последняя страница получает курсор None
+        user_ids = self.request_user_ids.page(after, limit + 1)
+        next_after = user_ids[limit - 1] if len(user_ids) > limit else None
+        del user_ids[limit:]
+        page = {user_id: self.user_requests[user_id] for user_id in user_ids}
+        return page, next_after
+
     async def to_list_unique_user_requests(self) -> list[UniqueUserRequest]:
-        return [req for req in self.unique_user_requests]
-
-    async def to_list_unique_requests_for_server(self) -> list[RequestForServer]:
-        await self._do_unique_requests_for_server()
-        res = [req for req in self.unique_requests_for_server]
-        return res
-
-    async def load_requests_from_db(self) -> None:
-        requests = await self.get_all_requests_from_db()
-        for request in requests:
-            user_id = request.user_id
-            request_user = UserRequest.from_db(request)
-            if UniqueUserRequest(request_user) in self.unique_user_requests:
-                self.unique_user_requests[UniqueUserRequest(request_user)].add(user_id)
-            else:
-                self.unique_user_requests.update(
-                    {UniqueUserRequest(request_user): {user_id}}
-                )
-            if user_id in self.user_requests:
-                self.user_requests[user_id].add(request_user)
+        return [req.to_unique() for req in self.unique_user_requests]
+
+    async def to_list_unique_requests_for_server(
+            self, shard: int | None = None, shards: int | None = None
+    ) -> list[RequestForServer]:
+        return [
+            request.to_model() for request in self.unique_requests_for_server
+            if shards is None or shard_of(request.symbol, shards) == shard
+        ]
+
+    async def unique_user_requests_json(self) -> bytes:
+        return self.responses.get(
+            "unique", None, lambda: [request.to_unique_dict() for request in self.unique_user_requests]
+        )
+
+    async def requests_for_server_json(self, shard: int | None = None, shards: int | None = None) -> bytes:
+        return self.responses.get(
+            "server",
+            (shard, shards),
+            lambda: [
+                request.to_dict() for request in self.unique_requests_for_server
+                if shards is None or shard_of(request.symbol, shards) == shard
+            ],
+        )
+
+    async def unique_user_requests_msgpack(self) -> bytes:
+        return self.responses.get(
+            "unique",
+            wire.MEDIA_TYPE,
+            lambda: [wire.unique_request(request) for request in self.unique_user_requests],
+            wire.dumps,
+        )
+
+    async def requests_for_server_msgpack(self, shard: int | None = None, shards: int | None = None) -> bytes:
+        return self.responses.get(
+            "server",
+            (shard, shards, wire.MEDIA_TYPE),
+            lambda: [
+                wire.request_for_server(request) for request in self.unique_requests_for_server
+                if shards is None or shard_of(request.symbol, shards) == shard
+            ],
+            wire.dumps,
+        )
+
+    async def shard_weights(self, shards: int) -> list[dict]:
+        """
+        Распределение запросов на API по шардам (consistent hashing по символу).
+
+        :param shards: Количество шардов
+        :return: Для каждого шарда количество символов, запросов на API и их суммарный вес
+        """
+
+        result = [{"shard": i, "symbols": set(), "requests": 0, "weight": 0} for i in range(shards)]
+        for request in self.unique_requests_for_server:
+            stats = result[shard_of(request.symbol, shards)]
+            stats["symbols"].add(request.symbol)
+            stats["requests"] += 1
+            stats["weight"] += request.request_data.weight
+        for stats in result:
+            stats["symbols"] = len(stats["symbols"])
+        return result
+
+    async def changes_since(self, kind: str, since: int, shard: int | None = None, shards: int | None = None) -> dict:
+        """
+        Возвращает изменения уникальных запросов или запросов на API после версии since.
+        Клиент сначала удаляет removed, затем добавляет added.
+        Если since старше журнала или не выдавалась этим экземпляром, возвращается полный список с reset=True.
+
+        :param kind: "unique" или "server"
+        :param since: Версия, полученная клиентом ранее
+        :param shard: Вернуть только изменения символов этого шарда
+        :param shards: Количество шардов
+        :return: Словарь {"version", "reset", "added", "removed"}
+        """
+
+        to_model = RequestRecord.to_unique if kind == "unique" else ServerRecord.to_model
+        entries = self.changelog_since(since)
+        if entries is None:
+            items = self.unique_user_requests if kind == "unique" else self.unique_requests_for_server
+            return {
+                "version": self.version,
+                "reset": True,
+                "added": [
+                    to_model(item) for item in items if shards is None or shard_of(item.symbol, shards) == shard
+                ],
+                "removed": [],
+            }
+        added, removed = {}, {}
+        for _, item_kind, is_added, item in entries:
+            if item_kind != kind or (shards is not None and shard_of(item.symbol, shards) != shard):
+                continue
+            if is_added:
+                added[item] = item
+            elif item in added:
+                added.pop(item)
             else:
-                self.user_requests.update({user_id: {request_user}})
+                removed[item] = item
+        return {
+            "version": self.version,
+            "reset": False,
+            "added": [to_model(item) for item in added],
+            "removed": [to_model(item) for item in removed],
+        }
+
+    def _distance(self, request: RequestRecord) -> float:
+        """
+        Расстояние до срабатывания запроса в процентах.
+        Для запросов по цене считается от последней известной цены символа, если она есть.
+        """
+
+        target = self.price_engine.target_price(request)
+        last_price = self.price_engine.last_prices.get(request.symbol)
+        if target is not None and last_price:
+            return abs(target - last_price) / last_price * 100
+        if request.request_data.type_request == "price":
+            return 100
+        return abs(request.request_data.target_percent)
+
+    def plan_priorities(self) -> dict[ServerRecord, float]:
+        """
+        Приоритет запросов на API: число подписчиков, деленное на (1 + расстояние до ближайшего порога в %).
+
+        :return: Словарь {запрос на API: приоритет}
+        """
+
+        subscribers: dict[ServerRecord, int] = {}
+        distances: dict[ServerRecord, float] = {}
+        for u_req, user_ids in self.unique_user_requests.items():
+            request_for_server = ServerRecord(u_req)
+            subscribers[request_for_server] = subscribers.get(request_for_server, 0) + len(user_ids)
+            distance = self._distance(u_req)
+            if distance < distances.get(request_for_server, distance + 1):
+                distances[request_for_server] = distance
+        return {
+            request_for_server: count / (1 + distances[request_for_server])
+            for request_for_server, count in subscribers.items()
+        }
+
+    async def get_plan(self, rebalance: bool = False) -> dict:
+        """
+        Возвращает план опроса API по слотам с учетом бюджета веса.
+
+        :param rebalance: Перед выдачей перепаковать план по текущим приоритетам
+        :return: План в виде словаря
+        """
+
+        if rebalance:
+            self.planner.rebalance(self.plan_priorities())
+        plan = self.planner.to_dict()
+        for slot in plan["slots"]:
+            slot["requests"] = [request.to_model() for request in slot["requests"]]
+        return plan
+
+    @property
+    def requests_weight(self) -> int:
+        """
+        Суммарный вес опроса API по плану мультисимвольных вызовов.
+        """
+
+        return self._fetch_plan().total_weight
+
+    def _fetch_plan(self) -> FetchPlan:
+        if self.fetch_plan is None or self.fetch_plan[0] != self.version:
+            self.fetch_plan = (
+                self.version,
+                build_fetch_plan(self.unique_requests_for_server, self.planner.weight),
+            )
+        return self.fetch_plan[1]
+
+    async def get_fetch_plan(self, shard: int | None = None, shards: int | None = None) -> FetchPlan:
+        """
+        Возвращает минимальный по весу набор мультисимвольных вызовов API для всех запросов на API.
+        План пересчитывается только после изменения версии репозитория.
+
+        :param shard: Построить план только для символов этого шарда
+        :param shards: Количество шардов
+        :return: План вызовов
+        """
+
+        if shards is not None:
+            requests = [
+                request for request in self.unique_requests_for_server if shard_of(request.symbol, shards) == shard
+            ]
+            return build_fetch_plan(requests, sum(request.request_data.weight for request in requests))
+        return self._fetch_plan()
+
+    async def evaluate_ticks(self, ticks: dict[str, float]) -> list[TriggeredRequest]:
+        """
+        Проверяет пачку тиков по запросам Price и PercentOfPoint.
+
+        :param ticks: Словарь {символ: цена}
+        :return: Сработавшие уникальные запросы и id подписанных на них пользователей
+        """
+
+        return [
+            TriggeredRequest(request=request.to_unique(), user_ids=self.unique_user_requests.get(request, set()))
+            for request in self.price_engine.evaluate(ticks)
+        ]
+
+    async def evaluate_percent_changes(self, changes: dict[str, dict[Period, float]]) -> list[TriggeredRequest]:
+        """
+        Проверяет пачку изменений цены по запросам PercentOfTime.
+
+        :param changes: Словарь {символ: {период: изменение цены в процентах}}
+        :return: Сработавшие уникальные запросы и id подписанных на них пользователей
+        """
+
+        return [
+            TriggeredRequest(request=request.to_unique(), user_ids=self.unique_user_requests.get(request, set()))
+            for request in self.percent_engine.evaluate(changes)
+        ]
+
+    async def load_requests_from_db(self) -> int:
+        """
+        Загружает запросы пользователей из БД порциями через серверный курсор,
+        индексы строятся по мере получения строк.
+
+        :return: Количество загруженных строк
+        """
+
+        rows = 0
+        async with self.load_session() as session:
+            res = await session.stream(
+                select(UserRequestOrm).execution_options(yield_per=config.DB_LOAD_CHUNK_SIZE)
+            )
+            async for requests in res.scalars().partitions():
+                for request in requests:
+                    user_id = request.user_id
+                    self._index_request(user_id, RequestRecord.from_orm(request))
+                rows += len(requests)
+        return rows
 
 
 class Repository(UserRepository, RequestRepository):
 
     async def delete_user(self, user_id: int) -> User:
-        user = self.users.get(user_id)
-        if not user:
-            raise Exception(f"Ошибка удаления пользователя (пользователь с id {user_id} не существует)")
-        else:
-            user_requests = self.user_requests.get(user_id, [])
-            for request in user_requests:
-                await self._delete_unique_user_request(user_id, request)
-            self.user_requests.pop(user_id, None)
+        async with self.locks.acquire(exclusive=[self._user_lock(user_id)]):
+            user = self.users.get(user_id)
+            if not user:
+                raise Exception(f"Ошибка удаления пользователя (пользователь с id {user_id} не существует)")
+            await self.flush_writes()
+            await self._unindex_user_requests(user_id)
             async with self.sql_db.SessionLocal() as session:
-                res = await session.execute(select(UserOrm).where(UserOrm.user_id == user_id))
+                res = await session.execute(
+                    self.sql_db.delete_query(model=UserOrm, where=(UserOrm.user_id == user_id,), returning=(UserOrm,))
+                )
                 user = res.scalar_one_or_none()
                 if user:
-                    await session.delete(user)
+                    await publish(session, [delete_user_event(user_id)])
                     await session.commit()
-                    self.users.pop(user_id, None)
+                    self._pop_user(user_id)
+                    await self.backend.delete_user(user_id)
                     return User(**user.__dict__)
                 else:
                     raise Exception(f"Ошибка удаления пользователя с id {user_id})")
+
+    def clear(self) -> None:
+        """
+        Очищает все индексы репозитория в памяти.
+        """
+
+        self.users.clear()
+        self.user_ids.clear()
+        self.user_requests.clear()
+        self.request_user_ids.clear()
+        self.user_request_keys.clear()
+        self.unique_user_requests.clear()
+        self.unique_keys.clear()
+        self.unique_request_ids.clear()
+        self.unique_requests_for_server.clear()
+        self.requests_for_server_refs.clear()
+        self.price_engine.clear()
+        self.percent_engine.clear()
+        self.planner.clear()
+        self.changelog.clear()
+        self.responses.clear()
+        self.version += 1
+        self.changelog_start = self.version
+        for subscription in self.subscriptions:
+            subscription.close()
+
+    async def reload(self) -> None:
+        """
+        Полностью перезагружает репозиторий из БД.
+        """
+
+        await self.flush_writes()
+        self.clear()
+        await asyncio.gather(self.load_users_from_db(), self.load_requests_from_db())
+
+    async def apply_changes(self, events: list[dict]) -> None:
+        """
+        Применяет к индексам в памяти события из канала изменений другого экземпляра сервиса.
+        БД не изменяется, повторное применение события не меняет состояние.
+
+        :param events: События изменения репозитория
+        """
+
+        for event in events:
+            if event["op"] in ("add_user", "update_user"):
+                self._set_user(user_from_row(event["user"]))
+            elif event["op"] == "delete_user":
+                await self._unindex_user_requests(event["user_id"])
+                self._pop_user(event["user_id"])
+            elif event["op"] == "add_request":
+                user_id, request = request_from_row(event["request"])
+                if (user_id, request.request_id) not in self.user_request_keys:
+                    self._index_request(user_id, request)
+            elif event["op"] == "delete_request":
+                request = self.user_request_keys.get((event["user_id"], event["request_id"]))
+                if request is not None:
+                    await self._unindex_request(event["user_id"], request)
+            else:
+                logging.warning(f'apply_changes: unknown event {event}')
+
+    def _state(self) -> tuple[list[User], list[tuple[tuple[int, int], RequestRecord]]]:
+        """
+        Копия содержимого индексов без обхода в Python:
+        список пользователей и пар ((id пользователя, id запроса), запрос).
+        """
+
+        return list(self.users.values()), list(self.user_request_keys.items())
+
+    @staticmethod
+    def _state_rows(
+            users: list[User], requests: list[tuple[tuple[int, int], RequestRecord]]
+    ) -> tuple[list[tuple], list[tuple]]:
+        return (
+            [user_to_row(user) for user in users],
+            [request_to_row(user_id, request) for (user_id, _), request in requests],
+        )
+
+    def _rows(self) -> tuple[list[tuple], list[tuple]]:
+        return self._state_rows(*self._state())
+
+    def _load_rows(self, users: list[tuple], requests: list[tuple]) -> None:
+        for row in users:
+            self._set_user(user_from_row(row))
+        for row in requests:
+            self._index_request(*request_from_row(row))
+
+    async def load_from_backend(self) -> bool:
+        """
+        Загружает репозиторий из общего прогретого индекса.
+
+        :return: True, если индекс был прогрет и загружен
+        """
+
+        loaded = await self.backend.load()
+        if loaded is None:
+            return False
+        self._load_rows(*loaded)
+        return True
+
+    async def save_to_backend(self) -> None:
+        """
+        Полностью заменяет общий прогретый индекс текущим состоянием репозитория.
+        """
+
+        await self.backend.replace(*self._rows())
+
+    async def save_snapshot(self, path: str) -> None:
+        """
+        Сохраняет снимок пользователей и запросов в файл.
+        В цикле событий индексы только копируются списками, построение строк, сериализация и запись
+        выполняются в отдельном потоке. Изменения после копирования досинхронизирует загрузка снимка.
+
+        :param path: Путь к файлу снимка
+        """
+
+        await self.flush_writes()
+        watermark = datetime.utcnow()
+        state = self._state()
+
+        def write() -> None:
+            users, requests = self._state_rows(*state)
+            write_snapshot(path, Snapshot(watermark=watermark, users=users, requests=requests))
+
+        await asyncio.to_thread(write)
+
+    async def load_from_snapshot(self, path: str) -> bool:
+        """
+        Загружает репозиторий из снимка и досинхронизирует его с БД.
+        При ошибке чтения или проверки снимка репозиторий остается пустым.
+
+        :param path: Путь к файлу снимка
+        :return: True, если репозиторий загружен из снимка
+        """
+
+        try:
+            snapshot = await asyncio.to_thread(read_snapshot, path)
+        except SnapshotError as e:
+            logging.warning(f'load_from_snapshot: {e}')
+            return False
+        try:
+            self._load_rows(snapshot.users, snapshot.requests)
+            await self._replay_changes(snapshot.watermark)
+        except Exception as e:
+            logging.warning(f'load_from_snapshot: replay of {path} failed - {e}')
+            self.clear()
+            return False
+        return True
+
+    async def _replay_changes(self, watermark: datetime) -> None:
+        """
+        Досинхронизирует загруженный из снимка репозиторий с БД.
+        Сканируются только ключи и updated: строки, которых нет в снимке или измененные после watermark,
+        дочитываются из БД, а отсутствующие в БД удаляются из репозитория.
+        Читает основную БД, а не реплику: отстающая реплика удалила бы строки, записанные до watermark.
+
+        :param watermark: Момент снятия снимка
+        """
+
+        changed_users, seen_users = [], set()
+        changed_requests, seen_requests = [], set()
+        async with self.sql_db.SessionLocal() as session:
+            res = await session.stream(
+                select(UserOrm.user_id, UserOrm.updated).execution_options(yield_per=config.DB_LOAD_CHUNK_SIZE)
+            )
+            async for rows in res.partitions():
+                for user_id, updated in rows:
+                    seen_users.add(user_id)
+                    if user_id not in self.users or (updated is not None and updated > watermark):
+                        changed_users.append(user_id)
+            res = await session.stream(
+                select(UserRequestOrm.user_id, UserRequestOrm.request_id, UserRequestOrm.updated)
+                .execution_options(yield_per=config.DB_LOAD_CHUNK_SIZE)
+            )
+            async for rows in res.partitions():
+                for user_id, request_id, updated in rows:
+                    seen_requests.add((user_id, request_id))
+                    if (user_id, request_id) not in self.user_request_keys or updated > watermark:
+                        changed_requests.append((user_id, request_id))
+
+            for user_id in [user_id for user_id in self.users if user_id not in seen_users]:
+                self._pop_user(user_id)
+            for key in [key for key in self.user_request_keys if key not in seen_requests]:
+                await self._unindex_request(key[0], self.user_request_keys[key])
+
+            for i in range(0, len(changed_users), config.BULK_CHUNK_SIZE):
+                res = await session.execute(
+                    select(UserOrm).where(UserOrm.user_id.in_(changed_users[i:i + config.BULK_CHUNK_SIZE]))
+                )
+                for user in res.scalars():
+                    self._set_user(User(**user.__dict__))
+            for i in range(0, len(changed_requests), config.BULK_CHUNK_SIZE):
+                res = await session.execute(
+                    select(UserRequestOrm).where(
+                        tuple_(UserRequestOrm.user_id, UserRequestOrm.request_id)
+                        .in_(changed_requests[i:i + config.BULK_CHUNK_SIZE])
+                    )
+                )
+                for request_orm in res.scalars():
+                    user_id = request_orm.user_id
+                    request = self.user_request_keys.get((user_id, request_orm.request_id))
+                    if request is not None:
+                        await self._unindex_request(user_id, request)
+                    self._index_request(user_id, RequestRecord.from_orm(request_orm))
+        logging.info(
+            f'Snapshot replay: {len(changed_users)} users and {len(changed_requests)} requests '
+            f'changed since {watermark}'
+        )
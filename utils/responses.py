@@ -0,0 +1,68 @@
+from typing import Callable, Hashable
+
+import orjson
+from pydantic import BaseModel
+
+OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content) -> bytes:
+    """
+    Сериализует ответ в JSON через orjson: ключи словарей приводятся к строкам, множества - к спискам,
+    pydantic-модели и записи репозитория - к словарям. Результат совпадает с jsonable_encoder FastAPI.
+    """
+
+    return orjson.dumps(content, default=_default, option=OPTIONS)
+
+
+class ResponseCache:
+    """
+    Кэш готовых ответов (JSON, MessagePack) больших списков. Ответ рендерится один раз и отдается
+    повторно без сериализации, пока репозиторий не сбросит его при изменении данных.
+    """
+
+    def __init__(self):
+        self.entries: dict[str, dict[Hashable, bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+            self,
+            name: str,
+            params: Hashable,
+            render: Callable[[], object],
+            serialize: Callable[[object], bytes] = dumps,
+    ) -> bytes:
+        """
+        :param name: Имя ответа, по которому он сбрасывается
+        :param params: Параметры запроса (например, шард и формат)
+        :param render: Возвращает содержимое ответа для сериализации
+        :param serialize: Сериализатор содержимого (по умолчанию JSON)
+        :return: Тело ответа
+        """
+
+        entries = self.entries.setdefault(name, {})
+        body = entries.get(params)
+        if body is None:
+            self.misses += 1
+            body = entries[params] = serialize(render())
+        else:
+            self.hits += 1
+        return body
+
+    def invalidate(self, *names: str) -> None:
+        for name in names:
+            self.entries.pop(name, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
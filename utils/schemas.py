@@ -23,6 +23,12 @@ class Way(enum.Enum):
     all = "all"
 
 
+class BulkStatus(enum.Enum):
+    created = "created"
+    exists = "exists"
+    error = "error"
+
+
 class Token(BaseModel):
     access_token: str
     refresh_token: str
@@ -170,7 +176,7 @@ class UserRequest(BaseModel):
                 other.request_data,
                 other.way,
             )
-        return False
+        return NotImplemented
 
     def __ne__(self, other):
         return not self == other
@@ -193,16 +199,20 @@ class UserRequest(BaseModel):
         return UserRequest(symbol=symbol, request_data=request_data, way=way, created=dt, updated=dt)
 
     @staticmethod
-    def from_db(request_orm):
-        request_data_temp = json.loads(request_orm.request_data)
+    def request_data_from_json(request_data: str) -> PercentOfTime | PercentOfPoint | Price:
+        request_data_temp = json.loads(request_data)
         if request_data_temp["type_request"] == "price":
-            request_orm.request_data = Price(**request_data_temp)
+            return Price(**request_data_temp)
         elif request_data_temp["type_request"] == "percent_of_point":
-            request_orm.request_data = PercentOfPoint(**request_data_temp)
+            return PercentOfPoint(**request_data_temp)
         elif request_data_temp["type_request"] == "percent_of_time":
-            request_orm.request_data = PercentOfTime(**request_data_temp)
+            return PercentOfTime(**request_data_temp)
         else:
             raise ValueError(f"Unknown type request: {request_data_temp}")
+
+    @staticmethod
+    def from_db(request_orm):
+        request_orm.request_data = UserRequest.request_data_from_json(request_orm.request_data)
         request_orm.way = Way(request_orm.way)
         request_orm.__dict__.pop("_sa_instance_state")
         return UserRequest(**request_orm.__dict__)
@@ -216,6 +226,29 @@ class UserRequestSchema(BaseModel):
     updated: datetime.datetime
 
 
+class BulkRequestItem(BaseModel):
+    user_id: int
+    request: UserRequestSchema
+
+
+class BulkRequestResult(BaseModel):
+    user_id: int
+    request_id: int | None = None
+    status: BulkStatus
+    detail: str | None = None
+
+
+class UserRequestKey(BaseModel):
+    user_id: int
+    request_id: int
+
+
+class BulkDeleteRequest(BaseModel):
+    items: list[UserRequestKey] = []
+    symbol: str | None = None
+    request_ids: list[int] = []
+
+
 class UniqueUserRequest(BaseModel):
     request_id: int | None = None
     symbol: str | None = None
@@ -239,7 +272,7 @@ class UniqueUserRequest(BaseModel):
                 other.request_data,
                 other.way,
             )
-        return False
+        return NotImplemented
 
     def __ne__(self, other):
         return not self == other
@@ -286,7 +319,7 @@ class RequestForServer(BaseModel):
                 other.symbol,
                 other.request_data,
             )
-        return False
+        return NotImplemented
 
     def __ne__(self, other):
         return not self == other
@@ -300,3 +333,20 @@ class RequestForServer(BaseModel):
     def __str__(self):
         return self.__repr__()
 
+
+class TriggeredRequest(BaseModel):
+    request: UniqueUserRequest
+    user_ids: set[int]
+
+
+class FetchCall(BaseModel):
+    endpoint: str
+    symbols: list[str] | None = None
+    window: str | None = None
+    weight: int
+
+
+class FetchPlan(BaseModel):
+    calls: list[FetchCall]
+    total_weight: int
+    naive_weight: int
@@ -0,0 +1,33 @@
+from functools import lru_cache
+from hashlib import blake2b
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping, Veach): при изменении количества корзин с n на n + 1
+    в новую корзину переходит только 1/(n + 1) ключей, остальные остаются на месте.
+
+    :param key: 64-битный ключ
+    :param buckets: Количество корзин
+    :return: Номер корзины от 0 до buckets - 1
+    """
+
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+@lru_cache(maxsize=65536)
+def shard_of(symbol: str, shards: int) -> int:
+    """
+    Возвращает номер шарда символа. Хэш символа стабилен между процессами (в отличие от hash()).
+
+    :param symbol: Символ
+    :param shards: Количество шардов
+    :return: Номер шарда от 0 до shards - 1
+    """
+
+    return jump_hash(int.from_bytes(blake2b(symbol.encode(), digest_size=8).digest(), "little"), shards)
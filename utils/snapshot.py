@@ -0,0 +1,142 @@
+import marshal
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from utils.records import RequestRecord, data_from_json
+from utils.schemas import User, UserRequest, Way
+
+MAGIC = b"CIRMSNAP"
+VERSION = 1
+HEADER = struct.Struct("<8sHHqQQQI")
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot(NamedTuple):
+    watermark: datetime
+    users: list[tuple]
+    requests: list[tuple]
+
+
+def to_us(dt: datetime | None) -> int | None:
+    return None if dt is None else (dt - EPOCH) // MICROSECOND
+
+
+def from_us(us: int | None) -> datetime | None:
+    return None if us is None else EPOCH + us * MICROSECOND
+
+
+def user_to_row(user: User) -> tuple:
+    return (
+        user.user_id,
+        user.firstname,
+        user.surname,
+        user.username,
+        user.ban,
+        to_us(user.created),
+        to_us(user.updated),
+    )
+
+
+def user_from_row(row: tuple) -> User:
+    user_id, firstname, surname, username, ban, created, updated = row
+    return User(
+        user_id=user_id,
+        firstname=firstname,
+        surname=surname,
+        username=username,
+        ban=ban,
+        created=from_us(created),
+        updated=from_us(updated),
+    )
+
+
+def request_to_row(user_id: int, request: UserRequest | RequestRecord) -> tuple:
+    return (
+        request.request_id,
+        user_id,
+        request.symbol,
+        request.request_data.json(),
+        request.way.value,
+        to_us(request.created),
+        to_us(request.updated),
+    )
+
+
+def request_from_row(row: tuple) -> tuple[int, RequestRecord]:
+    request_id, user_id, symbol, request_data, way, created, updated = row
+    return user_id, RequestRecord(
+        request_id,
+        symbol,
+        data_from_json(request_data),
+        Way(way),
+        from_us(created),
+        from_us(updated),
+    )
+
+
+def write_snapshot(path: str, snapshot: Snapshot) -> None:
+    """
+    Записывает снимок репозитория в файл.
+    Формат: заголовок фиксированной длины (магия, версии, watermark, количество строк, длина и crc32 данных)
+    и строки пользователей и запросов, сериализованные marshal. Файл заменяется атомарно.
+
+    :param path: Путь к файлу снимка
+    :param snapshot: Снимок
+    """
+
+    payload = marshal.dumps((snapshot.users, snapshot.requests))
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        marshal.version,
+        to_us(snapshot.watermark),
+        len(snapshot.users),
+        len(snapshot.requests),
+        len(payload),
+        zlib.crc32(payload),
+    )
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Snapshot:
+    """
+    Читает снимок репозитория через mmap и проверяет его целостность.
+
+    :param path: Путь к файлу снимка
+    :return: Снимок
+    :raises SnapshotError: Файл отсутствует, поврежден или записан в несовместимом формате
+    """
+
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < HEADER.size:
+                raise SnapshotError(f"Snapshot {path} is truncated")
+            magic, version, marshal_version, watermark, users, requests, length, crc = HEADER.unpack_from(mm)
+            if magic != MAGIC or version != VERSION or marshal_version != marshal.version:
+                raise SnapshotError(f"Snapshot {path} has incompatible format")
+            if len(mm) != HEADER.size + length:
+                raise SnapshotError(f"Snapshot {path} has wrong length")
+            with memoryview(mm)[HEADER.size:] as payload:
+                if zlib.crc32(payload) != crc:
+                    raise SnapshotError(f"Snapshot {path} checksum mismatch")
+                users_rows, requests_rows = marshal.loads(payload)
+    except (OSError, ValueError, EOFError, TypeError) as e:
+        raise SnapshotError(f"Snapshot {path} can not be read: {e}") from e
+    if len(users_rows) != users or len(requests_rows) != requests:
+        raise SnapshotError(f"Snapshot {path} row count mismatch")
+    return Snapshot(watermark=from_us(watermark), users=users_rows, requests=requests_rows)
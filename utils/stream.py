@@ -0,0 +1,105 @@
+import asyncio
+from typing import AsyncIterator
+
+import config
+from utils.records import RequestRecord, ServerRecord
+from utils.responses import dumps
+from utils.schemas import UniqueUserRequest, RequestForServer
+
+ChangeEntry = tuple[int, str, bool, RequestRecord | ServerRecord]
+
+
+class Subscription:
+    """
+    Подписка клиента на изменения репозитория с ограниченной очередью.
+    Если клиент не успевает читать и очередь переполняется, подписка помечается overflowed,
+    поток закрывается событием reset, и клиент переподключается с последней полученной версией.
+    """
+
+    __slots__ = ("queue", "overflowed")
+
+    def __init__(self, maxsize: int = config.STREAM_QUEUE_SIZE):
+        self.queue: asyncio.Queue[ChangeEntry | None] = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def push(self, entry: ChangeEntry) -> None:
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def close(self) -> None:
+        """
+        Закрывает поток, например после полной перезагрузки репозитория: клиент должен запросить новый снимок.
+        """
+
+        self.overflowed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+
+def sse_event(event: str, data: str, event_id: int | None = None) -> str:
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event}")
+    lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+
+def change_event(entry: ChangeEntry) -> str:
+    version, kind, added, item = entry
+    item = item.to_unique_dict() if kind == "unique" else item.to_dict()
+    return sse_event("added" if added else "removed", dumps({"kind": kind, "item": item}).decode(), version)
+
+
+def snapshot_event(version: int, unique: list[UniqueUserRequest], server: list[RequestForServer]) -> str:
+    return sse_event("snapshot", dumps({"version": version, "unique": unique, "server": server}).decode(), version)
+
+
+async def stream_changes(
+        repo,
+        since: int | None = None,
+        ping_interval: float = config.STREAM_PING_INTERVAL,
+) -> AsyncIterator[str]:
+    """
+    Поток Server-Sent Events с изменениями уникальных запросов и запросов на API.
+    Сначала отправляется снимок (snapshot) или, если клиент передал since и журнал его покрывает,
+    пропущенные изменения. Затем изменения отправляются по мере их появления,
+    id события равен версии репозитория.
+
+    :param repo: Репозиторий
+    :param since: Последняя полученная клиентом версия
+    :param ping_interval: Интервал отправки комментариев keep-alive в секундах
+    """
+
+    subscription = repo.subscribe()
+    try:
+        entries = None if since is None else repo.changelog_since(since)
+        if entries is None:
+            version = repo.version
+            yield snapshot_event(
+                version,
+                await repo.to_list_unique_user_requests(),
+                await repo.to_list_unique_requests_for_server(),
+            )
+        else:
+            version = entries[-1][0] if entries else since
+            for entry in entries:
+                yield change_event(entry)
+        while not subscription.overflowed:
+            try:
+                entry = await asyncio.wait_for(subscription.queue.get(), ping_interval)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if subscription.overflowed:
+                break
+            if entry[0] > version:
+                yield change_event(entry)
+                version = entry[0]
+        yield sse_event("reset", f'{{"version":{version}}}')
+    finally:
+        repo.unsubscribe(subscription)
@@ -0,0 +1,190 @@
+"""
+Компактный бинарный формат (MessagePack) ответов репозитория для сервисов опроса цен и бота.
+
+Запросы кодируются массивами, перечисления и type_request - малыми целыми:
+    данные:              [TYPE_PRICE, target_price, weight]
+                         [TYPE_PERCENT_OF_POINT, target_percent, current_price, weight]
+                         [TYPE_PERCENT_OF_TIME, target_percent, period, weight]
+    запрос на API:       [symbol, данные]
+    уникальный запрос:   [request_id, symbol, way, данные]
+    запрос пользователя: [request_id, symbol, way, данные, created, updated]
+Время передается целым числом микросекунд от начала эпохи (UTC без часового пояса).
+Кодировщики принимают и записи репозитория, и pydantic-модели.
+"""
+
+from datetime import datetime, timedelta
+
+import msgpack
+
+from utils.schemas import (
+    UserRequest,
+    UniqueUserRequest,
+    RequestForServer,
+    Price,
+    PercentOfPoint,
+    PercentOfTime,
+    Period,
+    Way,
+)
+
+MEDIA_TYPE = "application/msgpack"
+
+TYPE_PRICE = 0
+TYPE_PERCENT_OF_POINT = 1
+TYPE_PERCENT_OF_TIME = 2
+
+WAYS = (Way.up_to, Way.down_to, Way.all)
+WAY_CODES = {way: code for code, way in enumerate(WAYS)}
+PERIODS = (Period.v_4h, Period.v_8h, Period.v_12h, Period.v_24h)
+PERIOD_CODES = {period: code for code, period in enumerate(PERIODS)}
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def _time(dt: datetime) -> int:
+    return (dt - EPOCH) // MICROSECOND
+
+
+def _from_time(value: int) -> datetime:
+    return EPOCH + value * MICROSECOND
+
+
+def _data(data) -> list:
+    if data.type_request == "price":
+        return [TYPE_PRICE, data.target_price, data.weight]
+    if data.type_request == "percent_of_point":
+        return [TYPE_PERCENT_OF_POINT, data.target_percent, data.current_price, data.weight]
+    return [TYPE_PERCENT_OF_TIME, data.target_percent, PERIOD_CODES[data.period], data.weight]
+
+
+def _from_data(value: list) -> Price | PercentOfPoint | PercentOfTime:
+    if value[0] == TYPE_PRICE:
+        return Price.model_construct(target_price=value[1], weight=value[2])
+    if value[0] == TYPE_PERCENT_OF_POINT:
+        return PercentOfPoint.model_construct(target_percent=value[1], current_price=value[2], weight=value[3])
+    if value[0] == TYPE_PERCENT_OF_TIME:
+        return PercentOfTime.model_construct(target_percent=value[1], period=PERIODS[value[2]], weight=value[3])
+    raise ValueError(f"Unknown type request code: {value[0]}")
+
+
+def request_for_server(request) -> list:
+    return [request.symbol, _data(request.request_data)]
+
+
+def unique_request(request) -> list:
+    return [request.request_id, request.symbol, WAY_CODES[request.way], _data(request.request_data)]
+
+
+def user_request(request) -> list:
+    return [
+        request.request_id,
+        request.symbol,
+        WAY_CODES[request.way],
+        _data(request.request_data),
+        _time(request.created),
+        _time(request.updated),
+    ]
+
+
+def dumps(content) -> bytes:
+    return msgpack.packb(content, use_bin_type=True)
+
+
+ENCODERS = {"server": request_for_server, "unique": unique_request}
+
+
+def dumps_changes(changes: dict, kind: str) -> bytes:
+    """
+    Кодирует ответ changes_since.
+
+    :param changes: Словарь {"version", "reset", "added", "removed"}
+    :param kind: "unique" или "server"
+    """
+
+    encode = ENCODERS[kind]
+    return dumps(
+        {
+            "version": changes["version"],
+            "reset": changes["reset"],
+            "added": [encode(request) for request in changes["added"]],
+            "removed": [encode(request) for request in changes["removed"]],
+        }
+    )
+
+
+def _from_request_for_server(value: list) -> RequestForServer:
+    symbol, data = value
+    return RequestForServer.model_construct(symbol=symbol, request_data=_from_data(data))
+
+
+def _from_unique_request(value: list) -> UniqueUserRequest:
+    request_id, symbol, way, data = value
+    return UniqueUserRequest.model_construct(
+        request_id=request_id, symbol=symbol, way=WAYS[way], request_data=_from_data(data)
+    )
+
+
+def _from_user_request(value: list) -> UserRequest:
+    request_id, symbol, way, data, created, updated = value
+    return UserRequest.model_construct(
+        request_id=request_id,
+        symbol=symbol,
+        way=WAYS[way],
+        request_data=_from_data(data),
+        created=_from_time(created),
+        updated=_from_time(updated),
+    )
+
+
+DECODERS = {"server": _from_request_for_server, "unique": _from_unique_request}
+
+
+def loads_requests_for_server(body: bytes) -> list[RequestForServer]:
+    """
+    Декодирует ответ /requests/server/ в формате MessagePack (для клиентов сервиса).
+
+    :param body: Тело ответа
+    :return: Запросы на API
+    """
+
+    return [_from_request_for_server(value) for value in msgpack.unpackb(body)]
+
+
+def loads_unique_requests(body: bytes) -> list[UniqueUserRequest]:
+    """
+    Декодирует ответ /requests/unique/ в формате MessagePack (для клиентов сервиса).
+
+    :param body: Тело ответа
+    :return: Уникальные запросы
+    """
+
+    return [_from_unique_request(value) for value in msgpack.unpackb(body)]
+
+
+def loads_user_requests(body: bytes) -> list[UserRequest] | None:
+    """
+    Декодирует ответ /requests/users/{user_id} в формате MessagePack (для клиентов сервиса).
+
+    :param body: Тело ответа
+    :return: Запросы пользователя или None, если у пользователя нет запросов
+    """
+
+    requests = msgpack.unpackb(body)
+    return None if requests is None else [_from_user_request(value) for value in requests]
+
+
+def loads_changes(body: bytes, kind: str) -> dict:
+    """
+    Декодирует ответ ?since= в формате MessagePack (для клиентов сервиса).
+
+    :param body: Тело ответа
+    :param kind: "unique" или "server"
+    :return: Словарь {"version", "reset", "added", "removed"}
+    """
+
+    changes = msgpack.unpackb(body)
+    decode = DECODERS[kind]
+    changes["added"] = [decode(value) for value in changes["added"]]
+    changes["removed"] = [decode(value) for value in changes["removed"]]
+    return changes
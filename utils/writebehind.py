@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+import config
+
+DURABILITY_MEMORY = "memory"
+DURABILITY_COMMIT = "commit"
+PERMANENT_ERRORS = (IntegrityError, DataError)
+
+
+class GroupCommitQueue:
+    """
+    Очередь отложенной записи (write-behind) изменений в БД.
+    Изменения копятся и сбрасываются одной транзакцией каждые interval_ms миллисекунд
+    или при накоплении batch_size изменений (group commit).
+    Если пачка не записалась, изменения повторяются по одному: изменение с постоянной ошибкой
+    (нарушение ограничения, неверные данные) отклоняется само, не задерживая остальные.
+
+    Режимы надежности:
+        memory - put возвращается сразу, отклоненное изменение передается в rejected,
+                 при временной ошибке (например, недоступна БД) изменения остаются в очереди и повторяются;
+        commit - put ждет фиксации транзакции с изменением и пробрасывает его ошибку.
+    """
+
+    def __init__(
+            self,
+            commit: Callable[[list[tuple]], Awaitable[None]],
+            interval_ms: int = config.WRITE_BEHIND_INTERVAL_MS,
+            batch_size: int = config.WRITE_BEHIND_BATCH_SIZE,
+            durability: str = config.WRITE_BEHIND_DURABILITY,
+            rejected: Callable[[tuple, Exception], Awaitable[None]] | None = None,
+    ):
+        if durability not in (DURABILITY_MEMORY, DURABILITY_COMMIT):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.commit = commit
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.durability = durability
+        self.rejected = rejected
+        self.items: list[tuple[tuple, asyncio.Future | None]] = []
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+        self.closing = False
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    async def put(self, op: tuple) -> None:
+        """
+        :param op: Изменение, которое будет передано в commit
+        """
+
+        future = asyncio.get_running_loop().create_future() if self.durability == DURABILITY_COMMIT else None
+        self.items.append((op, future))
+        if len(self.items) >= self.batch_size:
+            self.wakeup.set()
+        if future is not None:
+            await future
+
+    async def flush(self) -> None:
+        """
+        Сбрасывает в БД все накопленные изменения пачками по batch_size.
+        Если сброс прерван (в том числе отменой задачи), незаписанные изменения возвращаются в очередь.
+        Изменения идемпотентны, поэтому повтор уже зафиксированной пачки безопасен.
+        """
+
+        async with self.lock:
+            while self.items:
+                batch = self.items[:self.batch_size]
+                del self.items[:self.batch_size]
+                try:
+                    await self.commit([op for op, _ in batch])
+                except Exception as e:
+                    logging.error(f'write-behind commit error: {e}')
+                    await self._commit_each(batch)
+                    continue
+                except BaseException:
+                    self.items[:0] = batch
+                    raise
+                self.batches += 1
+                self._resolve(batch)
+
+    async def _commit_each(self, batch: list[tuple[tuple, asyncio.Future | None]]) -> None:
+        """
+        Записывает изменения пачки по одному, отделяя изменения с постоянной ошибкой.
+        При временной ошибке оставшиеся изменения возвращаются в очередь с пробросом ошибки (memory)
+        или получают ошибку (commit).
+        """
+
+        for i, (op, future) in enumerate(batch):
+            try:
+                await self.commit([op])
+            except PERMANENT_ERRORS as e:
+                logging.error(f'write-behind rejected {op[:2]}: {e}')
+                if future is not None:
+                    if not future.done():
+                        future.set_exception(e)
+                elif self.rejected is not None:
+                    await self.rejected(op, e)
+                continue
+            except Exception as e:
+                if self.durability == DURABILITY_MEMORY:
+                    self.items[:0] = batch[i:]
+                    raise
+                for _, pending in batch[i:]:
+                    if not pending.done():
+                        pending.set_exception(e)
+                return
+            except BaseException:
+                self.items[:0] = batch[i:]
+                raise
+            self._resolve([(op, future)])
+
+    @staticmethod
+    def _resolve(batch: list[tuple[tuple, asyncio.Future | None]]) -> None:
+        for _, future in batch:
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def run(self) -> None:
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    def start(self) -> None:
+        if self.task is None:
+            self.closing = False
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """
+        Останавливает фоновую задачу, дождавшись текущего сброса, и сбрасывает оставшиеся изменения.
+        """
+
+        if self.task is not None:
+            self.closing = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()